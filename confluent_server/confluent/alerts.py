@@ -28,11 +28,44 @@
 # packet rather than have something block snmptrapd at all for things confluent
 # can handle.
 
+# Phase 2 is implemented by start_trap_receiver, enabled by setting trapport
+# in the [alerts] section of the configuration, with snmptrapd forwarding to
+# that port (or the port being 162 itself).  Traps are parsed in-process,
+# attributed to nodes, coalesced so that a burst of identical traps from a
+# node is decoded once, and handed to the hardware plugins a batch of nodes at
+# a time.  Decoded events are recorded in the event log.
+
 __author__ = 'jjohnson2'
 
+import confluent.config.conf as conf
+import confluent.config.configmanager as configmanager
 import confluent.exceptions as exc
+import confluent.log as log
 import confluent.lookuptools as lookuptools
+import confluent.messages as msg
 import confluent.core
+import collections
+import eventlet
+import eventlet.event
+import eventlet.green.socket as socket
+from pyasn1.codec.ber import decoder as berdecoder
+from pyasn1.type import univ
+from pysnmp.proto import api as snmpapi
+from pysnmp.proto import rfc1155, rfc1902
+
+trapcounters = {
+    'received': 0,
+    'decoded': 0,
+    'dropped': 0,
+    'coalesced': 0,
+}
+# node -> OrderedDict of coalescing key to varbinds awaiting decode
+_pendingtraps = {}
+_numpending = 0
+_trapwaiting = None
+_snmptrapoid = '.1.3.6.1.6.3.1.1.4.1.0'
+_snmptrapaddress = '.1.3.6.1.6.3.18.1.3.0'
+_sysuptime = '.1.3.6.1.2.1.1.3.0'
 
 def decode_alert(varbinds, configmanager):
     """Decode an SNMP alert for a server
@@ -57,3 +90,172 @@ def decode_alert(varbinds, configmanager):
         '/nodes/{0}/events/hardware/decode'.format(node), 'update',
         configmanager, varbinds, autostrip=False)
 
+
+
+def _format_value(value):
+    if (isinstance(value, univ.OctetString) and
+            not isinstance(value, (rfc1155.IpAddress, rfc1902.IpAddress))):
+        # match the hex form that snmptrapd would have handed over
+        return ':'.join('{0:02x}'.format(ord(x)) for x in value.asOctets())
+    return value.prettyPrint()
+
+
+def parse_trap(packet, peer):
+    """Parse an SNMPv1 or SNMPv2c trap into varbinds
+
+    The result is keyed like the data snmptrapd would provide to
+    decode_alert, including the address of the agent.
+
+    :param packet: The UDP payload of the trap
+    :param peer: The address the packet was received from
+    :returns: dict of varbinds, or None if the packet is not a trap
+    """
+    msgver = int(snmpapi.decodeMessageVersion(packet))
+    pmod = snmpapi.protoModules[msgver]
+    message, _ = berdecoder.decode(packet, asn1Spec=pmod.Message())
+    pdu = pmod.apiMessage.getPDU(message)
+    varbinds = {}
+    if msgver == snmpapi.protoVersion1:
+        if not pdu.isSameTypeWith(pmod.TrapPDU()):
+            return None
+        varbinds['enterprise'] = '.' + \
+            pmod.apiTrapPDU.getEnterprise(pdu).prettyPrint()
+        varbinds['specifictrap'] = int(pmod.apiTrapPDU.getSpecificTrap(pdu))
+        varbinds[_snmptrapaddress] = \
+            pmod.apiTrapPDU.getAgentAddr(pdu).prettyPrint()
+        pduvarbinds = pmod.apiTrapPDU.getVarBinds(pdu)
+    else:
+        if not pdu.isSameTypeWith(pmod.SNMPv2TrapPDU()):
+            return None
+        pduvarbinds = pmod.apiPDU.getVarBinds(pdu)
+    for oid, value in pduvarbinds:
+        varbinds['.' + oid.prettyPrint()] = _format_value(value)
+    if _snmptrapoid in varbinds and not varbinds[_snmptrapoid].startswith('.'):
+        varbinds[_snmptrapoid] = '.' + varbinds[_snmptrapoid]
+    if _snmptrapaddress not in varbinds:
+        peeraddr = peer[0]
+        if peeraddr.startswith('::ffff:') and '.' in peeraddr:
+            peeraddr = peeraddr[7:]
+        varbinds[_snmptrapaddress] = peeraddr
+    return varbinds
+
+
+def _queue_trap(packet, peer):
+    global _numpending
+    trapcounters['received'] += 1
+    try:
+        varbinds = parse_trap(packet, peer)
+    except Exception:
+        varbinds = None
+    if varbinds is None:
+        trapcounters['dropped'] += 1
+        return
+    node = lookuptools.node_by_manager(varbinds[_snmptrapaddress])
+    if node is None or _numpending >= _get_trap_option('maxpending', 16384):
+        trapcounters['dropped'] += 1
+        return
+    # identical traps in a burst only differ by uptime, decode them once
+    trapkey = tuple(sorted(
+        (k, v) for k, v in varbinds.items() if k != _sysuptime))
+    nodetraps = _pendingtraps.setdefault(node, collections.OrderedDict())
+    if trapkey in nodetraps:
+        trapcounters['coalesced'] += 1
+        return
+    nodetraps[trapkey] = varbinds
+    _numpending += 1
+    if _trapwaiting is not None and not _trapwaiting.ready():
+        _trapwaiting.send()
+
+
+def get_trap_stats():
+    """Report on traps taken in by the trap receiver
+
+    :returns: dict with counts of traps received, decoded, dropped and
+              coalesced into an identical pending trap, along with the
+              number awaiting decode
+    """
+    stats = dict(trapcounters)
+    stats['pending'] = _numpending
+    return stats
+
+
+def _get_trap_option(option, default):
+    value = conf.get_int_option('alerts', option)
+    if value is None:
+        return default
+    return value
+
+
+def _decode_batch(batch, cfm):
+    noderange = ','.join(sorted(batch))
+    decoded = set([])
+    try:
+        for rsp in confluent.core.handle_path(
+                '/noderange/{0}/events/hardware/decode'.format(noderange),
+                'update', cfm, batch, autostrip=False):
+            if isinstance(rsp, msg.EventCollection):
+                for node in rsp.kvpairs:
+                    decoded.add(node)
+                    log.log({'node': node,
+                             'alert': rsp.kvpairs[node]['events']})
+    except Exception:
+        log.logtrace()
+    trapcounters['decoded'] += len(decoded)
+    trapcounters['dropped'] += len(batch) - len(decoded)
+
+
+def _dispatch_traps():
+    global _numpending
+    global _trapwaiting
+    cfm = configmanager.ConfigManager(None)
+    while True:
+        if not _pendingtraps:
+            _trapwaiting = eventlet.event.Event()
+            _trapwaiting.wait()
+            _trapwaiting = None
+        # let a burst accumulate before decoding
+        eventlet.sleep(_get_trap_option('batchdelay', 500) / 1000.0)
+        pending = dict(_pendingtraps)
+        _pendingtraps.clear()
+        batchsize = _get_trap_option('batchsize', 256)
+        while pending:
+            batch = {}
+            for node in list(pending):
+                if len(batch) >= batchsize:
+                    break
+                batch[node] = pending[node].popitem(last=False)[1]
+                if not pending[node]:
+                    del pending[node]
+            _numpending -= len(batch)
+            _decode_batch(batch, cfm)
+
+
+def _receive_traps(sock):
+    while True:
+        packet, peer = sock.recvfrom(65535)
+        try:
+            _queue_trap(packet, peer)
+        except Exception:
+            log.logtrace()
+
+
+def start_trap_receiver():
+    port = conf.get_int_option('alerts', 'trapport')
+    if not port:
+        return
+    bindhost = conf.get_option('alerts', 'trapbindhost') or '::'
+    try:
+        family, _, _, _, sockaddr = socket.getaddrinfo(
+            bindhost, port, 0, socket.SOCK_DGRAM)[0]
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16777216)
+        sock.bind(sockaddr)
+    except Exception:
+        # run without trap receipt rather than keep the server from starting
+        log.logtrace()
+        return
+    eventlet.spawn_n(_receive_traps, sock)
+    eventlet.spawn_n(_dispatch_traps)
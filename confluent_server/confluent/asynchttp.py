@@ -115,6 +115,10 @@ class AsyncSession(object):
     def run_handler(self, handler, requestid):
         try:
             for rsp in handler:
+                if self.responses is None:
+                    # session is gone, stop pulling on long running
+                    # handlers such as followed sensor history
+                    return
                 self.add(requestid, rsp)
             self.add(requestid, messages.AsyncCompletion())
         except Exception as e:
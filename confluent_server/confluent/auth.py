@@ -18,14 +18,23 @@
 # authentication scheme caches passphrase values to help HTTP Basic auth
 # the PBKDF2 transform is skipped unless a user has been idle for sufficient
 # time
+# bearer tokens are signed with a key private to this process, carry their
+# expiry, and are checked without touching the user database, so a client
+# holding one skips both passphrase checks and per request user lookup
 
+import base64
+import confluent.config.conf as conf
 import confluent.config.configmanager as configmanager
+import copy
 import eventlet
+import eventlet.event
+import eventlet.semaphore
 import eventlet.tpool
 import Cryptodome.Protocol.KDF as KDF
 import hashlib
 import hmac
 import multiprocessing
+import os
 try:
     import PAM
 except ImportError:
@@ -37,7 +46,30 @@ _passcache = {}
 _passchecking = {}
 
 authworkers = None
-authcleaner = None
+_kdfslots = None
+_kdfpending = 0
+
+_tokenkey = os.urandom(32)
+# (user, tenant) -> generation, bumped to invalidate all tokens of a user
+_tokengenerations = {}
+# (user, tenant) -> result of authorize for holders of valid tokens
+_tokenauth = {}
+# nonce -> expiry of tokens revoked individually
+_revokedtokens = {}
+
+authstats = {
+    'checks': 0,
+    'failures': 0,
+    'cachehits': 0,
+    'kdfchecks': 0,
+    'kdfrejected': 0,
+    'lastkdftime': 0.0,
+    'maxkdftime': 0.0,
+    'totalkdftime': 0.0,
+    'maxkdfwait': 0.0,
+    'lastauthtime': 0.0,
+    'maxauthtime': 0.0,
+}
 
 
 class Credentials(object):
@@ -143,6 +175,21 @@ def check_user_passphrase(name, passphrase, element=None, tenant=False):
     :param tenant: Optional explicit indication of tenant (defaults to
                    embedded in name)
     """
+    start = time.time()
+    authstats['checks'] += 1
+    try:
+        result = _check_user_passphrase(name, passphrase, element, tenant)
+    finally:
+        elapsed = time.time() - start
+        authstats['lastauthtime'] = elapsed
+        if elapsed > authstats['maxauthtime']:
+            authstats['maxauthtime'] = elapsed
+    if result is None:
+        authstats['failures'] += 1
+    return result
+
+
+def _check_user_passphrase(name, passphrase, element, tenant):
     # The reason why tenant is 'False' instead of 'None':
     # None means explicitly not a tenant.  False means check
     # the username for signs of being a tenant
@@ -154,9 +201,8 @@ def check_user_passphrase(name, passphrase, element=None, tenant=False):
     while (user, tenant) in _passchecking:
         # Want to serialize passphrase checking activity
         # by a user, which might be malicious
-        # would normally make an event and wait
-        # but here there's no need for that
-        eventlet.sleep(0.5)
+        # the check in progress wakes us when it is done
+        _passchecking[(user, tenant)].wait()
     credobj = Credentials(user, passphrase)
     cfm = configmanager.ConfigManager(tenant, username=user)
     ucfg = cfm.get_user(user)
@@ -165,6 +211,7 @@ def check_user_passphrase(name, passphrase, element=None, tenant=False):
         return None
     if (user, tenant) in _passcache:
         if hashlib.sha256(passphrase).digest() == _passcache[(user, tenant)]:
+            authstats['cachehits'] += 1
             return authorize(user, element, tenant)
         else:
             # In case of someone trying to guess,
@@ -173,31 +220,23 @@ def check_user_passphrase(name, passphrase, element=None, tenant=False):
             del _passcache[(user, tenant)]
             return None
     if 'cryptpass' in ucfg:
-        _passchecking[(user, tenant)] = True
-        # TODO(jbjohnso): WORKERPOOL
-        # PBKDF2 is, by design, cpu intensive
-        # throw it at the worker pool when implemented
-        # maybe a distinct worker pool, wondering about starving out non-auth stuff
+        checking = _passchecking[(user, tenant)] = eventlet.event.Event()
+        # PBKDF2 is, by design, cpu intensive, it is done by a pool of
+        # worker processes so as not to starve out non-auth activity
         salt, crypt = ucfg['cryptpass']
-        # execute inside tpool to get greenthreads to give it a special thread
-        # world
-        # TODO(jbjohnso): util function to generically offload a call
-        # such a beast could be passed into pyghmi as a way for pyghmi to
-        # magically get offload of the crypto functions without having
-        # to explicitly get into the eventlet tpool game
-        global authworkers
-        global authcleaner
-        if authworkers is None:
-            authworkers = multiprocessing.Pool(processes=1)
-        else:
-            authcleaner.cancel()
-        authcleaner = eventlet.spawn_after(30, _clean_authworkers)
-        crypted = eventlet.tpool.execute(_do_pbkdf, passphrase, salt)
-        del _passchecking[(user, tenant)]
+        try:
+            crypted = _do_pbkdf(passphrase, salt)
+        finally:
+            del _passchecking[(user, tenant)]
+            checking.send()
         eventlet.sleep(
             0.05)  # either way, we want to stall so that client can't
         # determine failure because there is a delay, valid response will
         # delay as well
+        if crypted is None:
+            # too many checks already waiting on the workers, rather than
+            # growing the backlog without bound, fail this attempt
+            return None
         if crypt == crypted:
             _passcache[(user, tenant)] = hashlib.sha256(passphrase).digest()
             return authorize(user, element, tenant)
@@ -222,16 +261,187 @@ def _apply_pbkdf(passphrase, salt):
                       lambda p, s: hmac.new(p, s, hashlib.sha256).digest())
 
 
-def _clean_authworkers():
+def _get_auth_option(option, default):
+    value = conf.get_int_option('auth', option)
+    if value is None:
+        return default
+    return value
+
+
+def _get_authworkers():
     global authworkers
-    global authcleaner
-    authworkers = None
-    authcleaner = None
+    global _kdfslots
+    if authworkers is None:
+        workers = _get_auth_option('kdf_workers', 0)
+        if workers <= 0:
+            workers = min(multiprocessing.cpu_count(), 4)
+        # the pool is kept for the life of the process, a burst of logins
+        # should not also pay for starting processes
+        authworkers = multiprocessing.Pool(processes=workers)
+        _kdfslots = eventlet.semaphore.Semaphore(workers)
+    return authworkers
 
 
 def _do_pbkdf(passphrase, salt):
-    # we must get it over to the authworkers pool or else get blocked in
-    # compute.  However, we do want to wait for result, so we have
-    # one of the exceedingly rare sort of circumstances where 'apply'
-    # actually makes sense
-    return authworkers.apply(_apply_pbkdf, [passphrase, salt])
\ No newline at end of file
+    """Have a worker process compute the PBKDF2 of a passphrase
+
+    Checks beyond the number of workers wait their turn, up to the [auth]
+    kdf_queue option (256 by default) waiting, past which None is
+    returned rather than queueing more.
+    """
+    global _kdfpending
+    workers = _get_authworkers()
+    if _kdfpending >= _get_auth_option('kdf_queue', 256):
+        authstats['kdfrejected'] += 1
+        return None
+    _kdfpending += 1
+    queued = time.time()
+    try:
+        with _kdfslots:
+            start = time.time()
+            # we must get it over to the authworkers pool or else get
+            # blocked in compute.  However, we do want to wait for result,
+            # so we have one of the exceedingly rare sort of circumstances
+            # where 'apply' actually makes sense, done in a tpool thread so
+            # only this greenthread waits on it
+            crypted = eventlet.tpool.execute(
+                workers.apply, _apply_pbkdf, [passphrase, salt])
+    finally:
+        _kdfpending -= 1
+    done = time.time()
+    authstats['kdfchecks'] += 1
+    authstats['lastkdftime'] = done - start
+    authstats['totalkdftime'] += done - start
+    if done - start > authstats['maxkdftime']:
+        authstats['maxkdftime'] = done - start
+    if start - queued > authstats['maxkdfwait']:
+        authstats['maxkdfwait'] = start - queued
+    return crypted
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign_token(payload):
+    return hmac.new(_tokenkey, payload, hashlib.sha256).digest()
+
+
+def issue_token(name, tenant=False, lifetime=None):
+    """Issue a bearer token for an already authenticated user
+
+    The token is good until it expires, the user is changed or deleted, or
+    it is revoked.  It is only recognized by the collective member that
+    issued it, and not after that member restarts.
+
+    :param name: The authenticated user name
+    :param tenant: Optional explicit tenant (defaults to embedded in name)
+    :param lifetime: Requested lifetime in seconds, no more than the [auth]
+                     token_lifetime option (3600 by default)
+    :returns: tuple of the token and the time it expires
+    """
+    user, tenant = _get_usertenant(name, tenant)
+    maxlifetime = _get_auth_option('token_lifetime', 3600)
+    if not lifetime or lifetime < 0 or lifetime > maxlifetime:
+        lifetime = maxlifetime
+    expiry = int(time.time() + lifetime)
+    generation = _tokengenerations.get((user, tenant), 0)
+    payload = '\x00'.join((user, tenant or '', str(expiry), str(generation),
+                           _b64encode(os.urandom(12))))
+    return (_b64encode(payload) + '.' + _b64encode(_sign_token(payload)),
+            expiry)
+
+
+def _parse_token(token):
+    try:
+        payload, signature = token.split('.')
+        payload = _b64decode(payload)
+        signature = _b64decode(signature)
+    except (ValueError, TypeError):
+        return None
+    if not hmac.compare_digest(_sign_token(payload), signature):
+        return None
+    try:
+        user, tenant, expiry, generation, nonce = payload.split('\x00')
+        expiry = int(expiry)
+        generation = int(generation)
+    except ValueError:
+        return None
+    return user, tenant or None, expiry, generation, nonce
+
+
+def authorize_token(token, element=None):
+    """Determine whether a bearer token is valid
+
+    :param token: A token as returned by issue_token
+    :param element: The path being examined
+
+    returns None if the token is not valid, otherwise the same as authorize
+    """
+    parsed = _parse_token(token)
+    if parsed is None:
+        return None
+    user, tenant, expiry, generation, nonce = parsed
+    if (expiry < time.time() or nonce in _revokedtokens or
+            generation != _tokengenerations.get((user, tenant), 0)):
+        return None
+    authdata = _tokenauth.get((user, tenant), None)
+    if authdata is None:
+        authdata = authorize(user, element, tenant)
+        if authdata is None:
+            return None
+        _tokenauth[(user, tenant)] = authdata
+    userobj, manager, user, tenant, skipuserobj = authdata
+    # callers may alter the manager to suit their request
+    return userobj, copy.copy(manager), user, tenant, skipuserobj
+
+
+def revoke_token(token):
+    """Revoke a single bearer token
+
+    :param token: A token as returned by issue_token
+    """
+    parsed = _parse_token(token)
+    if parsed is None:
+        return
+    now = time.time()
+    for nonce in list(_revokedtokens):
+        if _revokedtokens[nonce] < now:
+            del _revokedtokens[nonce]
+    if parsed[2] >= now:
+        _revokedtokens[parsed[4]] = parsed[2]
+
+
+def revoke_user_tokens(name, tenant=False):
+    """Revoke every bearer token issued to a user
+
+    :param name: The user name
+    :param tenant: Optional explicit tenant (defaults to embedded in name)
+    """
+    user, tenant = _get_usertenant(name, tenant)
+    _tokengenerations[(user, tenant)] = _tokengenerations.get(
+        (user, tenant), 0) + 1
+    _tokenauth.pop((user, tenant), None)
+
+
+def _user_changed(tenant, name):
+    revoke_user_tokens(name, tenant)
+
+
+configmanager.hook_user_changes(_user_changed)
+
+
+def get_auth_stats():
+    """Report on passphrase checking activity
+
+    :returns: dict with counts of checks, failures, cache hits and checks
+              done by the workers, along with timings in seconds of the
+              checks and of the worker computation
+    """
+    stats = dict(authstats)
+    stats['kdfpending'] = _kdfpending
+    return stats
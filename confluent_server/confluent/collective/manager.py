@@ -27,6 +27,7 @@ import eventlet.green.ssl as ssl
 import eventlet.green.threading as threading
 import greenlet
 import random
+import struct
 try:
     import OpenSSL.crypto as crypto
 except ImportError:
@@ -74,9 +75,10 @@ def connect_to_leader(cert=None, name=None, leader=None):
             tlvdata.recv(remote)  # authpassed... 0..
             if name is None:
                 name = get_myname()
-            tlvdata.send(remote, {'collective': {'operation': 'connect',
-                                                 'name': name,
-                                                 'txcount': cfm._txcount}})
+            tlvdata.send(remote, {'collective': {
+                'operation': 'connect', 'name': name,
+                'txcount': cfm._txcount,
+                'txhash': base64.b64encode(cfm._txhash), 'batching': True}})
             keydata = tlvdata.recv(remote)
             if not keydata:
                 return False
@@ -118,40 +120,120 @@ def connect_to_leader(cert=None, name=None, leader=None):
             colldata = tlvdata.recv(remote)
             globaldata = tlvdata.recv(remote)
             dbi = tlvdata.recv(remote)
-            dbsize = dbi['dbsize']
-            dbjson = ''
-            while (len(dbjson) < dbsize):
-                ndata = remote.recv(dbsize - len(dbjson))
-                if not ndata:
-                    try:
-                        remote.close()
-                    except Exception:
-                        pass
-                    raise Exception("Error doing initial DB transfer")
-                dbjson += ndata
-            cfm.clear_configuration()
-            try:
-                cfm._restore_keys(keydata, None, sync=False)
-                for c in colldata:
-                    cfm._true_add_collective_member(c, colldata[c]['address'],
-                                                    colldata[c]['fingerprint'],
-                                                    sync=False)
-                for globvar in globaldata:
-                    cfm.set_global(globvar, globaldata[globvar], False)
-                cfm._txcount = dbi.get('txcount', 0)
-                cfm.ConfigManager(tenant=None)._load_from_json(dbjson,
-                                                               sync=False)
-                cfm.commit_clear()
-            except Exception:
-                cfm.stop_following()
-                cfm.rollback_clear()
-                raise
+            if 'transactions' in dbi:
+                _catch_up(remote, keydata, colldata, globaldata, dbi)
+            else:
+                _receive_configuration(remote, keydata, colldata, globaldata,
+                                       dbi)
             currentleader = leader
         #spawn this as a thread...
         follower = eventlet.spawn(follow_leader, remote)
     return True
 
 
+def _restore_collective_state(keydata, colldata, globaldata):
+    cfm._restore_keys(keydata, None, sync=False)
+    for c in colldata:
+        cfm._true_add_collective_member(c, colldata[c]['address'],
+                                        colldata[c]['fingerprint'],
+                                        sync=False)
+    for globvar in globaldata:
+        cfm.set_global(globvar, globaldata[globvar], False)
+
+
+def _recv_transaction(remote):
+    sz = struct.unpack('!Q', tlvdata.recvall(remote, 8))[0]
+    return tlvdata.recvall(remote, sz)
+
+
+def _catch_up(remote, keydata, colldata, globaldata, dbi):
+    # Our history is a point in the history of the leader, only the
+    # transactions since are needed
+    log.log({'info': 'Applying {0} transactions from leader'.format(
+        dbi['transactions']), 'subsystem': 'collective'})
+    cfm.stop_leading()
+    _restore_collective_state(keydata, colldata, globaldata)
+    cfm._replay_transactions(
+        _recv_transaction(remote) for _ in range(dbi['transactions']))
+    if (cfm._txcount != dbi['txcount'] or
+            cfm._txhash != base64.b64decode(dbi['txhash'])):
+        # do not claim to share a history that we evidently do not, the
+        # next attempt will then get the full configuration
+        cfm._reset_transaction_log()
+        raise Exception('Transactions from leader did not match its state')
+    cfm.ConfigManager._bg_sync_to_file()
+
+
+def _recv_records(remote, count):
+    for _ in range(count):
+        record = tlvdata.recv(remote)
+        if not record:
+            raise Exception("Error doing initial DB transfer")
+        yield record['area'], record['name'], record['data']
+
+
+def _receive_configuration(remote, keydata, colldata, globaldata, dbi):
+    if 'dbsize' in dbi:
+        # a leader that sends the configuration as one document
+        dbsize = dbi['dbsize']
+        dbjson = ''
+        while (len(dbjson) < dbsize):
+            ndata = remote.recv(dbsize - len(dbjson))
+            if not ndata:
+                try:
+                    remote.close()
+                except Exception:
+                    pass
+                raise Exception("Error doing initial DB transfer")
+            dbjson += ndata
+    cfm.clear_configuration()
+    try:
+        _restore_collective_state(keydata, colldata, globaldata)
+        cfm._txcount = dbi.get('txcount', 0)
+        if 'dbsize' in dbi:
+            cfm.ConfigManager(tenant=None)._load_from_json(dbjson, sync=False)
+        else:
+            # taken a record at a time as it arrives, rather than waiting on
+            # the whole before starting on it
+            cfm.ConfigManager(tenant=None)._load_from_records(
+                _recv_records(remote, dbi['records']), sync=False)
+            cfm._adopt_transaction_state(dbi['txcount'],
+                                         base64.b64decode(dbi['txhash']))
+        cfm.commit_clear()
+    except Exception:
+        cfm.stop_following()
+        cfm.rollback_clear()
+        raise
+
+
+def _send_configuration(connection, request):
+    # transactions still waiting to go out would otherwise reach this
+    # follower both here and again once it is following
+    cfm._flush_transactions()
+    if 'txhash' not in request:
+        # a follower that expects the configuration as one document
+        cfgdata = cfm.ConfigManager(None)._dump_to_json()
+        tlvdata.send(connection, {'txcount': cfm._txcount,
+                                  'dbsize': len(cfgdata)})
+        connection.sendall(cfgdata)
+        return
+    transactions = cfm.get_transactions_since(
+        request['txcount'], base64.b64decode(request['txhash']))
+    dbi = {'txcount': cfm._txcount, 'txhash': base64.b64encode(cfm._txhash)}
+    if transactions is not None:
+        dbi['transactions'] = len(transactions)
+        tlvdata.send(connection, dbi)
+        for payload in transactions:
+            cfm._push_rpc(connection, payload)
+        return
+    records = cfm.ConfigManager(None)._dump_to_records()
+    dbi['records'] = len(records)
+    tlvdata.send(connection, dbi)
+    for confarea, element, data in records:
+        tlvdata.send(connection, {'area': confarea, 'name': element,
+                                  'data': data})
+
+
 def follow_leader(remote):
     global currentleader
     cleanexit = False
@@ -444,13 +526,11 @@ def handle_connection(connection, cert, request, local=False):
             tlvdata.send(connection, cfm._dump_keys(None, False))
             tlvdata.send(connection, cfm._cfgstore['collective'])
             tlvdata.send(connection, cfm.get_globals())
-            cfgdata = cfm.ConfigManager(None)._dump_to_json()
-            tlvdata.send(connection, {'txcount': cfm._txcount,
-                                      'dbsize': len(cfgdata)})
-            connection.sendall(cfgdata)
+            _send_configuration(connection, request)
         #tlvdata.send(connection, {'tenants': 0}) # skip the tenants for now,
         # so far unused anyway
-        if not cfm.relay_slaved_requests(drone, connection):
+        if not cfm.relay_slaved_requests(drone, connection,
+                                         request.get('batching', False)):
             if not retrythread:  # start a recovery if everyone else seems
                 # to have disappeared
                 retrythread = eventlet.spawn_after(30 + random.random(),
@@ -49,6 +49,7 @@ from Cryptodome.Hash import SHA256
 import anydbm as dbm
 import ast
 import base64
+import collections
 import confluent.config.attributes as allattributes
 import confluent.config.conf as conf
 import confluent.log
@@ -64,6 +65,7 @@ import eventlet.event as event
 import eventlet.green.select as select
 import eventlet.green.threading as gthread
 import fnmatch
+import itertools
 import json
 import operator
 import os
@@ -74,6 +76,7 @@ import struct
 import sys
 import threading
 import traceback
+import zlib
 
 
 _masterkey = None
@@ -90,7 +93,26 @@ statelessmode = False
 _cfgstore = None
 _pendingchangesets = {}
 _txcount = 0
+# Replicated transactions form a hash chain, so that a member can show it
+# holds the same history as another, rather than merely the same count.
+# The most recent ones are kept to bring a returning follower up to date.
+_txhash = os.urandom(32)
+_txhashshared = True
+_txlog = collections.deque()
+_txlogbytes = 0
+_replaying = False
+# transactions waiting to go to followers, sent together after a short delay
+_pendingtx = []
+_pendingtxbytes = 0
+_txflusher = None
+_txflushlock = gthread.RLock()
+_batchstreams = set()
+_replaylock = gthread.RLock()
+_syncheld = False
+_syncwanted = None
 _hasquorum = True
+_nodecollgen = 0
+_userwatchers = []
 
 _attraliases = {
     'bmc': 'hardwaremanagement.manager',
@@ -162,6 +184,19 @@ def _format_key(key, password=None):
         return {"unencryptedvalue": key}
 
 
+def _flush_notifications():
+    ConfigManager._notificationflusher = None
+    pending = ConfigManager._pendingnotifications
+    ConfigManager._pendingnotifications = {}
+    for notifierid in pending:
+        if notifierid not in ConfigManager._notifierids:
+            # unsubscribed since the change
+            continue
+        watcher = pending[notifierid]
+        eventlet.spawn_n(_do_notifier, watcher['configmanager'], watcher,
+                         watcher['callback'])
+
+
 def _do_notifier(cfg, watcher, callback):
     try:
         callback(nodeattribs=watcher['nodeattrs'], configmanager=cfg)
@@ -267,18 +302,223 @@ def exec_on_leader(function, *args):
 
 def exec_on_followers(fnname, *args):
     global _txcount
+    global _pendingtxbytes
+    global _txflusher
     if len(cfgstreams) < (len(_cfgstore['collective']) // 2):
         # the leader counts in addition to registered streams
         raise exc.DegradedCollective()
-    pushes = eventlet.GreenPool()
     _txcount += 1
     payload = cPickle.dumps({'function': fnname, 'args': args,
                              'txcount': _txcount})
-    for res in pushes.starmap(
-            _push_rpc, [(cfgstreams[s], payload) for s in cfgstreams]):
+    _record_transaction(payload)
+    _pendingtx.append(payload)
+    _pendingtxbytes += len(payload)
+    window = _batch_window()
+    if window <= 0 or _pendingtxbytes >= _batch_size():
+        _flush_transactions()
+    elif _txflusher is None:
+        _txflusher = eventlet.spawn_after(window / 1000.0,
+                                          _flush_transactions)
+
+
+def _batch_window():
+    window = conf.get_int_option('collective', 'batch_window')
+    if window is None:
+        return 5
+    return window
+
+
+def _batch_size():
+    return conf.get_int_option('collective', 'batch_size') or 1048576
+
+
+def _compress_batches():
+    compress = conf.get_boolean_option('collective', 'compress_batches')
+    if compress is None:
+        return True
+    return compress
+
+
+def _flush_transactions():
+    """Send the transactions waiting on the batch window to followers
+
+    Followers that accept batches receive all of them in one message,
+    compressed if large and [collective] compress_batches is not 0, others
+    receive them one at a time.  Anything to be sent to a follower that
+    must come after the transactions waits on this first.
+    """
+    global _pendingtx
+    global _pendingtxbytes
+    global _txflusher
+    with _txflushlock:
+        if _txflusher is not None:
+            if _txflusher is not eventlet.getcurrent():
+                _txflusher.cancel()
+            _txflusher = None
+        payloads = _pendingtx
+        if not payloads:
+            return
+        _pendingtx = []
+        _pendingtxbytes = 0
+        batch = None
+        pushes = eventlet.GreenPool()
+        streams = []
+        for name in list(cfgstreams):
+            if name not in cfgstreams:
+                continue
+            if name not in _batchstreams:
+                streams.append((cfgstreams[name], payloads))
+                continue
+            if batch is None:
+                batch = _pack_batch(payloads)
+            streams.append((cfgstreams[name], (batch,)))
+        for _ in pushes.starmap(_push_transactions, streams):
+            pass
+
+
+def _pack_batch(payloads):
+    payload = cPickle.dumps(payloads, cPickle.HIGHEST_PROTOCOL)
+    if len(payload) > 4096 and _compress_batches():
+        return cPickle.dumps({'transactions': zlib.compress(payload),
+                              'compressed': True})
+    return cPickle.dumps({'transactions': payload})
+
+
+def _unpack_batch(rpc):
+    payload = rpc['transactions']
+    if rpc.get('compressed', False):
+        payload = zlib.decompress(payload)
+    return cPickle.loads(payload)
+
+
+def _push_transactions(stream, payloads):
+    try:
+        for payload in payloads:
+            _push_rpc(stream, payload)
+    except Exception:
+        # a broken follower is noticed and dropped by its relay, do not
+        # let it hold up the others
         pass
 
 
+def _txlog_size():
+    return conf.get_int_option('collective', 'txlog_size') or 33554432
+
+
+def _record_transaction(payload):
+    global _txhash
+    global _txhashshared
+    global _txlogbytes
+    prevhash = _txhash
+    _txhash = SHA256.new(prevhash + payload).digest()
+    _txhashshared = True
+    _txlog.append((_txcount, prevhash, payload))
+    _txlogbytes += len(payload)
+    maxbytes = _txlog_size()
+    while _txlog and _txlogbytes > maxbytes:
+        _txlogbytes -= len(_txlog.popleft()[2])
+
+
+def _reset_transaction_log():
+    # A change was made that followers will not hear of, no history held by
+    # another member may be taken to match ours from here on
+    global _txhash
+    global _txhashshared
+    global _txlogbytes
+    _txhash = os.urandom(32)
+    _txhashshared = False
+    _txlog.clear()
+    _txlogbytes = 0
+
+
+def _adopt_transaction_state(txcount, txhash):
+    global _txcount
+    global _txhash
+    global _txhashshared
+    global _txlogbytes
+    _txcount = txcount
+    _txhash = txhash
+    _txhashshared = True
+    _txlog.clear()
+    _txlogbytes = 0
+
+
+def get_transactions_since(txcount, txhash):
+    """Get the replicated transactions a follower is missing
+
+    The transactions are only offered if the follower history, as given by
+    its transaction count and hash, is a point in the history retained by
+    the [collective] txlog_size option (32MiB by default).
+
+    :param txcount: The transaction count of the follower
+    :param txhash: The transaction hash of the follower
+    :returns: List of transaction payloads, in order, or None if the
+              follower must instead be sent the full configuration
+    """
+    global _txhashshared
+    _txhashshared = True
+    if txcount == _txcount and txhash == _txhash:
+        return []
+    if not _txlog:
+        return None
+    idx = txcount + 1 - _txlog[0][0]
+    if idx < 0 or idx >= len(_txlog) or _txlog[idx][1] != txhash:
+        return None
+    return [entry[2] for entry in itertools.islice(_txlog, idx, None)]
+
+
+def _replay_transactions(payloads):
+    """Apply a series of transactions from the collective leader
+
+    The configuration is written out once all are applied, rather than once
+    for each.
+    """
+    global _syncheld
+    global _syncwanted
+    with _replaylock:
+        _syncheld = True
+        try:
+            for payload in payloads:
+                _replay_transaction(payload)
+        finally:
+            _syncheld = False
+            fullsync = _syncwanted
+            _syncwanted = None
+    if fullsync is not None:
+        ConfigManager._bg_sync_to_file(fullsync)
+
+
+def _replay_transaction(payload, rpc=None):
+    global _txcount
+    global _replaying
+    if rpc is None:
+        rpc = cPickle.loads(payload)
+    if rpc.get('txcount', _txcount + 1) <= _txcount:
+        # already had this one, as part of catching up
+        return rpc
+    if rpc.get('txcount', _txcount + 1) > _txcount + 1:
+        # something committed while the configuration was on its way here
+        # never reached us, stop following so that reconnecting catches up
+        # from the last transaction actually applied
+        raise Exception(
+            'Transactions {0} through {1} from leader were missed'.format(
+                _txcount + 1, rpc['txcount'] - 1))
+    if 'function' in rpc:
+        _replaying = True
+        try:
+            globals()[rpc['function']](*rpc['args'])
+        except Exception as e:
+            print(repr(e))
+        finally:
+            _replaying = False
+    if 'txcount' in rpc:
+        # advanced only once applied, so a sync to disk never records a
+        # count ahead of the data
+        _txcount = rpc['txcount']
+        _record_transaction(payload)
+    return rpc
+
+
 def logException():
     global tracelog
     if tracelog is None:
@@ -436,6 +676,131 @@ def _load_dict_from_dbm(dpath, tdb):
         return
 
 
+# The journal is an append only log of changed configuration keys.  Each
+# record is a small header (payload length and crc32) followed by a pickled
+# (txcount, entries, txhash) tuple, where entries is a list of
+# (tenant, category, key, value, deleted).  A commit costs one sequential
+# append and one fsync; the dbm files are only brought up to date when the
+# journal is compacted.
+_journalhdr = struct.Struct('!II')
+_journaldirty = {}
+_journaltx = None
+
+
+def _journal_compact_size():
+    return conf.get_int_option('config', 'journal_compact_size') or 16777216
+
+
+def _read_journal(jpath):
+    # returns the list of good records and the offset of the end of the last
+    # good record, a torn or corrupt tail is ignored
+    records = []
+    goodoffset = 0
+    try:
+        jfile = open(jpath, 'rb')
+    except IOError:
+        return records, goodoffset
+    with jfile:
+        while True:
+            hdr = jfile.read(_journalhdr.size)
+            if len(hdr) < _journalhdr.size:
+                break
+            plen, crc = _journalhdr.unpack(hdr)
+            payload = jfile.read(plen)
+            if len(payload) < plen:
+                break
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            try:
+                records.append(cPickle.loads(payload))
+            except Exception:
+                break
+            goodoffset = jfile.tell()
+    return records, goodoffset
+
+
+def _replay_journal(rootpath):
+    global _txcount
+    global _txhash
+    jpath = os.path.join(rootpath, 'journal')
+    records, goodoffset = _read_journal(jpath)
+    for record in records:
+        txcount, entries = record[:2]
+        for tenant, category, key, value, deleted in entries:
+            if tenant is None:
+                currdict = _cfgstore.setdefault('main', {})
+            else:
+                currdict = _cfgstore.setdefault('tenant', {}).setdefault(
+                    tenant, {})
+            currdict = currdict.setdefault(category, {})
+            if deleted:
+                currdict.pop(key, None)
+            else:
+                currdict[key] = value
+            _journaldirty.setdefault(tenant, {}).setdefault(
+                category, set()).add(key)
+        _txcount = txcount
+        if len(record) > 2:
+            _txhash = record[2]
+    if os.path.exists(jpath) and os.path.getsize(jpath) > goodoffset:
+        # drop a torn tail so that later appends are not hidden behind it
+        with open(jpath, 'r+b') as jfile:
+            jfile.truncate(goodoffset)
+
+
+def _append_journal(cfgdir, txcount, entries, txhash):
+    payload = cPickle.dumps((txcount, entries, txhash),
+                            cPickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(cfgdir, 'journal'), 'ab') as jfile:
+        os.fchmod(jfile.fileno(), 384)  # 0600
+        jfile.write(_journalhdr.pack(
+            len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        jfile.flush()
+        os.fsync(jfile.fileno())
+        return jfile.tell()
+
+
+def _truncate_journal(cfgdir):
+    global _journaltx
+    _journaldirty.clear()
+    with open(os.path.join(cfgdir, 'transactioncount'), 'w') as f:
+        f.write(struct.pack('!Q', _txcount) + _txhash)
+    _journaltx = _txcount
+    try:
+        with open(os.path.join(cfgdir, 'journal'), 'r+b') as jfile:
+            jfile.truncate(0)
+            os.fsync(jfile.fileno())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _compact_journal(cfgdir):
+    # fold every key touched since the last compaction into the dbm snapshot
+    # using current values, then the journal may be discarded
+    for tenant in _journaldirty:
+        dkdict = _journaldirty[tenant]
+        if tenant is None:
+            pathname = cfgdir
+            currdict = _cfgstore['main']
+        else:
+            pathname = os.path.join(cfgdir, 'tenants', tenant)
+            currdict = _cfgstore['tenant'][tenant]
+        for category in dkdict:
+            _mkpath(pathname)
+            dbf = dbm.open(os.path.join(pathname, category), 'c', 384)  # 0600
+            try:
+                for ck in dkdict[category]:
+                    if ck not in currdict.get(category, {}):
+                        if ck in dbf:
+                            del dbf[ck]
+                    else:
+                        dbf[ck] = cPickle.dumps(currdict[category][ck])
+            finally:
+                dbf.close()
+    _truncate_journal(cfgdir)
+
+
 def is_tenant(tenant):
     try:
         return tenant in _cfgstore['tenant']
@@ -488,7 +853,7 @@ def set_global(globalname, value, sync=True):
         ConfigManager._bg_sync_to_file()
 
 cfgstreams = {}
-def relay_slaved_requests(name, listener):
+def relay_slaved_requests(name, listener, batching=False):
     global cfgleader
     global _hasquorum
     pushes = eventlet.GreenPool()
@@ -504,6 +869,10 @@ def relay_slaved_requests(name, listener):
                     pass
                 del cfgstreams[name]
             cfgstreams[name] = listener
+            if batching:
+                _batchstreams.add(name)
+            else:
+                _batchstreams.discard(name)
             lh = StreamHandler(listener)
             _hasquorum = len(cfgstreams) >= (
                     len(_cfgstore['collective']) // 2)
@@ -533,6 +902,9 @@ def relay_slaved_requests(name, listener):
                     except Exception as e:
                         exc = e
                     if 'xid' in rpc:
+                        # the follower must have the change before word
+                        # that it is done
+                        _flush_transactions()
                         _push_rpc(listener, cPickle.dumps({'xid': rpc['xid'],
                                                            'exc': exc}))
                 try:
@@ -615,17 +987,21 @@ def stop_leading():
 
 _oldcfgstore = None
 _oldtxcount = 0
+_oldtxhash = None
 
 
 def rollback_clear():
     global _cfgstore
     global _txcount
+    global _txhash
     global _oldcfgstore
     global _oldtxcount
     _txcount = _oldtxcount
+    _txhash = _oldtxhash
     _cfgstore = _oldcfgstore
     _oldtxcount = 0
     _oldcfgstore = None
+    _bump_nodecollection_generation()
     ConfigManager.wait_for_sync(True)
 
 
@@ -634,33 +1010,53 @@ def clear_configuration():
     global _txcount
     global _oldcfgstore
     global _oldtxcount
+    global _oldtxhash
     stop_leading()
     stop_following()
     _oldcfgstore = _cfgstore
     _oldtxcount = _txcount
+    _oldtxhash = _txhash
     _cfgstore = {}
     _txcount = 0
+    _reset_transaction_log()
+    _bump_nodecollection_generation()
 
 def commit_clear():
     global _oldtxcount
     global _oldcfgstore
+    oldcfgstore = _oldcfgstore
     _oldcfgstore = None
     _oldtxcount = 0
     with _synclock:
-        todelete = ('transactioncount', 'globals', 'collective') + _config_areas
+        todelete = ('transactioncount', 'journal', 'globals',
+                    'collective') + _config_areas
         for cfg in todelete:
             try:
                 os.remove(os.path.join(ConfigManager._cfgdir, cfg))
             except OSError as oe:
                 pass
+        _journaldirty.clear()
     ConfigManager.wait_for_sync(True)
     ConfigManager._bg_sync_to_file()
+    # users of the new configuration were announced as they were created,
+    # but those that did not survive the replacement must be told of too
+    _notify_all_users(oldcfgstore)
+
+
+def _notify_all_users(cfgstore):
+    if not cfgstore:
+        return
+    for name in list(cfgstore.get('main', {}).get('users', {})):
+        _notify_user_change(None, name)
+    tenants = cfgstore.get('tenant', {})
+    for tenant in list(tenants):
+        for name in list(tenants[tenant].get('users', {})):
+            _notify_user_change(tenant, name)
 
 cfgleader = None
 
 
 def follow_channel(channel):
-    global _txcount
     global _hasquorum
     try:
         stop_leading()
@@ -676,14 +1072,13 @@ def follow_channel(channel):
                     if not nrpc:
                         raise Exception('Truncated message error')
                     rpc += nrpc
-                rpc = cPickle.loads(rpc)
-                if 'txcount' in rpc:
-                    _txcount = rpc['txcount']
-                if 'function' in rpc:
-                    try:
-                        globals()[rpc['function']](*rpc['args'])
-                    except Exception as e:
-                        print(repr(e))
+                payload = rpc
+                rpc = cPickle.loads(payload)
+                if 'transactions' in rpc:
+                    _replay_transactions(_unpack_batch(rpc))
+                else:
+                    with _replaylock:
+                        _replay_transaction(payload, rpc)
                 if 'xid' in rpc and rpc['xid']:
                     if rpc.get('exc', None):
                         _pendingchangesets[rpc['xid']].send_exception(rpc['exc'])
@@ -769,9 +1164,28 @@ def get_collective_member_by_address(address):
             return currdrone
 
 
+def _bump_nodecollection_generation():
+    global _nodecollgen
+    _nodecollgen += 1
+
+
+def get_nodecollection_generation():
+    """Get a counter that changes when nodes or groups change
+
+    The counter is advanced whenever a node is added or deleted or
+    anything about a group changes, allowing callers to cache data derived
+    from the node collection, such as noderange evaluation.
+    """
+    return _nodecollgen
+
+
 def _mark_dirtykey(category, key, tenant=None):
     if type(key) in (str, unicode):
         key = key.encode('utf-8')
+    if category == 'nodegroups':
+        _bump_nodecollection_generation()
+    if _txhashshared and not (cfgstreams or _replaying):
+        _reset_transaction_log()
     with _dirtylock:
         if 'dirtykeys' not in _cfgstore:
             _cfgstore['dirtykeys'] = {}
@@ -794,6 +1208,13 @@ def _generate_new_id():
     return uid
 
 
+# expressions and fields of expressions are parsed once, evaluated by the
+# resulting functions for as many nodes as they are used by
+_compiledexpressions = {}
+_compiledfields = {}
+_maxcompiled = 4096
+
+
 class _ExpressionFormat(string.Formatter):
     # This class is used to extract the literal value from an expression
     # in the db
@@ -819,13 +1240,59 @@ class _ExpressionFormat(string.Formatter):
         self._nodename = nodename
         self._numbers = None
 
-    def get_field(self, field_name, args, kwargs):
-        parsed = ast.parse(field_name)
-        return self._handle_ast_node(parsed.body[0].value), field_name
+    def format(self, format_string, *args, **kwargs):
+        if args or kwargs:
+            return string.Formatter.format(self, format_string, *args,
+                                           **kwargs)
+        template = _compiledexpressions.get(format_string, None)
+        if template is None:
+            template = self._compile_expression(format_string)
+        if not template:
+            # nested fields in a format specification, not worth compiling
+            return string.Formatter.format(self, format_string)
+        result = []
+        for literal, field, conversion, format_spec in template:
+            if literal:
+                result.append(literal)
+            if field is not None:
+                obj = self.convert_field(field(self), conversion)
+                result.append(self.format_field(obj, format_spec))
+        return ''.join(result)
+
+    def _compile_expression(self, format_string):
+        template = []
+        for literal, field_name, format_spec, conversion in self.parse(
+                format_string):
+            field = None
+            if field_name is not None:
+                if '{' in format_spec:
+                    template = ()
+                    break
+                field = self._compile_field(field_name)
+            template.append((literal, field, conversion, format_spec))
+        if len(_compiledexpressions) >= _maxcompiled:
+            _compiledexpressions.clear()
+        _compiledexpressions[format_string] = template
+        return template
 
-    def _handle_ast_node(self, node):
+    def get_field(self, field_name, args, kwargs):
+        return self._compile_field(field_name)(self), field_name
+
+    def _compile_field(self, field_name):
+        field = _compiledfields.get(field_name, None)
+        if field is None:
+            parsed = ast.parse(field_name)
+            field = self._compile_ast_node(parsed.body[0].value)
+            if len(_compiledfields) >= _maxcompiled:
+                _compiledfields.clear()
+            _compiledfields[field_name] = field
+        return field
+
+    def _compile_ast_node(self, node):
+        # returns a function of a formatter giving the value of node
         if isinstance(node, ast.Num):
-            return node.n
+            num = node.n
+            return lambda fmt: num
         elif isinstance(node, ast.Attribute):
             #ok, we have something with a dot
             left = node
@@ -840,42 +1307,61 @@ class _ExpressionFormat(string.Formatter):
                         _get_valid_attrname(key) not in allattributes.node):
                 raise ValueError(
                     '{0} is not a valid attribute name'.format(key))
-            val = self._expand_attribute(key)
-            return val['value'] if val and 'value' in val else ""
+            return lambda fmt: fmt._get_attribute_value(key)
         elif isinstance(node, ast.Name):
             var = node.id
             if var in ('node', 'nodename'):
-                return self._nodename
+                return lambda fmt: fmt._nodename
             if var in _attraliases:
-                val = self._expand_attribute(_attraliases[var])
-                return val['value'] if 'value' in val else ""
+                key = _attraliases[var]
+
+                def get_alias(fmt):
+                    val = fmt._expand_attribute(key)
+                    return val['value'] if 'value' in val else ""
+                return get_alias
             mg = re.match(self.posmatch, var)
             if mg:
                 idx = int(mg.group(1))
-                if self._numbers is None:
-                    self._numbers = re.findall(self.nummatch, self._nodename)
-                return int(self._numbers[idx - 1])
-            else:
-                if var in self._nodeobj:
-                    val = self._expand_attribute(var)
-                    return val['value'] if val and 'value' in val else ""
-                elif (not var.startswith('custom.') and
-                        _get_valid_attrname(var) not in allattributes.node):
+                return lambda fmt: fmt._get_number(idx)
+            valid = (var.startswith('custom.') or
+                     _get_valid_attrname(var) in allattributes.node)
+
+            def get_name(fmt):
+                if var in fmt._nodeobj:
+                    return fmt._get_attribute_value(var)
+                elif not valid:
                     raise ValueError(
                         '{0} is not a valid attribute name'.format(var))
+                # not set yet, but the expression should follow if it is
+                fmt._add_expressionkey(var)
+            return get_name
         elif isinstance(node, ast.BinOp):
             optype = type(node.op)
             if optype not in self._supported_ops:
                 raise Exception("Unsupported operation")
             op = self._supported_ops[optype]
-            return op(int(self._handle_ast_node(node.left)),
-                      int(self._handle_ast_node(node.right)))
+            left = self._compile_ast_node(node.left)
+            right = self._compile_ast_node(node.right)
+            return lambda fmt: op(int(left(fmt)), int(right(fmt)))
+        return lambda fmt: None
 
-    def _expand_attribute(self, key):
+    def _get_number(self, idx):
+        if self._numbers is None:
+            self._numbers = re.findall(self.nummatch, self._nodename)
+        return int(self._numbers[idx - 1])
+
+    def _get_attribute_value(self, key):
+        val = self._expand_attribute(key)
+        return val['value'] if val and 'value' in val else ""
+
+    def _add_expressionkey(self, key):
         if '_expressionkeys' not in self._nodeobj:
             self._nodeobj['_expressionkeys'] = set([key])
         else:
             self._nodeobj['_expressionkeys'].add(key)
+
+    def _expand_attribute(self, key):
+        self._add_expressionkey(key)
         val = _decode_attribute(key, self._nodeobj,
                                 formatter=self)
         return val
@@ -919,6 +1405,92 @@ def _addchange(changeset, node, attrname):
         changeset[node][attrname] = 1
 
 
+class _AttributeIndex(object):
+    """Inverted index of node attribute values
+
+    An attribute is indexed the first time it is used in a filter, after
+    which it is kept current from the changesets applied to the
+    configuration.
+
+    :param nodestore: The 'nodes' dictionary of a tenant
+    """
+
+    def __init__(self, nodestore):
+        self.nodestore = nodestore
+        # attribute -> value -> set of nodes
+        self.byvalue = {}
+        # attribute -> node -> value, to find the prior value on change
+        self.bynode = {}
+        # names of attributes set on any node, built on first use
+        self.names = None
+
+    def _get_value(self, node, attribute):
+        try:
+            return self.nodestore[node][attribute]['value']
+        except (KeyError, TypeError):
+            return None
+
+    def _add(self, node, attribute, value):
+        try:
+            self.byvalue[attribute].setdefault(value, set()).add(node)
+        except TypeError:  # unhashable values can not be indexed
+            return
+        self.bynode[attribute][node] = value
+
+    def _discard(self, node, attribute):
+        if node not in self.bynode[attribute]:
+            return
+        value = self.bynode[attribute].pop(node)
+        vnodes = self.byvalue[attribute][value]
+        vnodes.discard(node)
+        if not vnodes:
+            del self.byvalue[attribute][value]
+
+    def values(self, attribute):
+        """Return a dictionary of each distinct value to its nodes"""
+        if attribute not in self.byvalue:
+            self.byvalue[attribute] = {}
+            self.bynode[attribute] = {}
+            for node in self.nodestore:
+                value = self._get_value(node, attribute)
+                if value is not None:
+                    self._add(node, attribute, value)
+        return self.byvalue[attribute]
+
+    def attribute_names(self):
+        """Return the set of attribute names in use across all nodes
+
+        A name is not withdrawn when the last node to have it is cleared,
+        so callers must still check for it on each node.
+        """
+        if self.names is None:
+            self.names = set()
+            for node in self.nodestore:
+                self.names.update(self.nodestore[node])
+            self.names = set(
+                name for name in self.names if not name.startswith('_'))
+        return self.names
+
+    def update(self, changeset):
+        for node in changeset:
+            if node not in self.nodestore or '_nodedeleted' in changeset[node]:
+                for attribute in self.bynode:
+                    self._discard(node, attribute)
+                continue
+            if self.names is not None:
+                for attribute in changeset[node]:
+                    if (attribute in self.nodestore[node] and
+                            not attribute.startswith('_')):
+                        self.names.add(attribute)
+            for attribute in changeset[node]:
+                if attribute not in self.bynode:
+                    continue
+                self._discard(node, attribute)
+                value = self._get_value(node, attribute)
+                if value is not None:
+                    self._add(node, attribute, value)
+
+
 def hook_new_configmanagers(callback):
     """Register callback for new tenants
 
@@ -939,6 +1511,27 @@ def hook_new_configmanagers(callback):
         pass
 
 
+def hook_user_changes(callback):
+    """Register callback for changes to users
+
+    callback is invoked with the tenant and name of a user whenever that
+    user is created, modified or deleted, whether by this member or as
+    replicated from the collective leader.  It is intended for anything
+    caching credentials or authorization to know to discard them.
+
+    :param callback: Function to call with tenant and username
+    """
+    _userwatchers.append(callback)
+
+
+def _notify_user_change(tenant, name):
+    for callback in _userwatchers:
+        try:
+            callback(tenant, name)
+        except Exception:
+            logException()
+
+
 class ConfigManager(object):
     if os.name == 'nt':
         _cfgdir = os.path.join(
@@ -952,6 +1545,9 @@ class ConfigManager(object):
     _attribwatchers = {}
     _nodecollwatchers = {}
     _notifierids = {}
+    _attribindexes = {}
+    _pendingnotifications = {}
+    _notificationflusher = None
 
     @property
     def _cfgstore(self):
@@ -1001,6 +1597,10 @@ class ConfigManager(object):
     def check_quorum(cls):
         return check_quorum()
 
+    @classmethod
+    def get_nodecollection_generation(cls):
+        return get_nodecollection_generation()
+
     def filter_node_attributes(self, expression, nodes=None):
         """Filtered nodelist according to expression
 
@@ -1019,8 +1619,6 @@ class ConfigManager(object):
         """
         exmatch = None
         yieldmatches = True
-        if nodes is None:
-            nodes = self._cfgstore['nodes']
         if '==' in expression:
             attribute, match = expression.split('==')
         elif '!=' in expression:
@@ -1037,26 +1635,46 @@ class ConfigManager(object):
             attribute, match = expression.split('=')
         else:
             raise Exception('Invalid Expression')
+        valuemap = self._get_attribindex().values(attribute)
+        matched = set([])
+        # Let's treat 'not set' as being an empty string for this path
+        if exmatch:
+            matchunset = exmatch.search('')
+            for currval in valuemap:
+                if (isinstance(currval, (str, unicode)) and
+                        exmatch.search(currval)):
+                    matched |= valuemap[currval]
+        else:
+            matchunset = match == ''
+            matched |= valuemap.get(match, set([]))
+        if matchunset:
+            unset = set(self._cfgstore['nodes'])
+            for currval in valuemap:
+                unset -= valuemap[currval]
+            matched |= unset
+        if nodes is None:
+            if yieldmatches:
+                for node in matched:
+                    yield node
+                return
+            nodes = self._cfgstore['nodes']
         for node in nodes:
-            try:
-                currval = self._cfgstore['nodes'][node][attribute]['value']
-            except KeyError:
-                # Let's treat 'not set' as being an empty string for this path
-                currval = ''
-            if exmatch:
-                if yieldmatches:
-                    if exmatch.search(currval):
-                        yield node
-                else:
-                    if not exmatch.search(currval):
-                        yield node
-            else:
-                if yieldmatches:
-                    if match == currval:
-                        yield node
-                else:
-                    if match != currval:
-                        yield node
+            if (node in matched) == yieldmatches:
+                yield node
+
+    def _get_attribindex(self):
+        attribindex = self._attribindexes.get(self.tenant, None)
+        if (attribindex is None or
+                attribindex.nodestore is not self._cfgstore['nodes']):
+            # configuration was replaced wholesale, start over
+            attribindex = _AttributeIndex(self._cfgstore['nodes'])
+            self._attribindexes[self.tenant] = attribindex
+        return attribindex
+
+    def _update_attribindex(self, changeset):
+        attribindex = self._attribindexes.get(self.tenant, None)
+        if attribindex is not None:
+            attribindex.update(changeset)
 
     def filter_nodenames(self, expression, nodes=None):
         """Filter nodenames by regular expression
@@ -1077,7 +1695,11 @@ class ConfigManager(object):
         attributes may be literal, or a filename style wildcard like
         'net*.switch'
 
-        :param nodes: An iterable of node names to be watching
+        Changes made in quick succession are delivered together, with one
+        call of callback for all of them.
+
+        :param nodes: An iterable of node names to be watching, or None to
+                      watch all nodes, including those added later
         :param attributes: An iterable of attribute names to be notified about
         :param callback: A callback to process a notification
 
@@ -1087,26 +1709,33 @@ class ConfigManager(object):
         notifierid = random.randint(0, sys.maxint)
         while notifierid in self._notifierids:
             notifierid = random.randint(0, sys.maxint)
-        self._notifierids[notifierid] = {'attriblist': []}
+        exact = set([])
+        globs = []
+        for attribute in attributes:
+            if '*' in attribute:
+                globs.append(attribute)
+            else:
+                exact.add(attribute)
+        globmatch = None
+        if globs:
+            globmatch = re.compile('|'.join(
+                '(?:{0})'.format(fnmatch.translate(x)) for x in globs))
+        if nodes is not None:
+            nodes = set(nodes)
+        self._notifierids[notifierid] = {
+            'tenant': self.tenant, 'nodes': nodes, 'attributes': exact,
+            'globs': globs, 'globmatch': globmatch, 'callback': callback}
         if self.tenant not in self._attribwatchers:
-            self._attribwatchers[self.tenant] = {}
+            self._attribwatchers[self.tenant] = {'bynode': {},
+                                                 'all': set([])}
         attribwatchers = self._attribwatchers[self.tenant]
-        for node in nodes:
-            if node not in attribwatchers:
-                attribwatchers[node] = {}
-            for attribute in attributes:
-                self._notifierids[notifierid]['attriblist'].append(
-                    (node, attribute))
-                if attribute not in attribwatchers[node]:
-                    attribwatchers[node][attribute] = {
-                        notifierid: callback
-                    }
-                else:
-                    attribwatchers[node][attribute][notifierid] = callback
-                if '*' in attribute:
-                    currglobs = attribwatchers[node].get('_attrglobs', set([]))
-                    currglobs.add(attribute)
-                    attribwatchers[node]['_attrglobs'] = currglobs
+        if nodes is None:
+            attribwatchers['all'].add(notifierid)
+        else:
+            for node in nodes:
+                if node not in attribwatchers['bynode']:
+                    attribwatchers['bynode'][node] = set([])
+                attribwatchers['bynode'][node].add(notifierid)
         return notifierid
 
     def watch_nodecollection(self, callback):
@@ -1141,11 +1770,15 @@ class ConfigManager(object):
         if watcher not in self._notifierids:
             raise Exception("Invalid")
             # return
-        if 'attriblist' in self._notifierids[watcher]:
-            attribwatchers = self._attribwatchers[self.tenant]
-            for nodeattrib in self._notifierids[watcher]['attriblist']:
-                node, attrib = nodeattrib
-                del attribwatchers[node][attrib][watcher]
+        if 'callback' in self._notifierids[watcher]:
+            watchinfo = self._notifierids[watcher]
+            attribwatchers = self._attribwatchers[watchinfo['tenant']]
+            if watchinfo['nodes'] is None:
+                attribwatchers['all'].discard(watcher)
+            for node in watchinfo['nodes'] or ():
+                attribwatchers['bynode'][node].discard(watcher)
+                if not attribwatchers['bynode'][node]:
+                    del attribwatchers['bynode'][node]
         elif 'nodecollection' in self._notifierids[watcher]:
             del self._nodecollwatchers[self.tenant][watcher]
         else:
@@ -1236,6 +1869,7 @@ class ConfigManager(object):
             else:
                 user[attribute] = attributemap[attribute]
         _mark_dirtykey('users', name, self.tenant)
+        _notify_user_change(self.tenant, name)
         self._bg_sync_to_file()
 
     def del_user(self, name):
@@ -1249,6 +1883,7 @@ class ConfigManager(object):
         if name in self._cfgstore['users']:
             del self._cfgstore['users'][name]
             _mark_dirtykey('users', name, self.tenant)
+            _notify_user_change(self.tenant, name)
         self._bg_sync_to_file()
 
     def create_user(self, name,
@@ -1296,6 +1931,7 @@ class ConfigManager(object):
             self._true_set_user(name, attributemap)
         _mark_dirtykey('users', name, self.tenant)
         _mark_dirtykey('idmap', uid)
+        _notify_user_change(self.tenant, name)
         self._bg_sync_to_file()
 
     def is_node(self, node):
@@ -1347,7 +1983,8 @@ class ConfigManager(object):
             nodelist = [nodelist]
         if isinstance(attributes, str) or isinstance(attributes, unicode):
             attributes = [attributes]
-        relattribs = attributes
+        # wildcards are resolved once, rather than against every node
+        relattribs = self._expand_attributes(attributes)
         for node in nodelist:
             if node not in self._cfgstore['nodes']:
                 continue
@@ -1359,10 +1996,6 @@ class ConfigManager(object):
                 if attribute.startswith('_'):
                     # skip private things
                     continue
-                if '*' in attribute:
-                    for attr in fnmatch.filter(list(cfgnodeobj), attribute):
-                        nodeobj[attr] = _decode_attribute(attr, cfgnodeobj,
-                                                          decrypt=decrypt)
                 if attribute not in cfgnodeobj:
                     continue
                 # since the formatter is not passed in, the calculator is
@@ -1373,6 +2006,53 @@ class ConfigManager(object):
             retdict[node] = nodeobj
         return retdict
 
+    def get_node_attribute_columns(self, nodelist, attributes=(),
+                                   decrypt=None):
+        """Retrieve attributes of many nodes, arranged by attribute
+
+        Rather than a dictionary per node, the values of each attribute
+        are returned as a list aligned to the list of nodes found, with
+        None for a node that has no such setting.  An attribute that none
+        of the nodes have is omitted.  With no attributes requested, every
+        attribute in use is considered.
+
+        :param nodelist: Nodes to retrieve, in the order desired
+        :param attributes: Attribute names, which may include wildcards
+        :param decrypt: Whether to decrypt secret values
+        :returns: Tuple of the list of nodes and a dictionary of attribute
+                  names to lists of values
+        """
+        if decrypt is None:
+            decrypt = self.decrypt
+        if isinstance(nodelist, str) or isinstance(nodelist, unicode):
+            nodelist = [nodelist]
+        if isinstance(attributes, str) or isinstance(attributes, unicode):
+            attributes = [attributes]
+        nodestore = self._cfgstore.get('nodes', {})
+        nodes = [node for node in nodelist if node in nodestore]
+        nodeobjs = [nodestore[node] for node in nodes]
+        columns = {}
+        for attribute in self._expand_attributes(attributes or ('*',)):
+            if attribute.startswith('_'):
+                continue
+            column = [_decode_attribute(attribute, nodeobj, decrypt=decrypt)
+                      for nodeobj in nodeobjs]
+            if column.count(None) < len(column):
+                columns[attribute] = column
+        return nodes, columns
+
+    def _expand_attributes(self, attributes):
+        expanded = []
+        for attribute in attributes:
+            if '*' not in attribute:
+                expanded.append(attribute)
+                continue
+            if 'nodes' not in self._cfgstore:
+                continue
+            names = self._get_attribindex().attribute_names()
+            expanded.extend(sorted(fnmatch.filter(names, attribute)))
+        return expanded
+
     def _node_added_to_group(self, node, group, changeset):
         try:
             nodecfg = self._cfgstore['nodes'][node]
@@ -1646,53 +2326,52 @@ class ConfigManager(object):
                                           changeset=changeset)
 
     def _notif_attribwatchers(self, nodeattrs):
+        # every applied changeset passes through here, keep the attribute
+        # index current before anyone is told of the change
+        self._update_attribindex(nodeattrs)
         if self.tenant not in self._attribwatchers:
             return
-        notifdata = {}
         attribwatchers = self._attribwatchers[self.tenant]
+        allwatchers = attribwatchers['all']
+        bynode = attribwatchers['bynode']
+        pending = self._pendingnotifications
         for node in nodeattrs:
-            if node not in attribwatchers:
-                continue
-            attribwatcher = attribwatchers[node]
-            # usually, we will only look at the specific attribute keys that
-            # have had change flagged, so set up to iterate through only those
-            checkattrs = nodeattrs[node]
-            if '_nodedeleted' in nodeattrs[node]:
-                # in the case of a deleted node, we want to iterate through
-                # *all* attributes that the node might have had set prior
-                # to deletion, to make all watchers aware of the removed
-                # node and take appropriate action
-                checkattrs = attribwatcher
-            globattrs = {}
-            for attrglob in attribwatcher.get('_attrglobs', []):
-                for matched in fnmatch.filter(list(checkattrs), attrglob):
-                    globattrs[matched] = attrglob
-            for attrname in checkattrs:
-                if attrname == '_attrglobs':
+            notifierids = bynode.get(node, None)
+            if notifierids is None:
+                if not allwatchers:
                     continue
-                watchkey = attrname
-                # the attrib watcher could still have a glob
-                if attrname not in attribwatcher:
-                    if attrname in globattrs:
-                        watchkey = globattrs[attrname]
-                    else:
-                        continue
-                for notifierid in attribwatcher[watchkey]:
-                    if notifierid in notifdata:
-                        if node in notifdata[notifierid]['nodeattrs']:
-                            notifdata[notifierid]['nodeattrs'][node].append(
-                                attrname)
-                        else:
-                            notifdata[notifierid]['nodeattrs'][node] = [
-                                attrname]
-                    else:
-                        notifdata[notifierid] = {
-                            'nodeattrs': {node: [attrname]},
-                            'callback': attribwatcher[watchkey][notifierid]
-                        }
-        for watcher in notifdata.itervalues():
-            callback = watcher['callback']
-            eventlet.spawn_n(_do_notifier, self, watcher, callback)
+                notifierids = allwatchers
+            elif allwatchers:
+                notifierids = notifierids | allwatchers
+            deleted = '_nodedeleted' in nodeattrs[node]
+            for notifierid in notifierids:
+                watchinfo = self._notifierids[notifierid]
+                if deleted:
+                    # in the case of a deleted node, make watchers aware of
+                    # the removed node by everything they watch on it
+                    matched = list(watchinfo['attributes']) + watchinfo['globs']
+                else:
+                    globmatch = watchinfo['globmatch']
+                    matched = [
+                        x for x in nodeattrs[node]
+                        if x in watchinfo['attributes'] or (
+                            globmatch is not None and globmatch.match(x))]
+                if not matched:
+                    continue
+                if notifierid not in pending:
+                    pending[notifierid] = {'nodeattrs': {},
+                                           'callback': watchinfo['callback']}
+                pending[notifierid]['configmanager'] = self
+                notified = pending[notifierid]['nodeattrs'].setdefault(
+                    node, [])
+                for attrname in matched:
+                    if attrname not in notified:
+                        notified.append(attrname)
+        if pending and ConfigManager._notificationflusher is None:
+            # deliver once the current burst of changes is done, so that a
+            # watcher is called once for all of them
+            ConfigManager._notificationflusher = eventlet.spawn_after(
+                0, _flush_notifications)
 
     def del_nodes(self, nodes):
         if cfgleader:  # slaved to a collective
@@ -1717,6 +2396,7 @@ class ConfigManager(object):
                                           changeset=changeset)
                 del self._cfgstore['nodes'][node]
                 _mark_dirtykey('nodes', node, self.tenant)
+                _bump_nodecollection_generation()
         self._notif_attribwatchers(changeset)
         self._bg_sync_to_file()
 
@@ -1868,6 +2548,7 @@ class ConfigManager(object):
             if node not in self._cfgstore['nodes']:
                 newnodes.append(node)
                 self._cfgstore['nodes'][node] = {}
+                _bump_nodecollection_generation()
             cfgobj = self._cfgstore['nodes'][node]
             recalcexpressions = False
             for attrname in attribmap[node]:
@@ -1918,53 +2599,72 @@ class ConfigManager(object):
         :return:
         """
         dumpdata = json.loads(jsondata)
+        self._load_from_records(
+            ((confarea, element, dumpdata[confarea][element])
+             for confarea in _config_areas if confarea in dumpdata
+             for element in dumpdata[confarea]), sync)
+
+    def _load_from_records(self, records, sync=True):
+        """Load fresh configuration data from records
+
+        Each record is processed as it is taken, so records may be supplied
+        by a generator reading from a stream.
+
+        :param records: Iterable of tuples of configuration area, name and
+                        data, as produced by _dump_to_records
+        """
         tmpconfig = {}
-        for confarea in _config_areas:
-            if confarea not in dumpdata:
+        for confarea, element, data in records:
+            if confarea not in _config_areas:
                 continue
-            tmpconfig[confarea] = {}
-            for element in dumpdata[confarea]:
-                newelement = copy.deepcopy(dumpdata[confarea][element])
-                try:
-                    noderange._parser.parseString(
-                        '({0})'.format(element)).asList()
-                except noderange.pp.ParseException as pe:
-                    raise ValueError(
-                        '"{0}" is not a supported name, it must be renamed or '
-                        'removed from backup to restore'.format(element))
-                for attribute in dumpdata[confarea][element]:
-                    if newelement[attribute] == '*REDACTED*':
-                        raise Exception(
-                            "Unable to restore from redacted backup")
-                    elif attribute == 'cryptpass':
-                        passparts = newelement[attribute].split('!')
-                        newelement[attribute] = tuple([base64.b64decode(x)
-                                                       for x in passparts])
-                    elif 'cryptvalue' in newelement[attribute]:
-                        bincrypt = newelement[attribute]['cryptvalue']
-                        bincrypt = tuple([base64.b64decode(x)
-                                          for x in bincrypt.split('!')])
-                        newelement[attribute]['cryptvalue'] = bincrypt
-                    elif attribute in ('nodes', '_expressionkeys'):
-                        # A group with nodes
-                        # delete it and defer until nodes are being added
-                        # which will implicitly fill this up
-                        # Or _expressionkeys attribute, which will similarly
-                        # be rebuilt
-                        del newelement[attribute]
-                tmpconfig[confarea][element] = newelement
+            if confarea not in tmpconfig:
+                tmpconfig[confarea] = {}
+            newelement = copy.deepcopy(data)
+            try:
+                noderange._parser.parseString(
+                    '({0})'.format(element)).asList()
+            except noderange.pp.ParseException as pe:
+                raise ValueError(
+                    '"{0}" is not a supported name, it must be renamed or '
+                    'removed from backup to restore'.format(element))
+            for attribute in data:
+                if newelement[attribute] == '*REDACTED*':
+                    raise Exception(
+                        "Unable to restore from redacted backup")
+                elif attribute == 'cryptpass':
+                    passparts = newelement[attribute].split('!')
+                    newelement[attribute] = tuple([base64.b64decode(x)
+                                                   for x in passparts])
+                elif 'cryptvalue' in newelement[attribute]:
+                    bincrypt = newelement[attribute]['cryptvalue']
+                    bincrypt = tuple([base64.b64decode(x)
+                                      for x in bincrypt.split('!')])
+                    newelement[attribute]['cryptvalue'] = bincrypt
+                elif attribute in ('nodes', '_expressionkeys'):
+                    # A group with nodes
+                    # delete it and defer until nodes are being added
+                    # which will implicitly fill this up
+                    # Or _expressionkeys attribute, which will similarly
+                    # be rebuilt
+                    del newelement[attribute]
+            tmpconfig[confarea][element] = newelement
         # We made it through above section without an exception, go ahead and
         # replace
-        # Start by erasing the dbm files if present
-        for confarea in _config_areas:
-            try:
-                os.unlink(os.path.join(self._cfgdir, confarea))
-            except OSError as e:
-                if e.errno == 2:
-                    pass
+        # Start by erasing the dbm files if present, folding in the journal
+        # first so that it can not replay stale data over the new content
+        with _synclock:
+            if not statelessmode and _journaldirty:
+                _compact_journal(self._cfgdir)
+            for confarea in _config_areas:
+                try:
+                    os.unlink(os.path.join(self._cfgdir, confarea))
+                except OSError as e:
+                    if e.errno == 2:
+                        pass
         # Now we have to iterate through each fixed up element, using the
         # set attribute to flesh out inheritence and expressions
         _cfgstore['main']['idmap'] = {}
+        _bump_nodecollection_generation()
         for confarea in _config_areas:
             self._cfgstore[confarea] = {}
             if confarea not in tmpconfig:
@@ -1999,38 +2699,51 @@ class ConfigManager(object):
 
         """
         dumpdata = {}
+        for confarea in _config_areas:
+            if confarea in self._cfgstore:
+                dumpdata[confarea] = {}
+        for confarea, element, data in self._dump_to_records(redact):
+            dumpdata[confarea][element] = data
+        return json.dumps(
+            dumpdata, sort_keys=True, indent=4, separators=(',', ': '))
+
+    def _dump_to_records(self, redact=None):
+        """Dump the configuration as a list of records
+
+        This is the content of _dump_to_json, as a tuple of configuration
+        area, name and data per element, for sending an element at a time.
+
+        :param redact: As for _dump_to_json
+        """
+        records = []
         for confarea in _config_areas:
             if confarea not in self._cfgstore:
                 continue
-            dumpdata[confarea] = {}
             for element in self._cfgstore[confarea]:
-                dumpdata[confarea][element] = \
-                    copy.deepcopy(self._cfgstore[confarea][element])
+                data = copy.deepcopy(self._cfgstore[confarea][element])
                 for attribute in self._cfgstore[confarea][element]:
-                    if 'inheritedfrom' in dumpdata[confarea][element][attribute]:
-                        del dumpdata[confarea][element][attribute]
+                    if 'inheritedfrom' in data[attribute]:
+                        del data[attribute]
                     elif (attribute == 'cryptpass' or
-                                  'cryptvalue' in
-                                  dumpdata[confarea][element][attribute]):
+                                  'cryptvalue' in data[attribute]):
                         if redact is not None:
-                            dumpdata[confarea][element][attribute] = '*REDACTED*'
+                            data[attribute] = '*REDACTED*'
                         else:
                             if attribute == 'cryptpass':
-                                target = dumpdata[confarea][element][attribute]
+                                target = data[attribute]
                             else:
-                                target = dumpdata[confarea][element][attribute]['cryptvalue']
+                                target = data[attribute]['cryptvalue']
                             cryptval = []
                             for value in target:
                                 cryptval.append(base64.b64encode(value))
                             if attribute == 'cryptpass':
-                                dumpdata[confarea][element][attribute] = '!'.join(cryptval)
+                                data[attribute] = '!'.join(cryptval)
                             else:
-                                dumpdata[confarea][element][attribute]['cryptvalue'] = '!'.join(cryptval)
-                    elif isinstance(dumpdata[confarea][element][attribute], set):
-                        dumpdata[confarea][element][attribute] = \
-                            list(dumpdata[confarea][element][attribute])
-        return json.dumps(
-            dumpdata, sort_keys=True, indent=4, separators=(',', ': '))
+                                data[attribute]['cryptvalue'] = '!'.join(cryptval)
+                    elif isinstance(data[attribute], set):
+                        data[attribute] = list(data[attribute])
+                records.append((confarea, element, data))
+        return records
 
 
 
@@ -2038,13 +2751,19 @@ class ConfigManager(object):
     def _read_from_path(cls):
         global _cfgstore
         global _txcount
+        global _txhash
+        global _journaltx
         _cfgstore = {}
+        _journaldirty.clear()
+        _bump_nodecollection_generation()
         rootpath = cls._cfgdir
         try:
             with open(os.path.join(rootpath, 'transactioncount'), 'r') as f:
                 txbytes = f.read()
-                if len(txbytes) == 8:
-                    _txcount = struct.unpack('!Q', txbytes)[0]
+                if len(txbytes) >= 8:
+                    _txcount = struct.unpack('!Q', txbytes[:8])[0]
+                if len(txbytes) > 8:
+                    _txhash = txbytes[8:]
         except IOError:
             pass
         _load_dict_from_dbm(['collective'], os.path.join(rootpath,
@@ -2060,6 +2779,8 @@ class ConfigManager(object):
                         os.path.join(rootpath, tenant, confarea))
         except OSError:
             pass
+        _replay_journal(rootpath)
+        _journaltx = _txcount
 
     @classmethod
     def wait_for_sync(cls, fullsync=False):
@@ -2076,8 +2797,13 @@ class ConfigManager(object):
 
     @classmethod
     def _bg_sync_to_file(cls, fullsync=False):
+        global _syncwanted
         if statelessmode:
             return
+        if _syncheld:
+            # a batch of transactions is being applied, sync once at the end
+            _syncwanted = bool(_syncwanted) or fullsync
+            return
         with cls._syncstate:
             if (cls._syncrunning and cls._cfgwriter is not None and
                     cls._cfgwriter.isAlive()):
@@ -2095,12 +2821,11 @@ class ConfigManager(object):
 
     @classmethod
     def _sync_to_file(cls, fullsync=False):
+        global _journaltx
         with _synclock:
             if statelessmode:
                 return
             _mkpath(cls._cfgdir)
-            with open(os.path.join(cls._cfgdir, 'transactioncount'), 'w') as f:
-                f.write(struct.pack('!Q', _txcount))
             if (fullsync or 'dirtyglobals' in _cfgstore and
                     'globals' in _cfgstore):
                 if fullsync:  # globals is not a given to be set..
@@ -2150,30 +2875,37 @@ class ConfigManager(object):
                             dbf[ck] = cPickle.dumps(currdict[category][ck])
                     finally:
                         dbf.close()
-            elif 'dirtykeys' in _cfgstore:
+                _compact_journal(cls._cfgdir)
+            else:
+                entries = []
                 with _dirtylock:
-                    currdirt = copy.deepcopy(_cfgstore['dirtykeys'])
-                    del _cfgstore['dirtykeys']
+                    # the dirty set is being discarded anyway, so it is
+                    # simply taken rather than copied
+                    currdirt = _cfgstore.pop('dirtykeys', {})
                 for tenant in currdirt:
                     dkdict = currdirt[tenant]
                     if tenant is None:
-                        pathname = cls._cfgdir
                         currdict = _cfgstore['main']
                     else:
-                        pathname = os.path.join(cls._cfgdir, 'tenants', tenant)
                         currdict = _cfgstore['tenant'][tenant]
+                    jdirty = _journaldirty.setdefault(tenant, {})
                     for category in dkdict:
-                        _mkpath(pathname)
-                        dbf = dbm.open(os.path.join(pathname, category), 'c', 384)  # 0600
-                        try:
-                            for ck in dkdict[category]:
-                                if ck not in currdict[category]:
-                                    if ck in dbf:
-                                        del dbf[ck]
-                                else:
-                                    dbf[ck] = cPickle.dumps(currdict[category][ck])
-                        finally:
-                            dbf.close()
+                        catdict = currdict.get(category, {})
+                        for ck in dkdict[category]:
+                            if ck in catdict:
+                                entries.append(
+                                    (tenant, category, ck, catdict[ck], False))
+                            else:
+                                entries.append(
+                                    (tenant, category, ck, None, True))
+                        jdirty.setdefault(category, set()).update(
+                            dkdict[category])
+                if entries or _txcount != _journaltx:
+                    _journaltx = _txcount
+                    jsize = _append_journal(cls._cfgdir, _txcount, entries,
+                                            _txhash)
+                    if jsize > _journal_compact_size():
+                        _compact_journal(cls._cfgdir)
         willrun = False
         with cls._syncstate:
             if cls._writepending:
@@ -2185,6 +2917,11 @@ class ConfigManager(object):
             return cls._sync_to_file()
 
     def _recalculate_expressions(self, cfgobj, formatter, node, changeset):
+        toplevel = cfgobj is formatter._nodeobj
+        if toplevel:
+            # gather the referenced keys afresh as the expressions are
+            # evaluated, so that references no longer made are dropped
+            cfgobj['_expressionkeys'] = set()
         for key in cfgobj:
             if not isinstance(cfgobj[key], dict):
                 continue
@@ -2198,6 +2935,8 @@ class ConfigManager(object):
                 # it might indeed be a nested structure
                 self._recalculate_expressions(cfgobj[key], formatter, node,
                                               changeset)
+        if toplevel and not cfgobj['_expressionkeys']:
+            del cfgobj['_expressionkeys']
 
 
 def _restore_keys(jsond, password, newpassword=None, sync=True):
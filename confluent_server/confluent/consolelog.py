@@ -0,0 +1,120 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2018 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module provides search of the console logs of a noderange, by time
+# window and pattern.  The binary index of each log is used to seek to the
+# start of the window, and lines are assembled and matched as the referenced
+# text is read, so a log is never loaded whole into memory.  Nodes are
+# searched in parallel and their lines are streamed back in batches as they
+# are found.
+
+import confluent.collective.manager as collective
+import confluent.log as log
+import confluent.messages as msg
+import eventlet
+import eventlet.greenpool as greenpool
+import eventlet.queue as queue
+
+_searchers = greenpool.GreenPool(64)
+_batchsize = 64
+
+
+class _Search(object):
+    def __init__(self, nodes, inputdata):
+        self.nodes = nodes
+        self.since = self.until = self.pattern = None
+        if inputdata is not None:
+            self.since = inputdata.since
+            self.until = inputdata.until
+            self.pattern = inputdata.pattern
+        # bounded so a slow client applies backpressure to the searches
+        self.results = queue.Queue(len(nodes) * 2)
+        self.remaining = len(nodes)
+        self.cancelled = False
+
+    def start(self):
+        for node in self.nodes:
+            if self.cancelled:
+                self.results.put(node)
+                continue
+            _searchers.spawn_n(self._search_node, node)
+
+    def _search_node(self, node):
+        try:
+            logger = log.Logger(node, console=True)
+            pattern = self.pattern
+            lines = []
+            pending = ''
+            for tstamp, data in logger.read_text_range(self.since,
+                                                       self.until):
+                if self.cancelled:
+                    return
+                data = (pending + data).replace('\r', '').split('\n')
+                pending = data.pop()
+                for line in data:
+                    if pattern is None or pattern.search(line):
+                        lines.append({'timestamp': tstamp, 'line': line})
+                if len(lines) >= _batchsize:
+                    self.results.put(msg.ConsoleLogLines(lines, node))
+                    lines = []
+                eventlet.sleep(0)
+            if pending and (pattern is None or pattern.search(pending)):
+                lines.append({'timestamp': tstamp, 'line': pending})
+            if lines:
+                self.results.put(msg.ConsoleLogLines(lines, node))
+        except Exception as e:
+            log.logtrace()
+            self.results.put(msg.ConfluentNodeError(node, str(e)))
+        finally:
+            self.results.put(node)
+
+    def __iter__(self):
+        eventlet.spawn_n(self.start)
+        try:
+            while self.remaining:
+                rsp = self.results.get()
+                if isinstance(rsp, msg.ConfluentMessage):
+                    yield rsp
+                else:
+                    self.remaining -= 1
+        finally:
+            if self.remaining:
+                # client went away, stop the searches and let any of them
+                # blocked on a full queue finish
+                self.cancelled = True
+                eventlet.spawn_n(self._drain)
+
+    def _drain(self):
+        while self.remaining:
+            if not isinstance(self.results.get(), msg.ConfluentMessage):
+                self.remaining -= 1
+
+
+def retrieve(nodes, element, configmanager, inputdata):
+    myname = collective.get_myname()
+    managers = configmanager.get_node_attributes(nodes, 'collective.manager')
+    localnodes = []
+    for node in nodes:
+        manager = managers.get(node, {}).get('collective.manager', {}).get(
+            'value', None)
+        if manager and myname and manager != myname:
+            yield msg.ConfluentNodeError(
+                node, 'Console log is held by collective member ' + manager)
+        else:
+            localnodes.append(node)
+    if localnodes:
+        for rsp in _Search(localnodes, inputdata):
+            yield rsp
@@ -24,6 +24,7 @@
 import codecs
 import collections
 import confluent.collective.manager as collective
+import confluent.config.conf as conf
 import confluent.config.configmanager as configmodule
 import confluent.exceptions as exc
 import confluent.interface.console as conapi
@@ -42,6 +43,14 @@ import traceback
 
 _handled_consoles = {}
 
+# Consoles only model their screen while it is in use.  A console that has
+# not been looked at recently just logs its output, and its screen is
+# rebuilt from the tail of the log when a session next attaches.  Up to
+# hot_consoles screens are kept, evicting the least recently used idle ones.
+_hotconsoles = collections.OrderedDict()
+_hotlimit = None
+_replaysize = 32768
+
 _tracelog = None
 
 try:
@@ -158,9 +167,9 @@ class ConsoleHandler(object):
         self.node = node
         self.connectstate = 'unconnected'
         self._isalive = True
-        self.buffer = pyte.Screen(100, 31)
-        self.termstream = pyte.ByteStream()
-        self.termstream.attach(self.buffer)
+        self._screen = None
+        self._notice = None
+        self.termstream = None
         self.livesessions = set([])
         self.utf8decoder = codecs.getincrementaldecoder('utf-8')()
         if self._logtobuffer:
@@ -209,16 +218,65 @@ class ConsoleHandler(object):
             retrytime = 120
         return retrytime + (retrytime * random.random())
 
-    def feedbuffer(self, data):
+    def _screen_is_lazy(self):
+        # Only a console whose output all goes to the log can have its
+        # screen rebuilt later
+        return (self._logtobuffer and self._dologging and
+                _get_hot_limit() > 0)
+
+    @property
+    def buffer(self):
+        if self._screen is None:
+            self._materialize_screen()
+        elif self in _hotconsoles:
+            del _hotconsoles[self]
+            _hotconsoles[self] = True
+        return self._screen
+
+    def _materialize_screen(self):
+        self._screen = pyte.Screen(100, 31)
+        self.termstream = pyte.ByteStream()
+        self.termstream.attach(self._screen)
+        lazy = self._screen_is_lazy()
+        if lazy:
+            if self.logger.logentries:
+                self.logger.writedata()
+            self._feed(self.logger.read_recent_text(_replaysize)[0])
+        if self._notice:
+            # kept until real output arrives, as the screen may be released
+            # and rebuilt again before then
+            self._feed(self._notice)
+        if lazy:
+            _hotconsoles[self] = True
+            _evict_screens()
+
+    def _release_screen(self):
+        self._screen = None
+        self.termstream = None
+
+    def _feed(self, data):
         try:
             self.termstream.feed(data)
         except StopIteration:  # corrupt parser state, start over
             self.termstream = pyte.ByteStream()
-            self.termstream.attach(self.buffer)
+            self.termstream.attach(self._screen)
         except Exception:
             _tracelog.log(traceback.format_exc(), ltype=log.DataTypes.event,
                           event=log.Events.stacktrace)
 
+    def feedbuffer(self, data):
+        # a notice such as the one from clearbuffer is not logged, so
+        # remember the latest to put back on a screen rebuilt from the log
+        if data.startswith(b'\x1bc'):
+            self._notice = data
+        else:
+            self._notice = None
+        if self._screen is None and self._screen_is_lazy():
+            # output is in the log already
+            return
+        self.buffer
+        self._feed(data)
+
     def check_isondemand(self):
         self._dologging = True
         attrvalue = self.cfgmgr.get_node_attributes(
@@ -460,6 +518,7 @@ class ConsoleHandler(object):
 
     def close(self):
         self._isalive = False
+        _hotconsoles.pop(self, None)
         self._send_rcpts({'deleting': True})
         self._disconnect()
         if self._console:
@@ -485,6 +544,7 @@ class ConsoleHandler(object):
                 # indicate that user has multiple connections
                 edata = 2
         self.livesessions.add(session)
+        self.buffer  # sessions keep their screen materialized
         self.log(
             logdata=session.username, ltype=log.DataTypes.event,
             event=log.Events.clientconnect, eventdata=edata)
@@ -614,6 +674,29 @@ class ConsoleHandler(object):
                 self._got_disconnected()
 
 
+def _get_hot_limit():
+    # consulted for every chunk of console output, so only read it once
+    global _hotlimit
+    if _hotlimit is None:
+        _hotlimit = conf.get_int_option('console', 'hot_consoles')
+        if _hotlimit is None:
+            _hotlimit = 256
+    return _hotlimit
+
+
+def _evict_screens():
+    limit = _get_hot_limit()
+    for handler in list(_hotconsoles):
+        if len(_hotconsoles) <= limit:
+            break
+        del _hotconsoles[handler]
+        if handler.livesessions:
+            # in use, consider it most recently used instead
+            _hotconsoles[handler] = True
+        elif handler._screen_is_lazy():
+            handler._release_screen()
+
+
 def disconnect_node(node, configmanager):
     consk = (node, configmanager.tenant)
     if consk in _handled_consoles:
@@ -35,6 +35,7 @@
 
 import confluent
 import confluent.alerts as alerts
+import confluent.auth as auth
 import confluent.log as log
 import confluent.tlvdata as tlvdata
 import confluent.config.attributes as attrscheme
@@ -56,9 +57,11 @@ except ImportError:
     # Only required for collective mode
     crypto = None
 import confluent.util as util
+import eventlet
 import eventlet.greenpool as greenpool
 import eventlet.green.ssl as ssl
 import eventlet.queue as queue
+import eventlet.semaphore as semaphore
 import itertools
 import os
 try:
@@ -124,7 +127,8 @@ def load_plugins():
 
 
 rootcollections = ['discovery/', 'events/', 'networking/',
-                   'noderange/', 'nodes/', 'nodegroups/', 'users/', 'version']
+                   'noderange/', 'nodes/', 'nodegroups/', 'stats', 'users/',
+                   'version']
 
 
 class PluginRoute(object):
@@ -139,12 +143,15 @@ class PluginCollection(object):
 def _init_core():
     global noderesources
     global nodegroupresources
+    import confluent.consolelog as consolelog
     import confluent.shellserver as shellserver
+    import confluent.telemetry as telemetry
     # _ prefix indicates internal use (e.g. special console scheme) and should not
     # be enumerated in any collection
     noderesources = {
         'attributes': {
             'all': PluginRoute({'handler': 'attributes'}),
+            'columns': PluginRoute({'handler': 'attributes'}),
             'current': PluginRoute({'handler': 'attributes'}),
             'expression': PluginRoute({'handler': 'attributes'}),
         },
@@ -263,6 +270,9 @@ def _init_core():
                 'pluginattrs': ['hardwaremanagement.method'],
                 'default': 'ipmi',
             }),
+            'log': PluginRoute({
+                'handler': consolelog,
+            }),
         },
         'description': PluginRoute({
             'pluginattrs': ['hardwaremanagement.method'],
@@ -367,7 +377,9 @@ def _init_core():
                     'default': 'ipmi',
                 }),
             },
-
+            'history': PluginRoute({
+                'handler': telemetry,
+            }),
         },
         'support': {
             'servicedata': PluginCollection({
@@ -634,6 +646,61 @@ def handle_dispatch(connection, cert, dispatch, peername):
         connection.close()
         return
     dispatch = pickle.loads(dispatch)
+    for res in _run_dispatch(dispatch):
+        _forward_rsp(connection, res)
+    connection.sendall('\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def handle_dispatch_channel(connection, cert, peername):
+    """Service a persistent dispatch channel from a collective member
+
+    After acknowledgement, every frame on the channel is a request id and
+    length followed by a pickled dispatch request.  Requests are serviced
+    concurrently, with each response framed with the id of its request
+    and a zero length frame marking the end of that request.  Request id 0
+    is reserved for keepalives, which are echoed back.
+    """
+    cert = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+    if not util.cert_matches(
+            cfm.get_collective_member(peername)['fingerprint'], cert):
+        connection.close()
+        return
+    tlvdata.send(connection, {'dispatchchannel': 1})
+    sendlock = semaphore.Semaphore()
+    try:
+        while True:
+            rid, rlen = _dispatchhdr.unpack(
+                tlvdata.recvall(connection, _dispatchhdr.size))
+            if rid == 0:
+                with sendlock:
+                    connection.sendall(_dispatchhdr.pack(0, 0))
+                continue
+            dreq = tlvdata.recvall(connection, rlen)
+            eventlet.spawn_n(_channel_dispatch, connection, sendlock, rid,
+                             dreq)
+    except Exception:
+        pass  # the peer went away, or sent garbage, either way we are done
+    finally:
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def _channel_dispatch(connection, sendlock, rid, dreq):
+    try:
+        for res in _run_dispatch(pickle.loads(dreq)):
+            r = pickle.dumps(res)
+            with sendlock:
+                connection.sendall(_dispatchhdr.pack(rid, len(r)) + r)
+        with sendlock:
+            connection.sendall(_dispatchhdr.pack(rid, 0))
+    except Exception:
+        # most likely the channel is gone, which the reader will notice
+        pass
+
+
+def _run_dispatch(dispatch):
     configmanager = cfm.ConfigManager(dispatch['tenant'])
     nodes = dispatch['nodes']
     inputdata = dispatch['inputdata']
@@ -669,10 +736,9 @@ def handle_dispatch(connection, cert, dispatch, peername):
                 configmanager=configmanager,
                 inputdata=inputdata))
         for res in itertools.chain(*passvalues):
-            _forward_rsp(connection, res)
+            yield res
     except Exception as res:
-        _forward_rsp(connection, res)
-    connection.sendall('\x00\x00\x00\x00\x00\x00\x00\x00')
+        yield res
 
 
 def _forward_rsp(connection, res):
@@ -880,15 +946,202 @@ def addtoqueue(theq, fun, kwargs):
         theq.put('theend')
 
 
+_dispatchhdr = struct.Struct('!QQ')
+_dispatchchannels = {}
+_channellocks = {}
+_legacydispatch = {}
+
+
+class DispatchChannel(object):
+    """A persistent, multiplexed dispatch connection to a collective member
+
+    Requests are tagged with an id so that any number of them may be
+    outstanding on the one connection at a time.  An idle channel is kept
+    alive and checked by way of a periodic keepalive.
+
+    :param member: The collective member record that was connected to
+    :param remote: The connected socket, after channel acknowledgement
+    """
+
+    def __init__(self, member, remote):
+        self.member = member
+        self.remote = remote
+        self.pending = {}
+        self.nextid = 1
+        self.broken = False
+        self.sendlock = semaphore.Semaphore()
+        self.lastrecv = util.monotonic_time()
+        eventlet.spawn_n(self._read_responses)
+        eventlet.spawn_n(self._keepalive)
+
+    def matches(self, member):
+        return (not self.broken and
+                self.member['address'] == member['address'] and
+                self.member['fingerprint'] == member['fingerprint'])
+
+    def _read_responses(self):
+        try:
+            while True:
+                rid, rlen = _dispatchhdr.unpack(
+                    tlvdata.recvall(self.remote, _dispatchhdr.size))
+                rsp = tlvdata.recvall(self.remote, rlen) if rlen else None
+                self.lastrecv = util.monotonic_time()
+                if rid in self.pending:
+                    self.pending[rid].put(rsp)
+        except Exception:
+            pass
+        finally:
+            self.close()
+
+    def _keepalive(self):
+        while not self.broken:
+            eventlet.sleep(30)
+            if self.broken:
+                return
+            if util.monotonic_time() - self.lastrecv > 90:
+                self.close()
+                return
+            try:
+                self._send(_dispatchhdr.pack(0, 0))
+            except Exception:
+                self.close()
+
+    def _send(self, data):
+        with self.sendlock:
+            self.remote.sendall(data)
+
+    def close(self):
+        if self.broken:
+            return
+        self.broken = True
+        try:
+            self.remote.close()
+        except Exception:
+            pass
+        for rid in list(self.pending):
+            self.pending[rid].put(_ChannelBroken)
+        if _dispatchchannels.get(self.member['name'], None) is self:
+            del _dispatchchannels[self.member['name']]
+
+    def request(self, dreq):
+        """Issue a dispatch request, yielding the pickled responses
+
+        Raises _ChannelBroken if the channel fails before the request is
+        complete.
+        """
+        rid = self.nextid
+        self.nextid += 1
+        responses = queue.Queue()
+        self.pending[rid] = responses
+        try:
+            try:
+                self._send(_dispatchhdr.pack(rid, len(dreq)) + dreq)
+            except Exception:
+                self.close()
+                raise _ChannelBroken()
+            while True:
+                rsp = responses.get()
+                if rsp is None:
+                    return
+                if rsp is _ChannelBroken:
+                    raise _ChannelBroken()
+                yield rsp
+        finally:
+            del self.pending[rid]
+
+
+class _ChannelBroken(Exception):
+    pass
+
+
+def _connect_to_member(member):
+    remote = socket.create_connection((member['address'], 13001))
+    remote.settimeout(90)
+    remote = ssl.wrap_socket(remote, cert_reqs=ssl.CERT_NONE,
+                             keyfile='/etc/confluent/privkey.pem',
+                             certfile='/etc/confluent/srvcert.pem')
+    return remote
+
+
+def _get_dispatch_channel(member):
+    """Get a connected dispatch channel to the member
+
+    Returns None if the member does not support dispatch channels, in which
+    case the one connection per request dispatch should be used, or False
+    if the member can not be reached.
+    """
+    name = member['name']
+    if util.monotonic_time() - _legacydispatch.get(name, -600) < 600:
+        return None
+    if name not in _channellocks:
+        _channellocks[name] = semaphore.Semaphore()
+    with _channellocks[name]:
+        channel = _dispatchchannels.get(name, None)
+        if channel is not None and channel.matches(member):
+            return channel
+        if channel is not None:
+            channel.close()
+        try:
+            remote = _connect_to_member(member)
+        except Exception:
+            return False
+        if not util.cert_matches(member['fingerprint'], remote.getpeercert(
+                binary_form=True)):
+            raise Exception("Invalid certificate on peer")
+        try:
+            tlvdata.recv(remote)
+            tlvdata.recv(remote)
+            tlvdata.send(remote, {'dispatchchannel': {
+                'name': collective.get_myname()}})
+            ack = tlvdata.recv(remote)
+        except Exception:
+            ack = None
+        if not isinstance(ack, dict) or 'dispatchchannel' not in ack:
+            # an older member, remember not to ask again for a while
+            _legacydispatch[name] = util.monotonic_time()
+            try:
+                remote.close()
+            except Exception:
+                pass
+            return None
+        channel = DispatchChannel(member, remote)
+        _dispatchchannels[name] = channel
+        return channel
+
+
 def dispatch_request(nodes, manager, element, configmanager, inputdata,
                      operation):
     a = configmanager.get_collective_member(manager)
+    channel = _get_dispatch_channel(a) if a else None
+    if channel:
+        myname = collective.get_myname()
+        dreq = pickle.dumps({'name': myname, 'nodes': list(nodes),
+                             'path': element, 'tenant': configmanager.tenant,
+                             'operation': operation, 'inputdata': inputdata})
+        try:
+            for rsp in channel.request(dreq):
+                rsp = pickle.loads(rsp)
+                if isinstance(rsp, Exception):
+                    raise rsp
+                yield rsp
+        except _ChannelBroken:
+            for node in nodes:
+                yield msg.ConfluentResourceUnavailable(
+                    node, 'Collective member {0} went unreachable'.format(
+                        a['name']))
+        return
+    for rsp in _dispatch_request_oneshot(nodes, a, manager, element,
+                                         configmanager, inputdata, operation,
+                                         channel is None):
+        yield rsp
+
+
+def _dispatch_request_oneshot(nodes, a, manager, element, configmanager,
+                              inputdata, operation, reachable=True):
     try:
-        remote = socket.create_connection((a['address'], 13001))
-        remote.settimeout(90)
-        remote = ssl.wrap_socket(remote, cert_reqs=ssl.CERT_NONE,
-                                 keyfile='/etc/confluent/privkey.pem',
-                                 certfile='/etc/confluent/srvcert.pem')
+        if not reachable:
+            raise Exception('Unable to reach collective member')
+        remote = _connect_to_member(a)
     except Exception:
         for node in nodes:
             if a:
@@ -1003,6 +1256,12 @@ def handle_path(path, operation, configmanager, inputdata=None, autostrip=True):
             configmanager, inputdata, operation, pathcomponents)
     elif pathcomponents[0] == 'version':
         return (msg.Attributes(kv={'version': confluent.__version__}),)
+    elif pathcomponents[0] == 'stats':
+        if operation != 'retrieve':
+            raise exc.InvalidArgumentException('Target is read-only')
+        return (msg.KeyValueData({'alerts': alerts.get_trap_stats(),
+                                  'auth': auth.get_auth_stats(),
+                                  'log': log.get_writer_stats()}),)
     elif pathcomponents[0] == 'users':
         # TODO: when non-administrator accounts exist,
         # they must only be allowed to see their own user
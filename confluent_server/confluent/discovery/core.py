@@ -158,6 +158,133 @@ pending_nodes = {}
 pending_by_uuid = {}
 
 
+class _DiscoveryIndex(object):
+    """Index of the known_info entries by each of the by-* selectors
+
+    Entries are dicts that are updated in place as discovery progresses, so
+    each place that alters a selected value or files an entry under a node
+    is responsible for calling update() or link_node() afterward, which
+    _set_info does for changes of nodename and status.
+    """
+    attributes = {
+        'by-state': 'discostatus',
+        'by-model': 'modelnumber',
+        'by-node': 'nodename',
+        'by-serial': 'serialnumber',
+        'by-uuid': 'uuid',
+    }
+
+    def __init__(self):
+        # selector -> value -> set of macs
+        self.bykey = {}
+        # mac -> set of (selector, value) it is currently filed under
+        self.keysbymac = {}
+        # node -> set of macs, as filed in known_nodes
+        self.macsbynode = {}
+
+    def _add(self, key, mac):
+        selector, value = key
+        byvalue = self.bykey.setdefault(selector, {})
+        if value not in byvalue:
+            byvalue[value] = set([])
+        byvalue[value].add(mac)
+
+    def _discard(self, key, mac):
+        selector, value = key
+        byvalue = self.bykey.get(selector, {})
+        if value not in byvalue:
+            return
+        byvalue[value].discard(mac)
+        if not byvalue[value]:
+            del byvalue[value]
+
+    def update(self, info):
+        mac = info.get('hwaddr', None)
+        if not mac or known_info.get(mac, None) is not info:
+            # a superseded or not yet accepted report of the mac
+            return
+        keys = set([('by-mac', mac)])
+        for selector in self.attributes:
+            value = info.get(self.attributes[selector], None)
+            if value:
+                keys.add((selector, value))
+        for service in info.get('services', ()):
+            keys.add(('by-type', service))
+        oldkeys = self.keysbymac.get(mac, set([]))
+        for key in oldkeys - keys:
+            self._discard(key, mac)
+        for key in keys - oldkeys:
+            self._add(key, mac)
+        self.keysbymac[mac] = keys
+
+    def remove(self, mac):
+        for key in self.keysbymac.pop(mac, ()):
+            self._discard(key, mac)
+
+    def link_node(self, node, mac):
+        if node not in self.macsbynode:
+            self.macsbynode[node] = set([])
+        self.macsbynode[node].add(mac)
+
+    def unlink_node(self, node):
+        self.macsbynode.pop(node, None)
+
+    def _matches(self, selector, value):
+        return self.bykey.get(selector, {}).get(value, ())
+
+    def lookup(self, criteria):
+        """Return the set of macs matching all of the given criteria
+
+        None is returned when there are no criteria, to indicate every
+        known entry without copying them all into a new set.
+        """
+        selectors = [x for x in criteria if criteria[x]]
+        # start from the most selective to keep the intersections small
+        selectors.sort(key=lambda x: len(self._matches(x, criteria[x])))
+        candidates = None
+        for selector in selectors:
+            macs = self._matches(selector, criteria[selector])
+            if candidates is None:
+                candidates = set(macs)
+            else:
+                candidates.intersection_update(macs)
+            if not candidates:
+                break
+        return candidates
+
+    def values(self, selector, candidates=None):
+        """Return the distinct values of selector among candidate macs"""
+        if candidates is None:
+            return set(self.bykey.get(selector, ()))
+        values = set([])
+        for mac in candidates:
+            for key in self.keysbymac.get(mac, ()):
+                if key[0] == selector:
+                    values.add(key[1])
+        return values
+
+    def nodes(self, candidates=None):
+        """Return the nodes having a known entry among candidate macs"""
+        if candidates is None:
+            candidates = self.keysbymac
+        nodes = []
+        for node in self.macsbynode:
+            for mac in self.macsbynode[node]:
+                if mac in candidates:
+                    nodes.append(node)
+                    break
+        return nodes
+
+
+known_index = _DiscoveryIndex()
+
+
+def _set_info(info, **changes):
+    """Apply changes to a discovery entry and refile it in known_index"""
+    info.update(changes)
+    known_index.update(info)
+
+
 def enrich_pxe_info(info):
     sn = None
     mn = None
@@ -172,6 +299,7 @@ def enrich_pxe_info(info):
             info['modelnumber'] = known_uuids[uuid][mac]['modelnumber']
         if nodename is None and 'nodename' in known_uuids[uuid][mac]:
             info['nodename'] = known_uuids[uuid][mac]['nodename']
+    known_index.update(info)
 
 
 
@@ -215,53 +343,22 @@ def send_discovery_datum(info):
         yield msg.KeyValueData({'otheripaddrs': list(info['otheraddresses'])})
 
 
-def _info_matches(info, criteria):
-    model = criteria.get('by-model', None)
-    devtype = criteria.get('by-type', None)
-    node = criteria.get('by-node', None)
-    serial = criteria.get('by-serial', None)
-    status = criteria.get('by-state', None)
-    uuid = criteria.get('by-uuid', None)
-    if model and info.get('modelnumber', None) != model:
-        return False
-    if devtype and devtype not in info.get('services', []):
-            return False
-    if node and info.get('nodename', None) != node:
-        return False
-    if serial and info.get('serialnumber', None) != serial:
-        return False
-    if status and info.get('discostatus', None) != status:
-        return False
-    if uuid and info.get('uuid', None) != uuid:
-        return False
-    return True
-
-
 def list_matching_nodes(criteria):
-    retnodes = []
-    for node in known_nodes:
-        for mac in known_nodes[node]:
-            info = known_info[mac]
-            if _info_matches(info, criteria):
-                retnodes.append(node)
-                break
+    retnodes = known_index.nodes(known_index.lookup(criteria))
     retnodes.sort(key=noderange.humanify_nodename)
     return [msg.ChildCollection(node + '/') for node in retnodes]
 
 
 def list_matching_serials(criteria):
-    for serial in sorted(list(known_serials)):
-        info = known_serials[serial]
-        if _info_matches(info, criteria):
-            yield msg.ChildCollection(serial + '/')
+    serials = known_index.values('by-serial', known_index.lookup(criteria))
+    for serial in sorted(serials):
+        yield msg.ChildCollection(serial + '/')
 
 def list_matching_uuids(criteria):
-    for uuid in sorted(list(known_uuids)):
-        for mac in known_uuids[uuid]:
-            info = known_uuids[uuid][mac]
-            if _info_matches(info, criteria):
-                yield msg.ChildCollection(uuid + '/')
-                break
+    uuids = known_index.values('by-uuid', known_index.lookup(criteria))
+    for uuid in sorted(uuids):
+        if uuid_is_valid(uuid):
+            yield msg.ChildCollection(uuid + '/')
 
 
 def list_matching_states(criteria):
@@ -269,10 +366,11 @@ def list_matching_states(criteria):
                                              'unidentified/')]
 
 def list_matching_macs(criteria):
-    for mac in sorted(list(known_info)):
-        info = known_info[mac]
-        if _info_matches(info, criteria):
-            yield msg.ChildCollection(mac.replace(':', '-'))
+    macs = known_index.lookup(criteria)
+    if macs is None:
+        macs = list(known_info)
+    for mac in sorted(macs):
+        yield msg.ChildCollection(mac.replace(':', '-'))
 
 
 def list_matching_types(criteria):
@@ -409,6 +507,7 @@ def handle_api_request(configmanager, inputdata, operation, pathcomponents):
     elif operation == 'delete':
         mac = _get_mac_from_query(pathcomponents)
         del known_info[mac]
+        known_index.remove(mac)
         return [msg.DeletedResource(mac)]
     raise exc.NotImplementedException(
         'Unable to {0} to {1}'.format(operation, '/'.join(pathcomponents)))
@@ -451,12 +550,8 @@ def detected_services():
 
 
 def detected_models():
-    knownmodels = set([])
-    for info in known_info:
-        info = known_info[info]
-        if 'modelnumber' in info and info['modelnumber'] not in knownmodels:
-            knownmodels.add(info['modelnumber'])
-            yield info['modelnumber']
+    for model in known_index.values('by-model'):
+        yield model
 
 
 def _recheck_nodes(nodeattribs, configmanager):
@@ -473,13 +568,14 @@ def _recheck_nodes_backend(nodeattribs, configmanager):
     # for the nodes whose attributes have changed, consider them as potential
     # strangers
     if nodeattribs:
-        macmap.vintage = 0  # expire current mac map data, in case
+        # expire mac map data of the switches involved, in case
         # the attributes changed impacted the result
+        macmap.expire_node_switches(list(nodeattribs), configmanager)
     for node in nodeattribs:
         if node in known_nodes:
             for somemac in known_nodes[node]:
                 unknown_info[somemac] = known_nodes[node][somemac]
-                unknown_info[somemac]['discostatus'] = 'unidentified'
+                _set_info(unknown_info[somemac], discostatus='unidentified')
     # Now we go through ones we did not find earlier
     for mac in list(unknown_info):
         try:
@@ -551,9 +647,9 @@ def _recheck_single_unknown_info(configmanager, info):
             lastfp = dp.get(nodename, {}).get('pubkeys.tls_hardwaremanager',
                                               {}).get('value', None)
             if util.cert_matches(lastfp, handler.https_cert):
-                info['nodename'] = nodename
                 known_nodes[nodename][info['hwaddr']] = info
-                info['discostatus'] = 'discovered'
+                known_index.link_node(nodename, info['hwaddr'])
+                _set_info(info, nodename=nodename, discostatus='discovered')
                 return  # already known, no need for more
         discopool.spawn_n(eval_node, configmanager, handler, info, nodename)
 
@@ -632,6 +728,7 @@ def detected(info):
             # in that case, however, a user can clear pubkeys to force a check
             return
     known_info[info['hwaddr']] = info
+    known_index.update(info)
     cfg = cfm.ConfigManager(None)
     if handler:
         handler = handler.NodeHandler(info, cfg)
@@ -639,6 +736,8 @@ def detected(info):
     uuid = info.get('uuid', None)
     if uuid_is_valid(uuid):
         known_uuids[uuid][info['hwaddr']] = info
+    # the scan may have filled in the uuid and other indexed values
+    known_index.update(info)
     info['otheraddresses'] = set([])
     for i4addr in info.get('attributes', {}).get('ipv4-address', []):
         info['otheraddresses'].add(i4addr)
@@ -663,7 +762,7 @@ def detected(info):
             rechecktime = util.monotonic_time() + 300
             rechecker = eventlet.spawn_after(300, _periodic_recheck, cfg)
         unknown_info[info['hwaddr']] = info
-        info['discostatus'] = 'unidentfied'
+        _set_info(info, discostatus='unidentfied')
         #TODO, eventlet spawn after to recheck sooner, or somehow else
         # influence periodic recheck to shorten delay?
         return
@@ -674,9 +773,9 @@ def detected(info):
         lastfp = dp.get(nodename, {}).get('pubkeys.tls_hardwaremanager',
                                           {}).get('value', None)
         if util.cert_matches(lastfp, handler.https_cert):
-            info['nodename'] = nodename
             known_nodes[nodename][info['hwaddr']] = info
-            info['discostatus'] = 'discovered'
+            known_index.link_node(nodename, info['hwaddr'])
+            _set_info(info, nodename=nodename, discostatus='discovered')
             return  # already known, no need for more
     #TODO(jjohnson2): We might have to get UUID for certain searches...
     #for now defer probe until inside eval_node.  We might not have
@@ -689,8 +788,8 @@ def detected(info):
                      'address {2}'.format(
                         handler.devname, info['hwaddr'], handler.ipaddr
                       )})
-        info['discostatus'] = 'unidentified'
         unknown_info[info['hwaddr']] = info
+        _set_info(info, discostatus='unidentified')
 
 
 
@@ -787,7 +886,7 @@ def get_nodename(cfg, handler, info):
     if handler.https_supported:
         currcert = handler.https_cert
         if not currcert:
-            info['discofailure'] = 'nohttps'
+            _set_info(info, discofailure='nohttps')
             return None, None
         currprint = util.get_fingerprint(currcert, 'sha256')
         nodename = nodes_by_fprint.get(currprint, None)
@@ -883,7 +982,7 @@ def eval_node(cfg, handler, info, nodename, manual=False):
         handler.preconfig()
     except Exception as e:
         unknown_info[info['hwaddr']] = info
-        info['discostatus'] = 'unidentified'
+        _set_info(info, discostatus='unidentified')
         errorstr = 'An error occured during discovery, check the ' \
                    'trace and stderr logs, mac was {0} and ip was {1}' \
                    ', the node or the containing enclosure was {2}' \
@@ -898,7 +997,7 @@ def eval_node(cfg, handler, info, nodename, manual=False):
     # the node directly.  switch is ambiguous and we should leave it alone
     if 'enclosure.bay' in info and handler.is_enclosure:
         unknown_info[info['hwaddr']] = info
-        info['discostatus'] = 'unidentified'
+        _set_info(info, discostatus='unidentified')
         log.log({'error': 'Something that is an enclosure reported a bay, '
                           'not possible'})
         if manual:
@@ -911,7 +1010,7 @@ def eval_node(cfg, handler, info, nodename, manual=False):
         # might be ambiguous, need to match chassis-uuid as well..
         if 'enclosure.bay' not in info:
             unknown_info[info['hwaddr']] = info
-            info['discostatus'] = 'unidentified'
+            _set_info(info, discostatus='unidentified')
             errorstr = '{2} with mac {0} is in {1}, but unable to ' \
                        'determine bay number'.format(info['hwaddr'],
                                                      nodename,
@@ -954,7 +1053,7 @@ def eval_node(cfg, handler, info, nodename, manual=False):
         nl = list(cfg.filter_node_attributes(
             'enclosure.bay={0}'.format(info['enclosure.bay']), nl))
         if len(nl) != 1:
-            info['discofailure'] = 'ambigconfig'
+            _set_info(info, discofailure='ambigconfig')
             if len(nl):
                 errorstr = 'The following nodes have duplicate ' \
                            'enclosure attributes: ' + ','.join(nl)
@@ -970,7 +1069,7 @@ def eval_node(cfg, handler, info, nodename, manual=False):
                 raise exc.InvalidArgumentException(errorstr)
             log.log({'error': errorstr})
             unknown_info[info['hwaddr']] = info
-            info['discostatus'] = 'unidentified'
+            _set_info(info, discostatus='unidentified')
             return
         nodename = nl[0]
         if not discover_node(cfg, handler, info, nodename, manual):
@@ -1007,9 +1106,10 @@ def eval_node(cfg, handler, info, nodename, manual=False):
 
 def discover_node(cfg, handler, info, nodename, manual):
     known_nodes[nodename][info['hwaddr']] = info
+    known_index.link_node(nodename, info['hwaddr'])
     if info['hwaddr'] in unknown_info:
         del unknown_info[info['hwaddr']]
-    info['discostatus'] = 'identified'
+    _set_info(info, discostatus='identified')
     dp = cfg.get_node_attributes(
         [nodename], ('discovery.policy',
                      'pubkeys.tls_hardwaremanager'))
@@ -1029,7 +1129,7 @@ def discover_node(cfg, handler, info, nodename, manual):
         return do_pxe_discovery(cfg, handler, info, manual, nodename, policies)
     elif ('permissive' in policies and handler.https_supported and lastfp and
             not util.cert_matches(lastfp, handler.https_cert) and not manual):
-        info['discofailure'] = 'fingerprint'
+        _set_info(info, discofailure='fingerprint')
         log.log({'info': 'Detected replacement of {0} with existing '
                          'fingerprint and permissive discovery policy, not '
                          'doing discovery unless discovery.policy=open or '
@@ -1037,7 +1137,7 @@ def discover_node(cfg, handler, info, nodename, manual):
                          'first'.format(nodename)})
         return False  # With a permissive policy, do not discover new
     elif policies & set(('open', 'permissive')) or manual:
-        info['nodename'] = nodename
+        _set_info(info, nodename=nodename)
         if info['handler'] == pxeh:
             return do_pxe_discovery(cfg, handler, info, manual, nodename, policies)
         elif manual or not util.cert_matches(lastfp, handler.https_cert):
@@ -1045,7 +1145,7 @@ def discover_node(cfg, handler, info, nodename, manual):
             try:
                 handler.config(nodename)
             except Exception as e:
-                info['discofailure'] = 'bug'
+                _set_info(info, discofailure='bug')
                 if manual:
                     raise
                 log.log(
@@ -1068,14 +1168,14 @@ def discover_node(cfg, handler, info, nodename, manual):
                 cfg.set_node_attributes({nodename: newnodeattribs})
             log.log({'info': 'Discovered {0} ({1})'.format(nodename,
                                                           handler.devname)})
-        info['discostatus'] = 'discovered'
+        _set_info(info, discostatus='discovered')
         for i in pending_by_uuid.get(curruuid, []):
             eventlet.spawn_n(_recheck_single_unknown_info, cfg, i)
         return True
     log.log({'info': 'Detected {0}, but discovery.policy is not set to a '
                      'value allowing discovery (open or permissive)'.format(
                         nodename)})
-    info['discofailure'] = 'policy'
+    _set_info(info, discofailure='policy')
     return False
 
 
@@ -1103,6 +1203,7 @@ def do_pxe_discovery(cfg, handler, info, manual, nodename, policies):
                 attribs[newattrname] = info['hwaddr']
         if attribs:
             cfg.set_node_attributes({nodename: attribs})
+    known_index.update(info)
     if info['uuid'] in known_pxe_uuids:
         return True
     if uuid_is_valid(info['uuid']):
@@ -1120,7 +1221,7 @@ needaddhandled = False
 def _handle_nodelist_change(configmanager):
     global needaddhandled
     global nodeaddhandler
-    macmap.vintage = 0  # the current mac map is probably inaccurate
+    macmap.expire_portmap()  # the current port map is probably inaccurate
     _recheck_nodes((), configmanager)
     if needaddhandled:
         needaddhandled = False
@@ -1130,7 +1231,6 @@ def _handle_nodelist_change(configmanager):
 
 
 def newnodes(added, deleting, configmanager):
-    global attribwatcher
     global needaddhandled
     global nodeaddhandler
     for node in deleting:
@@ -1139,15 +1239,10 @@ def newnodes(added, deleting, configmanager):
         for mac in known_nodes[node]:
             if mac in known_info:
                 del known_info[mac]
+                known_index.remove(mac)
         del known_nodes[node]
+        known_index.unlink_node(node)
     _map_unique_ids()
-    configmanager.remove_watcher(attribwatcher)
-    allnodes = configmanager.list_nodes()
-    attribwatcher = configmanager.watch_attributes(
-        allnodes, ('discovery.policy', 'net*.switch',
-                   'hardwaremanagement.manager', 'net*.switchport',
-                   'id.uuid', 'pubkeys.tls_hardwaremanager',
-                   'net*.bootable'), _recheck_nodes)
     if nodeaddhandler:
         needaddhandled = True
     else:
@@ -1191,11 +1286,12 @@ def start_detection():
     global rechecker
     _map_unique_ids()
     cfg = cfm.ConfigManager(None)
-    allnodes = cfg.list_nodes()
+    # watching all nodes covers nodes as they are added
     attribwatcher = cfg.watch_attributes(
-        allnodes, ('discovery.policy', 'net*.switch',
-                   'hardwaremanagement.manager', 'net*.switchport', 'id.uuid',
-                   'pubkeys.tls_hardwaremanager'), _recheck_nodes)
+        None, ('discovery.policy', 'net*.switch',
+               'hardwaremanagement.manager', 'net*.switchport', 'id.uuid',
+               'pubkeys.tls_hardwaremanager', 'net*.bootable'),
+        _recheck_nodes)
     cfg.watch_nodecollection(newnodes)
     autosense = cfm.get_global('discovery.autosense')
     if autosense or autosense is None:
@@ -101,10 +101,9 @@ def _parse_slp_packet(packet, peer, rsps, xidmap):
     addr = peer[0]
     if '%' in addr:
         addr = addr[:addr.index('%')]
-    mac = None
-    if addr in neighutil.neightable:
-        identifier = neighutil.neightable[addr]
-        mac = identifier
+    mac = neighutil.get_hwaddr(addr)
+    if mac:
+        identifier = mac
     else:
         identifier = addr
     if (identifier, parsed['xid']) in rsps:
@@ -386,7 +385,7 @@ def rescan(handler):
     for scanned in scan():
         for addr in scanned['addresses']:
             ip = addr[0].partition('%')[0]  # discard scope if present
-            if ip not in neighutil.neightable:
+            if not neighutil.get_hwaddr(ip):
                 continue
             if addr in known_peers:
                 break
@@ -449,12 +448,12 @@ def snoop(handler, protocol=None):
                 for s in r:
                     (rsp, peer) = s.recvfrom(9000)
                     ip = peer[0].partition('%')[0]
-                    if ip not in neighutil.neightable:
+                    mac = neighutil.get_hwaddr(ip)
+                    if not mac:
                         continue
                     if peer in known_peers:
                         continue
                     known_peers.add(peer)
-                    mac = neighutil.neightable[ip]
                     if mac in peerbymacaddress:
                         peerbymacaddress[mac]['addresses'].append(peer)
                     else:
@@ -493,7 +492,7 @@ def active_scan(handler, protocol=None):
     for scanned in scan():
         for addr in scanned['addresses']:
             ip = addr[0].partition('%')[0]  # discard scope if present
-            if ip not in neighutil.neightable:
+            if not neighutil.get_hwaddr(ip):
                 continue
             if addr in known_peers:
                 break
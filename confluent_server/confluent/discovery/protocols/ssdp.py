@@ -96,11 +96,11 @@ def snoop(handler, byehandler=None):
                 method, _, _ = rsp[0].split(' ', 2)
                 if method == 'NOTIFY':
                     ip = peer[0].partition('%')[0]
-                    if ip not in neighutil.neightable:
+                    mac = neighutil.get_hwaddr(ip)
+                    if not mac:
                         continue
                     if peer in known_peers:
                         continue
-                    mac = neighutil.neightable[ip]
                     known_peers.add(peer)
                     newmacs.add(mac)
                     if mac in peerbymacaddress:
@@ -186,10 +186,9 @@ def _find_service(service, target):
 def _parse_ssdp(peer, rsp, peerdata):
     ip = peer[0].partition('%')[0]
     nid = ip
-    mac = None
-    if ip in neighutil.neightable:
-        nid = neighutil.neightable[ip]
-        mac = nid
+    mac = neighutil.get_hwaddr(ip)
+    if mac:
+        nid = mac
     headlines = rsp.split('\r\n')
     try:
         _, code, _ = headlines[0].split(' ', 2)
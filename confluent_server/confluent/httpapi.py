@@ -34,6 +34,7 @@ import copy
 import eventlet
 import eventlet.greenthread
 import greenlet
+import itertools
 import json
 import socket
 import sys
@@ -261,6 +262,12 @@ def _csrf_valid(env, session):
             env['HTTP_CONFLUENTAUTHTOKEN'] == session['csrftoken'])
 
 
+def _session_bound(path):
+    return (path == '/sessions/current/async' or
+            '/console/session' in path or '/shell/sessions/' in path or
+            (path.endswith('/forward/web') and path.startswith('/nodes/')))
+
+
 def _authorize_request(env, operation):
     """Grant/Deny access based on data from wsgi env
 
@@ -268,8 +275,22 @@ def _authorize_request(env, operation):
     authdata = None
     name = ''
     sessionid = None
+    sessid = None
+    bearer = None
     cookie = Cookie.SimpleCookie()
-    if 'HTTP_COOKIE' in env:
+    if env.get('HTTP_AUTHORIZATION', '').startswith('Bearer '):
+        bearer = env['HTTP_AUTHORIZATION'][7:].strip()
+        if env['PATH_INFO'] == '/sessions/current/logout':
+            auth.revoke_token(bearer)
+            return ('logout',)
+        authdata = auth.authorize_token(bearer)
+        if not authdata:
+            return {'code': 401}
+        if _session_bound(env['PATH_INFO']):
+            # these keep state in the http session, which a token lacks
+            return {'code': 403}
+        name = authdata[2]
+    elif 'HTTP_COOKIE' in env:
         #attempt to use the cookie.  If it matches
         cc = RobustCookie()
         cc.load(env['HTTP_COOKIE'])
@@ -292,7 +313,7 @@ def _authorize_request(env, operation):
                     authdata = auth.authorize(
                         name, element=None,
                         skipuserobj=httpsessions[sessionid]['skipuserobject'])
-    if (not authdata) and 'HTTP_AUTHORIZATION' in env:
+    if (not authdata) and bearer is None and 'HTTP_AUTHORIZATION' in env:
         if env['PATH_INFO'] == '/sessions/current/logout':
             if 'HTTP_REFERER' in env:
                 # note that this doesn't actually do harm
@@ -336,9 +357,11 @@ def _authorize_request(env, operation):
         auditmsg['user'] = authdata[2]
         if sessid is not None:
             authinfo['sessionid'] = sessid
+        if bearer is not None:
+            authinfo['bearer'] = bearer
         if not skiplog:
             auditlog.log(auditmsg)
-        if 'csrftoken' in httpsessions[sessid]:
+        if sessid in httpsessions and 'csrftoken' in httpsessions[sessid]:
             authinfo['authtoken'] = httpsessions[sessid]['csrftoken']
         return authinfo
     else:
@@ -360,9 +383,15 @@ def _pick_mimetype(env):
     browsers are very chaotic about ACCEPT HEADER.  It is assumed that
     XMLHttpRequest.setRequestHeader will be used by clever javascript
     if the '.json' scheme doesn't cut it.
+
+    A client may also ask for application/x-ndjson to have the responses
+    streamed as they arrive.
     """
     if env['PATH_INFO'].endswith('.json'):
         return 'application/json; charset=utf-8', '.json'
+    elif ('HTTP_ACCEPT' in env and
+            'application/x-ndjson' in env['HTTP_ACCEPT']):
+        return 'application/x-ndjson; charset=utf-8', ''
     elif env['PATH_INFO'].endswith('.html'):
         return 'text/html', '.html'
     elif 'HTTP_ACCEPT' in env and 'application/json' in env['HTTP_ACCEPT']:
@@ -624,6 +653,13 @@ def resourcehandler_backend(env, start_response):
                 sessinfo['authtoken'] = authorized['authtoken']
             yield json.dumps(sessinfo)
             return
+        if url == '/sessions/current/token' and operation in ('create',
+                                                              'delete'):
+            for rsp in _handle_token_request(authorized, operation,
+                                             querydict, headers,
+                                             start_response):
+                yield rsp
+            return
         resource = '.' + url[url.rindex('/'):]
         lquerydict = copy.deepcopy(querydict)
         try:
@@ -634,6 +670,17 @@ def resourcehandler_backend(env, start_response):
                 start_response('202 Accepted', headers)
                 yield 'Request queued'
                 return
+            if mimetype.startswith('application/x-ndjson'):
+                # pull the first response before declaring success, so
+                # errors raised up front still get their own status
+                hdlr = iter(hdlr)
+                first = next(hdlr, None)
+                start_response('200 OK', headers)
+                if first is not None:
+                    hdlr = itertools.chain((first,), hdlr)
+                    for datum in _stream_json(hdlr, extension):
+                        yield datum
+                return
             pagecontent = ""
             if mimetype == 'text/html':
                 for datum in _assemble_html(hdlr, resource, lquerydict, url,
@@ -653,6 +700,35 @@ def resourcehandler_backend(env, start_response):
                            headers)
             yield e.get_error_body()
 
+def _handle_token_request(authorized, operation, querydict, headers,
+                          start_response):
+    if operation == 'delete':
+        if 'bearer' in authorized:
+            auth.revoke_token(authorized['bearer'])
+        else:
+            auth.revoke_user_tokens(authorized['username'],
+                                    authorized.get('tenant', None))
+        start_response('200 OK', headers)
+        yield json.dumps({'revoked': True})
+        return
+    if 'bearer' in authorized:
+        # a token may not be used to extend itself past its expiry
+        start_response('403 Forbidden', headers)
+        yield json.dumps({'error': 'A token may not be used to issue tokens'})
+        return
+    lifetime = querydict.get('lifetime', None)
+    try:
+        lifetime = int(lifetime) if lifetime else None
+    except ValueError:
+        start_response('400 Bad Request', headers)
+        yield json.dumps({'error': 'lifetime must be a number of seconds'})
+        return
+    token, expiry = auth.issue_token(authorized['username'],
+                                     authorized.get('tenant', None), lifetime)
+    start_response('200 OK', headers)
+    yield json.dumps({'token': token, 'expires': expiry})
+
+
 def _assemble_html(responses, resource, querydict, url, extension):
     yield '<html><head><meta charset="UTF-8"><title>' \
           'Confluent REST Explorer: ' + url + '</title></head>' \
@@ -708,6 +784,37 @@ def _assemble_html(responses, resource, querydict, url, extension):
                '</form></body></html>')
 
 
+def _stream_json(responses, extension=''):
+    """Yield a line of JSON per response as it arrives
+
+    Unlike _assemble_json, nothing is held back to merge into a single
+    document, so the first nodes to answer are sent without waiting on the
+    last and memory use does not grow with the size of the noderange.
+    The caller sets the status after the first response arrives.  An error
+    after that can no longer change the status code, so it is sent as a
+    final line bearing 'error' and 'code'.
+    """
+    try:
+        for rsp in responses:
+            if isinstance(rsp, confluent.messages.LinkRelation):
+                rspdata = {'_links': rsp.raw()}
+                for hk in rspdata['_links']:
+                    if 'href' in rspdata['_links'][hk]:
+                        rspdata['_links'][hk]['href'] = '{0}{1}'.format(
+                            rspdata['_links'][hk]['href'], extension)
+            else:
+                rspdata = rsp.raw()
+            tlvdata.unicode_dictvalues(rspdata)
+            yield json.dumps(rspdata, sort_keys=True, separators=(',', ':'),
+                             ensure_ascii=False).encode('utf-8') + '\n'
+    except exc.ConfluentException as e:
+        if ((not isinstance(e, exc.LockedCredentials)) and
+                e.apierrorcode == 500):
+            raise
+        yield json.dumps({'error': e.apierrorstr,
+                          'code': e.apierrorcode}) + '\n'
+
+
 def _assemble_json(responses, resource=None, url=None, extension=None):
     #NOTE(jbjohnso) I'm considering giving up on yielding bit by bit
     #in json case over http.  Notably, duplicate key values from plugin
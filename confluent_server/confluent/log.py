@@ -59,6 +59,8 @@
 #    (a future extended version might include suport for Forward Secure Sealing
 #    or other fields)
 
+import array
+import bisect
 import collections
 import confluent.config.configmanager
 import confluent.config.conf as conf
@@ -66,10 +68,12 @@ import confluent.exceptions as exc
 import eventlet
 import glob
 import json
+import mmap
 import os
 import re
 import stat
 import struct
+import sys
 import time
 import traceback
 
@@ -156,6 +160,7 @@ class BaseRotatingHandler(object):
         try:
             rolling_type = self.shouldRollover(binrecord, textrecord)
             if rolling_type:
+                self.flush()
                 flock(self.textfile, LOCK_UN)
                 return self.doRollover(rolling_type)
             return None
@@ -174,8 +179,19 @@ class BaseRotatingHandler(object):
                 self.binfile = open(self.binpath, mode='ab')
             self.textfile.write(textrecord)
             self.binfile.write(binrecord)
-            self.textfile.flush()
-            self.binfile.flush()
+        except (IOError, OSError) as e:
+            if not daemonized:
+                raise
+            logfull = True
+
+    def flush(self):
+        global logfull
+        # text before index, so no index record refers to unwritten text
+        try:
+            if self.textfile is not None:
+                self.textfile.flush()
+            if self.binfile is not None:
+                self.binfile.flush()
         except (IOError, OSError) as e:
             if not daemonized:
                 raise
@@ -187,6 +203,7 @@ class BaseRotatingHandler(object):
         return self.textfile.tell() + data_len
 
     def close(self):
+        _openhandlers.pop(self, None)
         if self.textfile:
             if not self.textfile.closed:
                 self.textfile.close()
@@ -508,6 +525,146 @@ class TimedAndSizeRotatingFileHandler(BaseRotatingHandler):
             return self._timeRoll()
 
 
+# Every _timeindexstride'th timestamp of a binary index file is retained
+# in memory for the most recently used files, so that a seek by time is a
+# bisect of that list followed by a scan of a single stride of records
+_timeindexstride = 256
+_timeindexes = collections.OrderedDict()
+_timeindexlimit = 1024
+
+
+class BinaryIndex(object):
+    """Read access to the binary half of a log through mmap
+
+    Records are decoded a chunk at a time from an array of big endian 16 bit
+    words rather than unpacked one at a time, and are yielded as tuples of
+    (ltype, offset, datalen, tstamp, evtdata, eventaux).  The records present
+    when the index is opened are mapped under a shared lock which is then
+    released, as records are only ever appended.
+
+    :param binpath: Path to the binary index file
+    """
+    recsize = 16
+
+    def __init__(self, binpath):
+        self.binpath = binpath
+        self.binfile = open(binpath, mode='rb')
+        flock(self.binfile, LOCK_SH)
+        try:
+            filestat = os.fstat(self.binfile.fileno())
+            self.inode = filestat.st_ino
+            self.count = filestat.st_size // self.recsize
+            self.map = None
+            if self.count:
+                self.map = mmap.mmap(self.binfile.fileno(),
+                                     self.count * self.recsize,
+                                     access=mmap.ACCESS_READ)
+        finally:
+            flock(self.binfile, LOCK_UN)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.binfile is not None:
+            self.binfile.close()
+            self.binfile = None
+
+    def decode(self, start, end):
+        words = array.array('H')
+        words.fromstring(self.map[start * self.recsize:end * self.recsize])
+        if sys.byteorder == 'little':
+            words.byteswap()
+        records = []
+        for base in xrange(0, len(words), 8):
+            records.append((
+                words[base] & 0xff, words[base + 1] << 16 | words[base + 2],
+                words[base + 3], words[base + 4] << 16 | words[base + 5],
+                words[base + 6] >> 8, words[base + 6] & 0xff))
+        return records
+
+    def records(self, start=0, chunk=4096):
+        for idx in xrange(start, self.count, chunk):
+            for record in self.decode(idx, min(idx + chunk, self.count)):
+                yield record
+
+    def reversed_records(self, chunk=4096):
+        end = self.count
+        while end > 0:
+            start = max(end - chunk, 0)
+            for record in reversed(self.decode(start, end)):
+                yield record
+            end = start
+
+    def _get_time_index(self):
+        key = (self.binpath, self.inode)
+        timeindex = _timeindexes.pop(key, [])
+        if len(timeindex) * _timeindexstride > self.count:
+            # the file got shorter than the index, start over
+            timeindex = []
+        for idx in xrange(len(timeindex) * _timeindexstride, self.count,
+                          _timeindexstride):
+            timeindex.append(self.decode(idx, idx + 1)[0][3])
+        _timeindexes[key] = timeindex
+        while len(_timeindexes) > _timeindexlimit:
+            _timeindexes.popitem(last=False)
+        return timeindex
+
+    def find_time(self, tstamp):
+        """Find the first record at or after a timestamp
+
+        :param tstamp: Timestamp in seconds since epoch
+        :returns: Index of the first record with a timestamp not earlier than
+                  tstamp, or count if there is no such record
+        """
+        if not self.count:
+            return 0
+        timeindex = self._get_time_index()
+        block = max(bisect.bisect_left(timeindex, tstamp) - 1, 0)
+        start = block * _timeindexstride
+        end = min(start + 2 * _timeindexstride, self.count)
+        for offset, record in enumerate(self.decode(start, end)):
+            if record[3] >= tstamp:
+                return start + offset
+        return end
+
+
+class _TextMap(object):
+    # The text half of a log mapped as it was when opened
+
+    def __init__(self, textpath):
+        self.map = None
+        self.size = 0
+        with open(textpath, mode='rb') as textfile:
+            flock(textfile, LOCK_SH)
+            try:
+                self.size = os.fstat(textfile.fileno()).st_size
+                if self.size:
+                    self.map = mmap.mmap(textfile.fileno(), self.size,
+                                         access=mmap.ACCESS_READ)
+            finally:
+                flock(textfile, LOCK_UN)
+
+    def __getitem__(self, item):
+        if self.map is None:
+            return ''
+        return self.map[item]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
 class Logger(object):
     """
     :param console:  If true, [] will be used to denote non-text events.  If
@@ -544,8 +701,6 @@ class Logger(object):
             self.filepath = os.path.join(self.filepath, "consoles")
         if not os.path.isdir(self.filepath):
             os.makedirs(self.filepath, 448)
-        self.writer = None
-        self.closer = None
         self.handler = TimedAndSizeRotatingFileHandler(self.filepath, logname,
                                                        interval=1)
         self.lockfile = None
@@ -553,8 +708,22 @@ class Logger(object):
         self.logentries = collections.deque()
 
     def writedata(self):
+        try:
+            self._writeentries()
+        finally:
+            if self.handler.textfile is not None:
+                self.handler.flush()
+                flock(self.handler.textfile, LOCK_UN)
+                _touch_handler(self.handler)
+
+    def _writeentries(self):
+        # Records are written under one lock and flushed once at the end,
+        # rather than locking and flushing for every record
+        textfile = None
         while self.logentries:
-            textfile, binfile = self.handler.open()
+            if textfile is None:
+                textfile, binfile = self.handler.open()
+                flock(textfile, LOCK_EX)
             entry = self.logentries.popleft()
             ltype = entry[0]
             tstamp = entry[1]
@@ -575,7 +744,6 @@ class Logger(object):
             elif not self.isconsole:
                 textdate = time.strftime(
                     '%b %d %H:%M:%S ', time.localtime(tstamp))
-            flock(textfile, LOCK_EX)
             offset = textfile.tell() + len(textdate)
             datalen = len(data)
             eventaux = entry[4]
@@ -597,24 +765,81 @@ class Logger(object):
             files = self.handler.try_emit(binrecord, textrecord)
             if not files:
                 self.handler.emit(binrecord, textrecord)
-                flock(textfile, LOCK_UN)
             else:
                 # Log the rolling event at first, then log the last data
                 # which cause the rolling event.
+                textfile = None
                 to_bfile, to_tfile = files
                 self.logentries.appendleft(entry)
                 roll_data = json.dumps({'previouslogfile': to_tfile})
                 self.logentries.appendleft([DataTypes.event, tstamp, roll_data,
                                             Events.logrollover, None])
-        if self.closer is None:
-            self.closer = eventlet.spawn_after(15, self.closelog)
-        self.writer = None
+
+    def _get_log_files(self, since=None):
+        # Follow the rollover events at the start of each binary index back
+        # through the rolled files, stopping at the first file that
+        # started before since
+        textpath = self.handler.textpath
+        binpath = self.handler.binpath
+        logfiles = []
+        while (textpath, binpath) not in logfiles:
+            try:
+                binindex = BinaryIndex(binpath)
+            except IOError:
+                break
+            with binindex:
+                logfiles.append((textpath, binpath))
+                if not binindex.count:
+                    break
+                ltype, offset, datalen, tstamp, evtdata, _ = \
+                    binindex.decode(0, 1)[0]
+            if (ltype != DataTypes.event or evtdata != Events.logrollover or
+                    (since is not None and tstamp < since)):
+                break
+            with _TextMap(textpath) as textmap:
+                textpath = json.loads(
+                    textmap[offset:offset + datalen])['previouslogfile']
+            dir_name, base_name = os.path.split(textpath)
+            temp = base_name.split('.')
+            temp.insert(1, 'cbl')
+            binpath = os.path.join(dir_name, '.'.join(temp))
+        logfiles.reverse()
+        return logfiles
+
+    def read_text_range(self, since=None, until=None):
+        """Iterate over console data logged within a time range
+
+        The binary index of each file is used to seek to the start of the
+        range, and only the text referenced by matching records is read.
+
+        :param since: Earliest timestamp to include, or None for the oldest
+        :param until: Latest timestamp to include, or None for the newest
+        :returns: Iterable of (timestamp, data) tuples in logged order
+        """
+        for textpath, binpath in self._get_log_files(since):
+            try:
+                binindex = BinaryIndex(binpath)
+            except IOError:
+                continue
+            with binindex:
+                with _TextMap(textpath) as textmap:
+                    start = 0
+                    if since is not None:
+                        start = binindex.find_time(since)
+                    for (ltype, offset, datalen, tstamp, _,
+                            _) in binindex.records(start):
+                        if until is not None and tstamp > until:
+                            return
+                        if (ltype != DataTypes.console or
+                                offset + datalen > textmap.size):
+                            continue
+                        yield tstamp, textmap[offset:offset + datalen]
 
     def read_recent_text(self, size):
 
-        def parse_last_rolling_files(textfile, offset, datalen):
-            textfile.seek(offset, 0)
-            textpath = json.loads(textfile.read(datalen))['previouslogfile']
+        def parse_last_rolling_files(textmap, offset, datalen):
+            textpath = json.loads(
+                textmap[offset:offset + datalen])['previouslogfile']
             dir_name, base_name = os.path.split(textpath)
             temp = base_name.split('.')
             temp.insert(1,'cbl')
@@ -624,96 +849,50 @@ class Logger(object):
 
         textpath = self.handler.textpath
         binpath = self.handler.binpath
-        try:
-            textfile = open(textpath, mode='r')
-            binfile = open(binpath, mode='r')
-        except IOError:
-            return '', 0, 0
-        flock(binfile, LOCK_SH)
-        binfile.seek(0, 2)
-        binidx = binfile.tell()
         currsize = 0
-        offsets = []
+        textdata = []
         termstate = None
         recenttimestamp = 0
-        flock(textfile, LOCK_SH)
-        while binidx > 0 and currsize < size:
-            binidx -= 16
-            binfile.seek(binidx, 0)
-            recbytes = binfile.read(16)
-            (_, ltype, offset, datalen, tstamp, evtdata, eventaux, _) = \
-                struct.unpack(">BBIHIBBH", recbytes)
-            # rolling events found.
-            if ltype == DataTypes.event and evtdata == Events.logrollover:
-                txtpath, bpath = parse_last_rolling_files(textfile, offset,
-                                                          datalen)
-                if txtpath == textpath:
-                    break
-                if bpath == binpath:
-                    break
-                textpath = txtpath
-                binpath = bpath
-                # Rolling event detected, close the current bin file, then open
-                # the renamed bin file.
-                flock(binfile, LOCK_UN)
-                flock(textfile, LOCK_UN)
-                binfile.close()
-                textfile.close()
-                try:
-                    binfile = open(binpath, mode='r')
-                    textfile = open(textpath, mode='r')
-                except IOError:
-                    binfile = None
-                    textfile = None
-                    break
-                flock(binfile, LOCK_SH)
-                flock(textfile, LOCK_SH)
-                binfile.seek(0, 2)
-                binidx = binfile.tell()
-                # things have been set up for next iteration to dig to
-                # previous log file, go to next iteration
-                continue
-            elif ltype != 2:
-                continue
-            if tstamp > recenttimestamp:
-                recenttimestamp = tstamp
-            currsize += datalen
-            offsets.append((offset, datalen, textpath))
-            if termstate is None:
-                termstate = eventaux
-        try:
-            flock(binfile, LOCK_UN)
-            binfile.close()
-        except:
-            pass
-        textdata = ''
-        while offsets:
-            (offset, length, textpath) = offsets.pop()
-            if textfile is None:
-                textfile = open(textpath, mode='r')
-                flock(textfile, LOCK_SH)
-            if textfile.name != textpath:
-                try:
-                    flock(textfile, LOCK_UN)
-                    textfile.close()
-                    textfile = open(textpath, mode='r')
-                    flock(textfile, LOCK_SH)
-                except (ValueError, IOError) as e:
-                    break
+        while currsize < size:
             try:
-                textfile.seek(offset, 0)
-            except ValueError:
-                # file was closed, settle with what we have and continue
+                binindex = BinaryIndex(binpath)
+            except IOError:
                 break
-            textdata += textfile.read(length)
-        try:
-            flock(textfile, LOCK_UN)
-            textfile.close()
-        except:
-            pass
+            nextfiles = None
+            try:
+                with _TextMap(textpath) as textmap:
+                    for (ltype, offset, datalen, tstamp, evtdata,
+                            eventaux) in binindex.reversed_records():
+                        if currsize >= size:
+                            break
+                        if (ltype == DataTypes.event and
+                                evtdata == Events.logrollover):
+                            if textmap.size:
+                                nextfiles = parse_last_rolling_files(
+                                    textmap, offset, datalen)
+                            break
+                        elif ltype != 2:
+                            continue
+                        if tstamp > recenttimestamp:
+                            recenttimestamp = tstamp
+                        currsize += datalen
+                        textdata.append(textmap[offset:offset + datalen])
+                        if termstate is None:
+                            termstate = eventaux
+            except IOError:
+                break
+            finally:
+                binindex.close()
+            # rolling event found, continue into the previous files unless
+            # they are somehow the same as the ones just read
+            if (nextfiles is None or nextfiles[0] == textpath or
+                    nextfiles[1] == binpath):
+                break
+            textpath, binpath = nextfiles
+        textdata.reverse()
         if termstate is None:
             termstate = 0
-        return textdata, termstate, recenttimestamp
+        return ''.join(textdata), termstate, recenttimestamp
 
     def write(self, data):
         """Write plain text to log
@@ -741,9 +920,6 @@ class Logger(object):
                 ltype = 2
             else:
                 ltype = 0
-        if self.closer is not None:
-            self.closer.cancel()
-            self.closer = None
         timestamp = int(time.time())
         if (len(self.logentries) > 0 and ltype == 2 and
                 event == 0 and self.logentries[-1][0] == 2 and
@@ -755,14 +931,116 @@ class Logger(object):
             self.logentries.append(
                 [ltype, timestamp, logdata, event, eventdata])
         if self.buffered:
-            if self.writer is None:
-                self.writer = eventlet.spawn_after(2, self.writedata)
+            _schedule_write(self)
         else:
             self.writedata()
 
     def closelog(self):
         self.handler.close()
-        self.closer = None
+
+# All buffered Loggers are written out by a single flusher greenthread every
+# flush_interval seconds.  Open files are kept in a bounded LRU and closed
+# once idle for a while, rather than each Logger keeping timers of its own.
+_pendingloggers = collections.OrderedDict()
+_openhandlers = collections.OrderedDict()
+_flusher = None
+_closer = None
+_idleclose = 15
+writerstats = {
+    'flushes': 0,
+    'lastflushtime': 0.0,
+    'maxflushtime': 0.0,
+    'writes': 0,
+    'lastwritetime': 0.0,
+    'maxwritetime': 0.0,
+    'totalwritetime': 0.0,
+}
+
+
+def _get_log_option(option, default):
+    value = conf.get_int_option('log', option)
+    if value is None:
+        return default
+    return value
+
+
+def _schedule_write(logger):
+    global _flusher
+    _pendingloggers[logger] = True
+    if _flusher is None:
+        _flusher = eventlet.spawn_after(_get_log_option('flush_interval', 2),
+                                        _flush_loggers)
+
+
+def _touch_handler(handler):
+    global _closer
+    _openhandlers.pop(handler, None)
+    _openhandlers[handler] = time.time()
+    maxopen = _get_log_option('max_open_files', 512)
+    while len(_openhandlers) > maxopen:
+        oldest = next(iter(_openhandlers))
+        oldest.close()
+    if _closer is None:
+        _closer = eventlet.spawn_after(_idleclose, _close_idle_handlers)
+
+
+def _close_idle_handlers():
+    global _closer
+    idlesince = time.time() - _idleclose
+    for handler in list(_openhandlers):
+        if _openhandlers[handler] > idlesince:
+            # the rest were used more recently still
+            break
+        handler.close()
+    if _openhandlers:
+        _closer = eventlet.spawn_after(_idleclose, _close_idle_handlers)
+    else:
+        _closer = None
+
+
+def _flush_loggers():
+    global _flusher
+    started = time.time()
+    pending = list(_pendingloggers)
+    _pendingloggers.clear()
+    for logger in pending:
+        writestart = time.time()
+        try:
+            logger.writedata()
+        except Exception:
+            traceback.print_exc()
+        writetime = time.time() - writestart
+        writerstats['writes'] += 1
+        writerstats['lastwritetime'] = writetime
+        writerstats['totalwritetime'] += writetime
+        if writetime > writerstats['maxwritetime']:
+            writerstats['maxwritetime'] = writetime
+        eventlet.sleep(0)
+    elapsed = time.time() - started
+    writerstats['flushes'] += 1
+    writerstats['lastflushtime'] = elapsed
+    if elapsed > writerstats['maxflushtime']:
+        writerstats['maxflushtime'] = elapsed
+    _flusher = None
+    if _pendingloggers:
+        _flusher = eventlet.spawn_after(_get_log_option('flush_interval', 2),
+                                        _flush_loggers)
+
+
+def get_writer_stats():
+    """Report on the state of buffered log writing
+
+    :returns: dict with the number of loggers and entries waiting to be
+              written, the number of open files, and timings in seconds of
+              flushes and of the writes of each logger within them
+    """
+    stats = dict(writerstats)
+    stats['pendingloggers'] = len(_pendingloggers)
+    stats['pendingentries'] = sum(
+        len(logger.logentries) for logger in _pendingloggers)
+    stats['openfiles'] = len(_openhandlers)
+    return stats
+
 
 globaleventlog = None
 tracelog = None
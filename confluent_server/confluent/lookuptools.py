@@ -26,49 +26,124 @@
 __author__ = 'jjohnson2'
 
 import confluent.config.configmanager as configmanager
-import itertools
+import eventlet.greenpool as greenpool
+import eventlet.semaphore as semaphore
 from eventlet.support import greendns
+import socket
+
+# hardwaremanagement.manager values are indexed by normalized address and by
+# lower case name, with names also indexed by the addresses they resolved
+# to.  Nodes are reindexed when their manager changes, and names are only
+# resolved when the index is next consulted rather than in the notification
+_managerindex = {}
+_nodekeys = {}
+_dirtynodes = set([])
+_indexlock = semaphore.Semaphore()
+_watchers = None
+
+
+def _normalize_address(address):
+    if address.startswith('[') and address.endswith(']'):
+        address = address[1:-1]
+    address = address.split('%')[0]
+    octets = address.split('.')
+    if len(octets) == 4 and all(x.isdigit() for x in octets):
+        # tolerate zero padded forms like 127.000.000.001
+        address = '.'.join(str(int(x)) for x in octets)
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_ntop(family, socket.inet_pton(family, address))
+        except (socket.error, ValueError):
+            continue
+    return None
+
+
+def _resolve(name):
+    addresses = set([])
+    try:
+        for addrinfo in greendns.getaddrinfo(name, None):
+            address = _normalize_address(addrinfo[4][0])
+            if address:
+                addresses.add(address)
+    except Exception:
+        pass
+    return addresses
+
+
+def _get_manager_keys(manager):
+    address = _normalize_address(manager)
+    if address:
+        return set([address])
+    return set([manager.lower()]) | _resolve(manager)
+
+
+def _index_node(node, keys):
+    for key in _nodekeys.pop(node, ()):
+        _managerindex[key].discard(node)
+        if not _managerindex[key]:
+            del _managerindex[key]
+    if keys:
+        _nodekeys[node] = keys
+        for key in keys:
+            _managerindex.setdefault(key, set([])).add(node)
+
+
+def _attribs_changed(nodeattribs, configmanager, **kwargs):
+    _dirtynodes.update(nodeattribs)
+
+
+def _nodes_changed(added, deleting, configmanager):
+    for node in deleting:
+        _dirtynodes.discard(node)
+        _index_node(node, None)
+    if added:
+        _dirtynodes.update(added)
+
+
+def _refresh_index():
+    global _watchers
+    cfm = configmanager.ConfigManager(None)
+    if _watchers is None:
+        _watchers = (
+            cfm.watch_attributes(None, ('hardwaremanagement.manager',),
+                                 _attribs_changed),
+            cfm.watch_nodecollection(_nodes_changed))
+        _dirtynodes.update(cfm.list_nodes())
+    if not _dirtynodes:
+        return
+    nodes = list(_dirtynodes)
+    _dirtynodes.clear()
+    hmattribs = cfm.get_node_attributes(nodes,
+                                        ('hardwaremanagement.manager',))
+    managers = {}
+    for node in nodes:
+        manager = hmattribs.get(node, {}).get(
+            'hardwaremanagement.manager', {}).get('value', None)
+        if manager:
+            managers[node] = manager
+        else:
+            _index_node(node, None)
+    pool = greenpool.GreenPool(64)
+    for node, keys in zip(managers, pool.imap(_get_manager_keys,
+                                               managers.values())):
+        _index_node(node, keys)
 
-manager_to_nodemap = {}
 
 def node_by_manager(manager):
     """Lookup a node by manager
 
     Search for a node according to a given network address.
-    Rather than do a simple equality, it uses getaddrinfo
-    to allow name or ip and different forms of ip.  For
-    example, 'fe80::0001' will match 'fe80::01' and
+    Rather than do a simple equality, addresses are normalized
+    and names are resolved to allow name or ip and different
+    forms of ip.  For example, 'fe80::0001' will match 'fe80::01' and
     '127.000.000.001' will match '127.0.0.1'
 
     :param manager: The ip or resolvable name of the manager
 
     :returns: The node name (if any)
     """
-
-    manageraddresses = []
-    for tmpaddr in greendns.getaddrinfo(manager, None):
-        manageraddresses.append(tmpaddr[4][0])
-    cfm = configmanager.ConfigManager(None)
-    if manager in manager_to_nodemap:
-        # We have a stored hint as to the most probably correct answer
-        # put that node at the head of the list in hopes of reducing
-        # iterations for a lookup in a large environment
-        # However we don't trust the answer either, since
-        # reconfiguration could have changed it and this mapping
-        # is not hooked into getting updates
-        check_nodes = itertools.chain(
-            (manager_to_nodemap[manager],), cfm.list_nodes())
-    else:
-        check_nodes = cfm.list_nodes()
-    hmattribs = cfm.get_node_attributes(check_nodes,
-                                        ('hardwaremanagement.manager',))
-    for node in hmattribs:
-        currhm = hmattribs[node]['hardwaremanagement.manager']['value']
-        if currhm in manageraddresses:
-            manager_to_nodemap[manager] = node
-            return node
-        for curraddr in greendns.getaddrinfo(currhm, None):
-            curraddr = curraddr[4][0]
-            if curraddr in manageraddresses:
-                manager_to_nodemap[manager] = node
-                return node
\ No newline at end of file
+    with _indexlock:
+        _refresh_index()
+    for key in _get_manager_keys(manager):
+        if key in _managerindex:
+            return sorted(_managerindex[key])[0]
@@ -26,6 +26,7 @@
 # It also will optionally snoop SLP DA requests
 
 import atexit
+import confluent.alerts as alerts
 import confluent.auth as auth
 import confluent.config.conf as conf
 import confluent.config.configmanager as configmanager
@@ -33,6 +34,7 @@ import confluent.consoleserver as consoleserver
 import confluent.core as confluentcore
 import confluent.httpapi as httpapi
 import confluent.log as log
+import confluent.telemetry as telemetry
 import confluent.collective.manager as collective
 try:
     import confluent.sockapi as sockapi
@@ -254,6 +256,7 @@ def run():
     webservice = httpapi.HttpApi(http_bind_host, http_bind_port)
     webservice.start()
     disco.start_detection()
+    alerts.start_trap_receiver()
     try:
         sockservice = sockapi.SockApi(sock_bind_host, sock_bind_port)
         sockservice.start()
@@ -262,6 +265,7 @@ def run():
     atexit.register(doexit)
     eventlet.sleep(1)
     consoleserver.start_console_sessions()
+    telemetry.start_sampling()
     while 1:
         eventlet.sleep(100)
 
@@ -23,6 +23,8 @@ import confluent.config.configmanager as cfm
 from copy import deepcopy
 from datetime import datetime
 import json
+import re
+import time
 
 valid_health_values = set([
     'ok',
@@ -393,6 +395,12 @@ def get_input_message(path, operation, inputdata, nodes=None, multinode=False,
         return InputIdentifyMessage(path, nodes, inputdata)
     elif path == ['events', 'hardware', 'decode']:
         return InputAlertData(path, inputdata, nodes)
+    elif path == ['sensors', 'history'] and inputdata:
+        return InputSensorHistory(path, nodes, inputdata)
+    elif path == ['console', 'log'] and inputdata:
+        return InputConsoleLogQuery(path, nodes, inputdata)
+    elif path == ['attributes', 'columns'] and inputdata:
+        return InputAttributeColumns(path, nodes, inputdata)
     elif (path[:3] == ['configuration', 'management_controller', 'users'] and
             operation not in ('retrieve', 'delete') and path[-1] != 'all'):
         return InputCredential(path, inputdata, nodes)
@@ -493,7 +501,18 @@ class Media(ConfluentMessage):
 class InputAlertData(ConfluentMessage):
 
     def __init__(self, path, inputdata, nodes=None):
-        self.alertparams = inputdata
+        self.alertbynode = {}
+        if nodes and all(node in inputdata for node in nodes):
+            # alerts for several nodes, as batched by the trap receiver
+            for node in nodes:
+                self.alertbynode[node] = self._normalize_alert(
+                    dict(inputdata[node]))
+            self.alertparams = None
+        else:
+            self.alertparams = self._normalize_alert(inputdata)
+
+    def _normalize_alert(self, alertparams):
+        self.alertparams = alertparams
         # first migrate snmpv1 input to snmpv2 format
         if 'specifictrap' in self.alertparams:
             # If we have a 'specifictrap', convert to SNMPv2 per RFC 2576
@@ -507,11 +526,85 @@ class InputAlertData(ConfluentMessage):
                 self.alertparams['1.3.6.1.6.3.1.1.4.1.0']
         if '.1.3.6.1.6.3.1.1.4.1.0' not in self.alertparams:
             raise exc.InvalidArgumentException('Missing SNMP Trap OID')
+        return self.alertparams
 
     def get_alert(self, node=None):
+        if node in self.alertbynode:
+            return self.alertbynode[node]
         return self.alertparams
 
 
+class InputSensorHistory(ConfluentMessage):
+
+    def __init__(self, path, nodes, inputdata):
+        self.category = inputdata.get('category', None)
+        if self.category not in (None, 'all', 'temperature', 'energy',
+                                 'power', 'fans'):
+            raise exc.InvalidArgumentException(
+                'Unsupported sensor category ' + self.category)
+        self.interval = self._get_number(inputdata, 'interval', int)
+        self.samples = self._get_number(inputdata, 'samples', int)
+        self.follow = self._get_number(inputdata, 'follow', int)
+        self.since = self._get_number(inputdata, 'since', float)
+
+    def _get_number(self, inputdata, key, numtype):
+        if key not in inputdata:
+            return None
+        try:
+            value = numtype(inputdata[key])
+        except ValueError:
+            raise exc.InvalidArgumentException(
+                '{0} must be a number'.format(key))
+        if value < 0:
+            raise exc.InvalidArgumentException(
+                '{0} must not be negative'.format(key))
+        return value
+
+
+class InputConsoleLogQuery(ConfluentMessage):
+
+    def __init__(self, path, nodes, inputdata):
+        self.since = self._get_time(inputdata, 'since')
+        self.until = self._get_time(inputdata, 'until')
+        self.pattern = inputdata.get('pattern', None)
+        if self.pattern:
+            try:
+                self.pattern = re.compile(self.pattern)
+            except re.error as e:
+                raise exc.InvalidArgumentException(
+                    'Invalid pattern: ' + str(e))
+        else:
+            self.pattern = None
+
+    def _get_time(self, inputdata, key):
+        value = inputdata.get(key, None)
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            raise exc.InvalidArgumentException(
+                '{0} must be seconds since epoch or of the form '
+                'YYYY-MM-DDTHH:MM:SS'.format(key))
+
+
+class InputAttributeColumns(ConfluentMessage):
+
+    def __init__(self, path, nodes, inputdata):
+        self.attributes = inputdata.get('attributes', ())
+        if isinstance(self.attributes, str) or isinstance(self.attributes,
+                                                          unicode):
+            self.attributes = [
+                attr for attr in self.attributes.split(',') if attr]
+        elif not isinstance(self.attributes, list):
+            raise exc.InvalidArgumentException(
+                'attributes must be a list or comma separated names')
+
+
 class InputExpression(ConfluentMessage):
     # This is specifically designed to suppress the expansion of an expression
     # so that it can make it intact to the pertinent configmanager function
@@ -1347,6 +1440,25 @@ class SensorReadings(ConfluentMessage):
             self.kvpairs = {name: {'sensors': readings}}
 
 
+class SensorHistory(ConfluentMessage):
+    readonly = True
+
+    def __init__(self, sensors=(), name=None):
+        self.notnode = name is None
+        if self.notnode:
+            self.kvpairs = {'sensors': list(sensors)}
+        else:
+            self.kvpairs = {name: {'sensors': list(sensors)}}
+
+
+class ConsoleLogLines(ConfluentMessage):
+    readonly = True
+
+    def __init__(self, lines, name):
+        self.notnode = False
+        self.kvpairs = {name: {'lines': lines}}
+
+
 class Firmware(ConfluentMessage):
     readonly = True
 
@@ -1503,6 +1615,38 @@ class Attributes(ConfluentMessage):
                 name: nkv
             }
 
+class AttributeColumns(ConfluentMessage):
+    readonly = True
+
+    def __init__(self, nodes, columns, inheritedfrom=None):
+        self.desc = ''
+        self.notnode = True
+        self.kvpairs = {'nodes': nodes, 'attributes': columns}
+        if inheritedfrom:
+            self.kvpairs['inheritedfrom'] = inheritedfrom
+
+    def strip_node(self, node):
+        # the columns are aligned to the node list, keep it even for one node
+        self.stripped = True
+
+    def html(self, extension=''):
+        htmlout = ''
+        columns = self.kvpairs['attributes']
+        for idx, node in enumerate(self.kvpairs['nodes']):
+            for attribute in sorted(columns):
+                value = columns[attribute][idx]
+                if value is None:
+                    continue
+                if isinstance(value, dict) and 'broken' in value:
+                    value = '*BROKEN*'
+                elif isinstance(value, dict):
+                    value = '********' if value.get('isset', False) else ''
+                elif isinstance(value, list):
+                    value = ','.join(value)
+                htmlout += '{0}: {1}: {2}<br>'.format(node, attribute, value)
+        return htmlout
+
+
 class ConfigSet(Attributes):
     pass
 
@@ -15,11 +15,16 @@
 # limitations under the License.
 
 # A consolidated manage of neighbor table information management.
-# Ultimately, this should use AF_NETLINK, but in the interest of time,
-# use ip neigh for the moment
+# Where AF_NETLINK is available, the table is dumped once and then kept
+# current from the RTM_NEWNEIGH/RTM_DELNEIGH notifications of the kernel,
+# which are read whenever the table is consulted.  Elsewhere, or if the
+# subscription cannot be made, fall back to running ip neigh.
 
+import errno
 import eventlet.green.subprocess as subprocess
 import os
+import socket
+import struct
 
 neightable = {}
 neightime = 0
@@ -27,14 +32,159 @@ neightime = 0
 import re
 
 _validmac = re.compile('..:..:..:..:..:..')
+# Note that these addresses are common static ip addresses
+# that are hopelessly ambiguous if there are many
+# so ignore such entries and move on
+# ideally the system network steers clear of this landmine of
+# a subnet, but just in case
+_ambiguousaddrs = set(['192.168.0.100', '192.168.70.100', '192.168.70.125'])
 
+# from linux/rtnetlink.h and linux/neighbour.h
+NETLINK_ROUTE = 0
+RTMGRP_NEIGH = 4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+RTM_GETNEIGH = 30
+NLM_F_REQUEST = 1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NDA_DST = 1
+NDA_LLADDR = 2
+NUD_NOARP = 0x40
+_nlmsghdr = struct.Struct('=IHHII')
+_ndmsg = struct.Struct('=BBHiHBB')
+_rtattr = struct.Struct('=HH')
 
-def update_neigh():
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _set_entry(table, addr, mac):
+    if addr in _ambiguousaddrs:
+        return
+    if mac is None or not _validmac.match(mac):
+        table.pop(addr, None)
+    else:
+        table[addr] = mac
+
+
+class _NeighborMonitor(object):
+    def __init__(self):
+        self.events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                    NETLINK_ROUTE)
+        try:
+            self.events.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   1048576)
+            self.events.bind((0, RTMGRP_NEIGH))
+            self.events.setblocking(0)
+            # subscribed before the dump, so no change can fall between
+            self.resync()
+        except Exception:
+            self.events.close()
+            raise
+
+    def resync(self):
+        global neightable
+        global neightime
+        dump = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             NETLINK_ROUTE)
+        try:
+            dump.bind((0, 0))
+            request = _nlmsghdr.pack(
+                _nlmsghdr.size + _ndmsg.size, RTM_GETNEIGH,
+                NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + _ndmsg.pack(
+                    socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0)
+            dump.sendto(request, (0, 0))
+            newtable = {}
+            done = False
+            while not done:
+                done = self.process(dump.recv(65536), newtable)
+        finally:
+            dump.close()
+        neightable = newtable
+        neightime = os.times()[4]
+
+    def drain(self):
+        global neightime
+        while True:
+            try:
+                data = self.events.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.ENOBUFS:
+                    # changes were dropped while we were not looking,
+                    # start over from a complete dump
+                    self.resync()
+                    continue
+                raise
+            self.process(data, neightable)
+        neightime = os.times()[4]
+
+    def process(self, data, table):
+        """Apply the neighbor messages in data to table
+
+        Returns True if the end of a dump was reached.
+        """
+        offset = 0
+        while offset + _nlmsghdr.size <= len(data):
+            msglen, msgtype, _, _, _ = _nlmsghdr.unpack_from(data, offset)
+            if msglen < _nlmsghdr.size:
+                break
+            if msgtype == NLMSG_DONE:
+                return True
+            if msgtype == NLMSG_ERROR:
+                raise OSError('Unable to read neighbor table')
+            if msgtype in (RTM_NEWNEIGH, RTM_DELNEIGH):
+                self.process_neighbor(
+                    msgtype, data[offset + _nlmsghdr.size:offset + msglen],
+                    table)
+            offset += _align(msglen)
+        return False
+
+    def process_neighbor(self, msgtype, data, table):
+        family, _, _, _, state, _, _ = _ndmsg.unpack_from(data)
+        addr = mac = None
+        offset = _ndmsg.size
+        while offset + _rtattr.size <= len(data):
+            attrlen, attrtype = _rtattr.unpack_from(data, offset)
+            if attrlen < _rtattr.size:
+                break
+            value = data[offset + _rtattr.size:offset + attrlen]
+            if attrtype == NDA_DST:
+                addr = socket.inet_ntop(family, value)
+            elif attrtype == NDA_LLADDR:
+                mac = ':'.join(['{0:02x}'.format(ord(x)) for x in value])
+            offset += _align(attrlen)
+        if addr is None:
+            return
+        if msgtype == RTM_DELNEIGH or state & NUD_NOARP:
+            # like ip neigh, disregard entries that are not resolved by
+            # arp or neighbor discovery, such as multicast
+            mac = None
+        _set_entry(table, addr, mac)
+
+
+_monitor = None
+
+
+def _get_monitor():
+    global _monitor
+    if _monitor is None:
+        try:
+            _monitor = _NeighborMonitor()
+        except Exception:
+            # no netlink here, or not permitted, use ip neigh instead
+            _monitor = False
+    return _monitor
+
+
+def _fork_update_neigh():
     global neightable
     global neightime
-    neightable = {}
-    if os.name == 'nt':
-        return
+    newtable = {}
     ipn = subprocess.Popen(['ip', 'neigh'], stdin=subprocess.PIPE,
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
@@ -43,22 +193,41 @@ def update_neigh():
         entry = entry.split(' ')
         if len(entry) < 5 or not entry[4]:
             continue
-        if entry[0] in ('192.168.0.100', '192.168.70.100', '192.168.70.125'):
-            # Note that these addresses are common static ip addresses
-            # that are hopelessly ambiguous if there are many
-            # so ignore such entries and move on
-            # ideally the system network steers clear of this landmine of
-            # a subnet, but just in case
-            continue
-        if not _validmac.match(entry[4]):
-            continue
-        neightable[entry[0]] = entry[4]
+        _set_entry(newtable, entry[0], entry[4])
+    neightable = newtable
     neightime = os.times()[4]
 
 
+def update_neigh():
+    if os.name == 'nt':
+        return
+    monitor = _get_monitor()
+    if monitor:
+        monitor.drain()
+    else:
+        _fork_update_neigh()
+
+
 def refresh_neigh():
-    global neightime
     if os.name == 'nt':
         return
-    if os.times()[4] > (neightime + 30):
-        update_neigh()
+    monitor = _get_monitor()
+    if monitor:
+        monitor.drain()
+    elif os.times()[4] > (neightime + 30):
+        _fork_update_neigh()
+
+
+def get_hwaddr(ipaddr):
+    """Look up the hardware address of a neighbor
+
+    With the netlink monitor, pending changes are applied first, so the
+    answer is current without rereading the table.  Otherwise, the answer
+    is as of the last update_neigh or refresh_neigh.
+
+    :param ipaddr: The IP address, without any scope
+    :returns: The hardware address, or None if not known
+    """
+    if os.name != 'nt' and _get_monitor():
+        _monitor.drain()
+    return neightable.get(ipaddr, None)
@@ -178,35 +178,44 @@ def _extract_neighbor_data_b(args):
         return
     conn = snmp.Session(switch, password, user)
     sid = None
+    chassisid = None
     lldpdata = {'!!vintage': now}
-    for sysid in conn.walk('1.3.6.1.2.1.1.2'):
-        sid = str(sysid[1][6:])
     idxtoifname = {}
     idxtoportid = {}
-    _chassisidbyswitch[switch] = sanitize(list(
-        conn.walk('1.0.8802.1.1.2.1.3.2'))[0][1])
-    for oidindex in conn.walk('1.0.8802.1.1.2.1.3.7.1.3'):
-        idx = oidindex[0][-1]
-        idxtoportid[idx] = sanitize(oidindex[1])
-    for oidindex in conn.walk('1.0.8802.1.1.2.1.3.7.1.4'):
+    localdescs = []
+    for table, oidindex in conn.walk_tables(
+            ('1.3.6.1.2.1.1.2', '1.0.8802.1.1.2.1.3.2',
+             '1.0.8802.1.1.2.1.3.7.1.3', '1.0.8802.1.1.2.1.3.7.1.4')):
+        if table == '1.3.6.1.2.1.1.2':
+            sid = str(oidindex[1][6:])
+        elif table == '1.0.8802.1.1.2.1.3.2':
+            if chassisid is None:
+                chassisid = oidindex[1]
+        elif table == '1.0.8802.1.1.2.1.3.7.1.3':
+            idx = oidindex[0][-1]
+            idxtoportid[idx] = sanitize(oidindex[1])
+        else:
+            localdescs.append(oidindex)
+    if chassisid is None:
+        raise exc.TargetEndpointUnreachable(
+            'No LLDP data available from {0}'.format(switch))
+    _chassisidbyswitch[switch] = sanitize(chassisid)
+    for oidindex in localdescs:
         idx = oidindex[0][-1]
         idxtoifname[idx] = _lldpdesc_to_ifname(sid, idx, str(oidindex[1]))
-    for remotedesc in conn.walk('1.0.8802.1.1.2.1.4.1.1.10'):
-        iname = idxtoifname[remotedesc[0][-2]]
-        _init_lldp(lldpdata, iname, remotedesc[0][-2], idxtoportid, switch)
-        _extract_extended_desc(lldpdata[iname], remotedesc[1], user)
-    for remotename in conn.walk('1.0.8802.1.1.2.1.4.1.1.9'):
-        iname = idxtoifname[remotename[0][-2]]
-        _init_lldp(lldpdata, iname, remotename[0][-2], idxtoportid, switch)
-        lldpdata[iname]['peername'] = str(remotename[1])
-    for remotename in conn.walk('1.0.8802.1.1.2.1.4.1.1.7'):
-        iname = idxtoifname[remotename[0][-2]]
-        _init_lldp(lldpdata, iname, remotename[0][-2], idxtoportid, switch)
-        lldpdata[iname]['peerportid'] = sanitize(remotename[1])
-    for remoteid in conn.walk('1.0.8802.1.1.2.1.4.1.1.5'):
-        iname = idxtoifname[remoteid[0][-2]]
-        _init_lldp(lldpdata, iname, remoteid[0][-2], idxtoportid, switch)
-        lldpdata[iname]['peerchassisid'] = sanitize(remoteid[1])
+    for table, remote in conn.walk_tables(
+            ('1.0.8802.1.1.2.1.4.1.1.10', '1.0.8802.1.1.2.1.4.1.1.9',
+             '1.0.8802.1.1.2.1.4.1.1.7', '1.0.8802.1.1.2.1.4.1.1.5')):
+        iname = idxtoifname[remote[0][-2]]
+        _init_lldp(lldpdata, iname, remote[0][-2], idxtoportid, switch)
+        if table == '1.0.8802.1.1.2.1.4.1.1.10':
+            _extract_extended_desc(lldpdata[iname], remote[1], user)
+        elif table == '1.0.8802.1.1.2.1.4.1.1.9':
+            lldpdata[iname]['peername'] = str(remote[1])
+        elif table == '1.0.8802.1.1.2.1.4.1.1.7':
+            lldpdata[iname]['peerportid'] = sanitize(remote[1])
+        else:
+            lldpdata[iname]['peerchassisid'] = sanitize(remote[1])
     for entry in lldpdata:
         if entry == '!!vintage':
             continue
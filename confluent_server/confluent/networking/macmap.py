@@ -47,12 +47,17 @@ import eventlet.semaphore
 import re
 
 _macmap = {}
-_apimacmap = {}
 _macsbyswitch = {}
+_macsonswitch = {}
+_switchesbymac = {}
 _nodesbymac = {}
 _switchportmap = {}
+_portmatchers = {}
 _neighdata = {}
-vintage = None
+# switch -> monotonic time its mac table was last walked
+_switchvintage = {}
+_switchlocks = {}
+_portmapstale = True
 
 
 _whitelistnames = (
@@ -62,42 +67,55 @@ _whitelistnames = (
     re.compile(r'^Unit \d+ Port (\d+)\Z'),
 )
 
-_blacklistnames = (
-    re.compile(r'vl'),
-    re.compile(r'Nu'),
-    re.compile(r'RMON'),
-    re.compile(r'onsole'),
-    re.compile(r'Stack'),
-    re.compile(r'Trunk'),
-    re.compile(r'po\d'),
-    re.compile(r'XGE'),
-    re.compile(r'LAG'),
-    re.compile(r'CPU'),
-    re.compile(r'Management'),
-)
+_blacklistnames = re.compile(
+    r'vl|Nu|RMON|onsole|Stack|Trunk|po\d|XGE|LAG|CPU|Management')
+
+
+class _PortMatcher(object):
+    """Find the configured port description that a switch ifName refers to
+
+    The configured descriptions are indexed up front, so a lookup is a
+    handful of dictionary checks against the forms that the ifName could
+    take (exact, a whitelisted numbering, or a suffix following a
+    non-digit) rather than a regular expression per configured port.
+    """
+
+    def __init__(self, portmap):
+        self.portmap = portmap
+        self.bynumber = {}
+        for portdesc in portmap:
+            try:
+                self.bynumber[int(portdesc)] = portdesc
+            except ValueError:
+                continue
+
+    def match(self, switchdesc):
+        if switchdesc in self.portmap:
+            return switchdesc
+        if self.bynumber:
+            for exp in _whitelistnames:
+                match = exp.match(switchdesc)
+                if match:
+                    snum = int(match.groups()[0])
+                    if snum in self.bynumber:
+                        return self.bynumber[snum]
+        if _blacklistnames.match(switchdesc):
+            return None
+        candidates = [switchdesc]
+        if switchdesc.endswith('.0'):
+            candidates.append(switchdesc[:-2])
+        for candidate in candidates:
+            # longest suffix first, a more specific description wins
+            for idx in range(1, len(candidate)):
+                if candidate[idx - 1] in '0123456789':
+                    continue
+                if candidate[idx:] in self.portmap:
+                    return candidate[idx:]
+        return None
 
 
 def _namesmatch(switchdesc, userdesc):
-    if switchdesc == userdesc:
-        return True
-    try:
-        portnum = int(userdesc)
-    except ValueError:
-        portnum = None
-    if portnum is not None:
-        for exp in _whitelistnames:
-            match = exp.match(switchdesc)
-            if match:
-                snum = int(match.groups()[0])
-                if snum == portnum:
-                    return True
-    anymatch = re.search(r'[^0123456789]' + userdesc + r'(\.0)?\Z', switchdesc)
-    if anymatch:
-        for blexp in _blacklistnames:
-            if blexp.match(switchdesc):
-                return False
-        return True
-    return False
+    return _PortMatcher({userdesc: None}).match(switchdesc) is not None
 
 def _map_switch(args):
     try:
@@ -121,10 +139,13 @@ def _map_switch(args):
 def _nodelookup(switch, ifname):
     """Get a nodename for a given switch and interface name
     """
-    for portdesc in _switchportmap.get(switch, {}):
-        if _namesmatch(ifname, portdesc):
-            return _switchportmap[switch][portdesc]
-    return None
+    matcher = _portmatchers.get(switch, None)
+    if matcher is None:
+        return None
+    portdesc = matcher.match(ifname)
+    if portdesc is None:
+        return None
+    return _switchportmap[switch][portdesc]
 
 
 def _map_switch_backend(args):
@@ -143,7 +164,6 @@ def _map_switch_backend(args):
     #  .1.3.6.1.2.1.2.2.1.2 - ifDescr, usually useless, but a
     #   fallback if ifName is empty
     #
-    global _macmap
     if len(args) == 3:
         switch, password, user = args
         if not user:
@@ -153,17 +173,32 @@ def _map_switch_backend(args):
         user = None
     haveqbridge = False
     mactobridge = {}
+    bridgetoifmap = {}
+    ifnames = []
     conn = snmp.Session(switch, password, user)
-    for vb in conn.walk('1.3.6.1.2.1.17.7.1.2.2.1.2'):
-        haveqbridge = True
-        oid, bridgeport = vb
-        if not bridgeport:
-            continue
-        oid = str(oid).rsplit('.', 6)  # if 7, then oid[1] would be vlan id
-        macaddr = '{0:02x}:{1:02x}:{2:02x}:{3:02x}:{4:02x}:{5:02x}'.format(
-            *([int(x) for x in oid[-6:]])
-        )
-        mactobridge[macaddr] = int(bridgeport)
+    for table, vb in conn.walk_tables(('1.3.6.1.2.1.17.7.1.2.2.1.2',
+                                       '1.3.6.1.2.1.17.1.4.1.2',
+                                       '1.3.6.1.2.1.31.1.1.1.1')):
+        if table == '1.3.6.1.2.1.17.7.1.2.2.1.2':
+            haveqbridge = True
+            oid, bridgeport = vb
+            if not bridgeport:
+                continue
+            oid = str(oid).rsplit('.', 6)  # if 7, then oid[1] would be vlan id
+            macaddr = '{0:02x}:{1:02x}:{2:02x}:{3:02x}:{4:02x}:{5:02x}'.format(
+                *([int(x) for x in oid[-6:]])
+            )
+            mactobridge[macaddr] = int(bridgeport)
+        elif table == '1.3.6.1.2.1.17.1.4.1.2':
+            bridgeport, ifidx = vb
+            bridgeport = int(str(bridgeport).rsplit('.', 1)[1])
+            try:
+                bridgetoifmap[bridgeport] = int(ifidx)
+            except ValueError:
+                # ifidx might be '', skip in such a case
+                continue
+        else:
+            ifnames.append(vb)
     if not haveqbridge:
         for vb in conn.walk('1.3.6.1.2.1.17.4.3.1.2'):
             oid, bridgeport = vb
@@ -174,16 +209,7 @@ def _map_switch_backend(args):
                 *([int(x) for x in oid[-6:]])
             )
             mactobridge[macaddr] = int(bridgeport)
-    bridgetoifmap = {}
-    for vb in conn.walk('1.3.6.1.2.1.17.1.4.1.2'):
-        bridgeport, ifidx = vb
-        bridgeport = int(str(bridgeport).rsplit('.', 1)[1])
-        try:
-            bridgetoifmap[bridgeport] = int(ifidx)
-        except ValueError:
-            # ifidx might be '', skip in such a case
-            continue
-    ifnamemap = get_portnamemap(conn)
+    ifnamemap = get_portnamemap(conn, ifnames)
     maccounts = {}
     bridgetoifvalid = False
     for mac in mactobridge:
@@ -220,66 +246,147 @@ def _map_switch_backend(args):
             ifname = ifnamemap[bridgetoifmap[mactobridge[mac]]]
         except KeyError:
             continue
-        if mac in _macmap:
-            _macmap[mac].append((switch, ifname, maccounts[ifname]))
-        else:
-            _macmap[mac] = [(switch, ifname, maccounts[ifname])]
-        if ifname in newmacs:
-            newmacs[ifname].append(mac)
+        newmacs[mac] = (ifname, maccounts[ifname])
+    _set_switch_macs(switch, newmacs)
+
+
+def _set_switch_macs(switch, newmacs):
+    """Replace the mac table of a switch and reindex the affected macs
+
+    newmacs maps each mac to the ifName it was learned on and how many
+    macs were learned on that ifName.  Only the macs that were or now are
+    on the switch are revisited, the rest of the map stays as is.
+    """
+    oldmacs = _macsonswitch.get(switch, {})
+    if newmacs:
+        _macsonswitch[switch] = newmacs
+    else:
+        _macsonswitch.pop(switch, None)
+    byport = {}
+    for mac in newmacs:
+        ifname = newmacs[mac][0]
+        if ifname in byport:
+            byport[ifname].append(mac)
         else:
-            newmacs[ifname] = [mac]
+            byport[ifname] = [mac]
+    if newmacs:
+        _macsbyswitch[switch] = byport
+    else:
+        _macsbyswitch.pop(switch, None)
+    for mac in oldmacs:
+        if mac not in newmacs:
+            _switchesbymac[mac].discard(switch)
+    for mac in newmacs:
+        if mac not in _switchesbymac:
+            _switchesbymac[mac] = set([])
+        _switchesbymac[mac].add(switch)
+    for mac in set(oldmacs) | set(newmacs):
+        _index_mac(mac)
+
+
+def _index_mac(mac):
+    switches = _switchesbymac.get(mac, ())
+    if not switches:
+        _switchesbymac.pop(mac, None)
+        _macmap.pop(mac, None)
+        _nodesbymac.pop(mac, None)
+        return
+    locations = []
+    nodeinfo = None
+    for switch in sorted(switches):
+        ifname, maccount = _macsonswitch[switch][mac]
+        locations.append((switch, ifname, maccount))
         nodename = _nodelookup(switch, ifname)
-        if nodename is not None:
-            if mac in _nodesbymac and _nodesbymac[mac][0] != nodename:
-                # For example, listed on both a real edge port
-                # and by accident a trunk port
-                log.log({'error': '{0} and {1} described by ambiguous'
-                                  ' switch topology values'.format(
-                                      nodename, _nodesbymac[mac][0])})
-                _nodesbymac[mac] = (None, None)
-            else:
-                _nodesbymac[mac] = (nodename, maccounts[ifname])
-    _macsbyswitch[switch] = newmacs
+        if nodename is None or nodeinfo == (None, None):
+            continue
+        if nodeinfo is not None and nodeinfo[0] != nodename:
+            # For example, listed on both a real edge port
+            # and by accident a trunk port
+            log.log({'error': '{0} and {1} described by ambiguous'
+                              ' switch topology values'.format(
+                                  nodename, nodeinfo[0])})
+            nodeinfo = (None, None)
+        else:
+            nodeinfo = (nodename, maccount)
+    _macmap[mac] = locations
+    if nodeinfo is None:
+        _nodesbymac.pop(mac, None)
+    else:
+        _nodesbymac[mac] = nodeinfo
 
 
 switchbackoff = 30
+_knownswitches = set([])
+_walking = set([])
+
+
+def _is_fresh(switch, maxage):
+    lastwalk = _switchvintage.get(switch, None)
+    return (lastwalk is not None and
+            util.monotonic_time() - lastwalk < maxage)
+
+
+def _nodeinfo_by_mac(mac):
+    return _nodesbymac[mac][0], {'maccount': _nodesbymac[mac][1]}
 
 
 def find_nodeinfo_by_mac(mac, configmanager):
-    now = util.monotonic_time()
-    if vintage and (now - vintage) < 90 and mac in _nodesbymac:
-        return _nodesbymac[mac][0], {'maccount': _nodesbymac[mac][1]}
-    # do not actually sweep switches more than once every 30 seconds
-    # however, if there is an update in progress, wait on it
-    for _ in update_macmap(configmanager,
-                           vintage and (now - vintage) < switchbackoff):
+    if mac in _nodesbymac and not _portmapstale:
+        switches = _switchesbymac.get(mac, ())
+        if all(_is_fresh(switch, 90) for switch in switches):
+            return _nodeinfo_by_mac(mac)
+        # check where it was last seen before considering other switches
+        for _ in update_macmap(configmanager, list(switches), 90):
+            pass
+        if mac in _nodesbymac:
+            return _nodeinfo_by_mac(mac)
+    # do not actually walk a switch more than once every switchbackoff
+    # seconds, however, if there is a walk of it in progress, wait on it
+    for _ in update_macmap(configmanager, maxage=switchbackoff):
         if mac in _nodesbymac:
-            return _nodesbymac[mac][0], {'maccount': _nodesbymac[mac][1]}
+            return _nodeinfo_by_mac(mac)
     # If update_mac bailed out, still check one last time
     if mac in _nodesbymac:
-        return _nodesbymac[mac][0], {'maccount': _nodesbymac[mac][1]}
+        return _nodeinfo_by_mac(mac)
     return None, {'maccount': 0}
 
 
-mapupdating = eventlet.semaphore.Semaphore()
+def expire_portmap():
+    """Note a change to the nodes or their switch topology attributes
 
+    The port to node map is rebuilt on the next lookup, and the cached
+    mac tables are reindexed against it without walking any switches.
+    """
+    global _portmapstale
+    _portmapstale = True
 
-def update_macmap(configmanager, impatient=False):
+
+def expire_node_switches(nodes, configmanager):
+    """Have the switches of the given nodes walked again on next lookup
+
+    Only the switches referenced by the net*.switch attributes of the nodes
+    are affected, the mac tables of the rest remain in use until they
+    age out.
+    """
+    expire_portmap()
+    nodelocations = configmanager.get_node_attributes(nodes, 'net*.switch')
+    for node in nodelocations:
+        cfg = nodelocations[node]
+        for attr in cfg:
+            _switchvintage.pop(cfg[attr].get('value', None), None)
+
+
+def update_macmap(configmanager, switches=None, maxage=0):
     """Interrogate switches to build/update mac table
 
     Begin a rebuild process.  This process is a generator that will yield
     as each switch interrogation completes, allowing a caller to
     recheck the cache as results become possible, rather
     than having to wait for the process to complete to interrogate.
+    If switches is given, only those switches are interrogated, and any
+    switch interrogated less than maxage seconds ago is skipped.
     """
-    if mapupdating.locked():
-        while mapupdating.locked():
-            eventlet.sleep(1)
-            yield None
-        return
-    if impatient:
-        return
-    completions = _full_updatemacmap(configmanager)
+    completions = _updatemacmap(configmanager, switches, maxage)
     for completion in completions:
         try:
             yield completion
@@ -295,69 +402,98 @@ def _finish_update(completions):
         pass
 
 
-def _full_updatemacmap(configmanager):
-    global vintage
-    global _apimacmap
-    global _macmap
-    global _nodesbymac
+def _update_portmap(configmanager):
+    global _portmapstale
     global _switchportmap
-    global _macsbyswitch
-    global switchbackoff
-    start = util.monotonic_time()
-    with mapupdating:
-        vintage = util.monotonic_time()
-        # Clear all existing entries
-        _macmap = {}
-        _nodesbymac = {}
-        _switchportmap = {}
-        if configmanager.tenant is not None:
-            raise exc.ForbiddenRequest(
-                'Network topology not available to tenants')
-        # here's a list of switches... need to add nodes that are switches
-        nodelocations = configmanager.get_node_attributes(
-            configmanager.list_nodes(), ('net*.switch', 'net*.switchport'))
-        switches = set([])
-        for node in nodelocations:
-            cfg = nodelocations[node]
-            for attr in cfg:
-                if not attr.endswith('.switch') or 'value' not in cfg[attr]:
-                    continue
-                curswitch = cfg[attr].get('value', None)
-                if not curswitch:
+    global _portmatchers
+    global _knownswitches
+    # cleared first, so a change while reading is caught next time
+    _portmapstale = False
+    # here's a list of switches... need to add nodes that are switches
+    nodelocations = configmanager.get_node_attributes(
+        configmanager.list_nodes(), ('net*.switch', 'net*.switchport'))
+    switches = set([])
+    switchportmap = {}
+    for node in nodelocations:
+        cfg = nodelocations[node]
+        for attr in cfg:
+            if not attr.endswith('.switch') or 'value' not in cfg[attr]:
+                continue
+            curswitch = cfg[attr].get('value', None)
+            if not curswitch:
+                continue
+            switches.add(curswitch)
+            switchportattr = attr + 'port'
+            if switchportattr in cfg:
+                portname = cfg[switchportattr].get('value', '')
+                if not portname:
                     continue
-                switches.add(curswitch)
-                switchportattr = attr + 'port'
-                if switchportattr in cfg:
-                    portname = cfg[switchportattr].get('value', '')
-                    if not portname:
-                        continue
-                    if curswitch not in _switchportmap:
-                        _switchportmap[curswitch] = {}
-                    if portname in _switchportmap[curswitch]:
-                        log.log({'error': 'Duplicate switch topology config '
-                                          'for {0} and {1}'.format(
-                                            node,
-                                            _switchportmap[curswitch][
-                                                portname])})
-                        _switchportmap[curswitch][portname] = None
-                    else:
-                        _switchportmap[curswitch][portname] = node
-        for switch in list(_macsbyswitch):
-            if switch not in switches:
-                del _macsbyswitch[switch]
-        switchauth = get_switchcreds(configmanager, switches)
-        pool = GreenPool(64)
-        for ans in pool.imap(_map_switch, switchauth):
-            vintage = util.monotonic_time()
-            yield ans
-    _apimacmap = _macmap
-    endtime = util.monotonic_time()
-    duration = endtime - start
-    duration = duration * 15  # wait 15 times as long as it takes to walk
-    # avoid spending a large portion of the time hitting switches with snmp
-    # requests
-    if duration > switchbackoff:
-        switchbackoff = duration
+                if curswitch not in switchportmap:
+                    switchportmap[curswitch] = {}
+                if portname in switchportmap[curswitch]:
+                    log.log({'error': 'Duplicate switch topology config '
+                                      'for {0} and {1}'.format(
+                                        node,
+                                        switchportmap[curswitch][
+                                            portname])})
+                    switchportmap[curswitch][portname] = None
+                else:
+                    switchportmap[curswitch][portname] = node
+    _switchportmap = switchportmap
+    _portmatchers = dict((switch, _PortMatcher(switchportmap[switch]))
+                         for switch in switchportmap)
+    _knownswitches = switches
+    for switch in list(_macsonswitch):
+        if switch not in switches:
+            _set_switch_macs(switch, {})
+            _switchvintage.pop(switch, None)
+    # ports may lead to different nodes now, but the macs behind them have
+    # not moved, so reindex what is already known
+    for mac in list(_switchesbymac):
+        _index_mac(mac)
+
+
+def _refresh_switch(args, maxage):
+    global switchbackoff
+    switch = args[0]
+    if switch not in _switchlocks:
+        _switchlocks[switch] = eventlet.semaphore.Semaphore()
+    with _switchlocks[switch]:
+        # a walk in progress when called may have satisfied the request
+        if _is_fresh(switch, maxage):
+            return
+        start = util.monotonic_time()
+        _walking.add(switch)
+        try:
+            _map_switch(args)
+        finally:
+            _walking.discard(switch)
+            _switchvintage[switch] = util.monotonic_time()
+        # wait 15 times as long as it takes to walk
+        # avoid spending a large portion of the time hitting switches with
+        # snmp requests
+        duration = (_switchvintage[switch] - start) * 15
+        if duration > switchbackoff:
+            switchbackoff = duration
+
+
+def _updatemacmap(configmanager, switches, maxage):
+    if configmanager.tenant is not None:
+        raise exc.ForbiddenRequest(
+            'Network topology not available to tenants')
+    if _portmapstale:
+        _update_portmap(configmanager)
+    if switches is None:
+        switches = _knownswitches
+    switches = [switch for switch in switches if switch in _knownswitches
+                and not _is_fresh(switch, maxage)]
+    if not switches:
+        return
+    switchauth = get_switchcreds(configmanager, switches)
+    pool = GreenPool(64)
+    for ans in pool.imap(_refresh_switch, switchauth,
+                         [maxage] * len(switchauth)):
+        yield ans
 
 
 def _dump_locations(info, macaddr, nodename=None):
@@ -430,7 +566,7 @@ def handle_read_api_request(pathcomponents, configmanager):
     elif pathcomponents[2] == 'by-mac':
         if len(pathcomponents) == 3:
             return [msg.ChildCollection(x.replace(':', '-'))
-                    for x in sorted(list(_apimacmap))]
+                    for x in sorted(list(_macmap))]
         elif len(pathcomponents) == 4:
             return dump_macinfo(pathcomponents[-1])
     elif pathcomponents[2] == 'by-switch':
@@ -464,7 +600,7 @@ def handle_read_api_request(pathcomponents, configmanager):
         if len(pathcomponents) == 8:
             return dump_macinfo(pathcomponents[-1])
     elif pathcomponents[2] == 'rescan':
-        return [msg.KeyValueData({'scanning': mapupdating.locked()})]
+        return [msg.KeyValueData({'scanning': bool(_walking)})]
     raise exc.NotFoundException('Unrecognized path {0}'.format(
         '/'.join(pathcomponents)))
 
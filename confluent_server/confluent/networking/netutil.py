@@ -56,10 +56,18 @@ def list_switches(configmanager):
     return util.natural_sort(switches)
 
 
-def get_portnamemap(conn):
+def get_portnamemap(conn, ifnames=None):
+    """Map interface indexes of a switch to their names
+
+    :param conn: The snmputil session to the switch
+    :param ifnames: Results of an ifName walk already done alongside other
+                    tables, to avoid walking it again
+    """
     ifnamemap = {}
     havenames = False
-    for vb in conn.walk('1.3.6.1.2.1.31.1.1.1.1'):
+    if ifnames is None:
+        ifnames = conn.walk('1.3.6.1.2.1.31.1.1.1.1')
+    for vb in ifnames:
         ifidx, ifname = vb
         if not ifname:
             continue
@@ -20,6 +20,7 @@
 # the middle of strings and use of @ for anything is not in their syntax
 
 
+import collections
 import copy
 import itertools
 import pyparsing as pp
@@ -39,8 +40,47 @@ _numextractor = pp.OneOrMore(pp.Word(pp.alphas + '-') | pp.Word(pp.nums))
 
 numregex = re.compile('([0-9]+)')
 
+# The common forms of 'prefix[N:M]' and 'nX-nY' (or 'nX:nY') may be expanded
+# without going through pyparsing
+_simplebracket = re.compile(r'^([a-zA-Z][a-zA-Z0-9_]*)\[([0-9]+)[:-]([0-9]+)\]$')
+_simplerange = re.compile(r'^([a-zA-Z]+)([0-9]+)[:-]([a-zA-Z]+)([0-9]+)$')
+
 lastnoderange = None
 
+# Parse trees depend only on the noderange string, evaluated results also
+# depend on the node collection and are tagged with its generation
+_cachesize = 256
+_parsecache = collections.OrderedDict()
+_evalcache = collections.OrderedDict()
+
+
+def _cache_get(cache, key):
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        return None
+    cache[key] = value
+    return value
+
+
+def _cache_put(cache, key, value):
+    cache.pop(key, None)
+    cache[key] = value
+    while len(cache) > _cachesize:
+        cache.popitem(last=False)
+
+
+def _parse_noderange(noderange):
+    elements = _cache_get(_parsecache, noderange)
+    if elements is None:
+        try:
+            elements = _parser.parseString(
+                "(" + noderange + ")").asList()[0]
+        except pp.ParseException as pe:
+            raise Exception("Invalid syntax")
+        _cache_put(_parsecache, noderange, elements)
+    return elements
+
 def humanify_nodename(nodename):
     """Analyzes nodename in a human way to enable natural sort
 
@@ -100,18 +140,72 @@ class NodeRange(object):
         self.beginpage = None
         self.endpage = None
         self.cfm = config
-        try:
-            elements = _parser.parseString("(" + noderange + ")").asList()[0]
-        except pp.ParseException as pe:
-            raise Exception("Invalid syntax")
-        if noderange[0] in ('<', '>'):
+        # set if the result depends on attribute values rather than just
+        # the node collection, such a result can not be cached
+        self.volatile = False
+        if config is None:
+            cachekey = (False, None, noderange)
+            generation = None
+        else:
+            cachekey = (True, config.tenant, noderange)
+            generation = config.get_nodecollection_generation()
+        cached = _cache_get(_evalcache, cachekey)
+        if cached is not None and cached[0] == generation:
+            _, nodes, self.beginpage, self.endpage = cached
+            self._noderange = set(nodes)
+            lastnoderange = {noderange: set(self._noderange)}
+            return
+        nodes = self._expand_simple(noderange)
+        if nodes is not None:
+            self._noderange = nodes
+        elif noderange[0] in ('<', '>'):
             # pagination across all nodes
-            self._evaluate(elements)
+            self._evaluate(_parse_noderange(noderange))
             self._noderange = set(self.cfm.list_nodes())
         else:
-            self._noderange = self._evaluate(elements)
+            self._noderange = self._evaluate(_parse_noderange(noderange))
+        if not self.volatile:
+            _cache_put(_evalcache, cachekey, (
+                generation, frozenset(self._noderange), self.beginpage,
+                self.endpage))
         lastnoderange = {noderange: set(self._noderange)}
 
+    def _expand_simple(self, noderange):
+        """Expand the most common simple ranges without the full grammar
+
+        Returns None if the noderange is not of a simple form or if anything
+        other than plain nodes would come of it, in which case the full
+        evaluation is needed.
+        """
+        if self.cfm is not None and (self.cfm.is_node(noderange) or
+                                     self.cfm.is_nodegroup(noderange)):
+            return None
+        simplematch = _simplebracket.match(noderange)
+        if simplematch:
+            prefix, left, right = simplematch.groups()
+        else:
+            simplematch = _simplerange.match(noderange)
+            if not simplematch or simplematch.group(1) != simplematch.group(3):
+                return None
+            prefix, left, _, right = simplematch.groups()
+        leftnum = int(left)
+        rightnum = int(right)
+        if leftnum > rightnum:
+            width = len(right)
+            leftnum, rightnum = rightnum, leftnum
+        elif rightnum > leftnum:
+            width = len(left)
+        else:
+            return None
+        numformat = '%s%%0%dd' % (prefix.replace('%', '%%'), width)
+        nodes = set([])
+        for num in xrange(leftnum, rightnum + 1):
+            nodename = numformat % num
+            if self.cfm is not None and not self.cfm.is_node(nodename):
+                return None
+            nodes.add(nodename)
+        return nodes
+
     @property
     def nodes(self):
         if self.beginpage is None and self.endpage is None:
@@ -204,8 +298,9 @@ class NodeRange(object):
             grpcfg = self.cfm.get_nodegroup_attributes(entname)
             nodes = copy.copy(grpcfg['nodes'])
             if 'noderange' in grpcfg and grpcfg['noderange']:
-                nodes |= NodeRange(
-                    grpcfg['noderange']['value'], self.cfm).nodes
+                grprange = NodeRange(grpcfg['noderange']['value'], self.cfm)
+                self.volatile |= grprange.volatile
+                nodes |= grprange.nodes
             return nodes
         raise Exception('Unknown node ' + entname)
         
@@ -221,6 +316,7 @@ class NodeRange(object):
             element = ''.join(element)
             if self.cfm is None:
                 raise Exception('Verification configmanager required')
+            self.volatile = True
             return set(self.cfm.filter_node_attributes(element, filternodes))
         for idx in xrange(len(element)):
             if element[idx][0] == '[':
@@ -240,8 +336,10 @@ class NodeRange(object):
                 grpcfg = self.cfm.get_nodegroup_attributes(element)
                 nodes = copy.copy(grpcfg['nodes'])
                 if 'noderange' in grpcfg and grpcfg['noderange']:
-                    nodes |= NodeRange(
-                        grpcfg['noderange']['value'], self.cfm).nodes
+                    grprange = NodeRange(grpcfg['noderange']['value'],
+                                         self.cfm)
+                    self.volatile |= grprange.volatile
+                    nodes |= grprange.nodes
                 return nodes
         if ':' in element:  # : range for less ambiguity
             return self.expandrange(element, ':')
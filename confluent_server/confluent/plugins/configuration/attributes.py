@@ -21,7 +21,9 @@ import confluent.util as util
 
 def retrieve(nodes, element, configmanager, inputdata):
     configmanager.check_quorum()
-    if nodes is not None:
+    if nodes is not None and element[-1] == 'columns':
+        return retrieve_columns(nodes, configmanager, inputdata)
+    elif nodes is not None:
         return retrieve_nodes(nodes, element, configmanager, inputdata)
     elif element[0] == 'nodegroups':
         return retrieve_nodegroup(
@@ -102,6 +104,37 @@ def retrieve_nodegroup(nodegroup, element, configmanager, inputdata):
                 raise Exception("BUGGY ATTRIBUTE FOR NODEGROUP")
 
 
+def _column_value(attribute, val):
+    if val is None or isinstance(val, list):
+        return val
+    if attribute.startswith('secret.') or 'cryptvalue' in val:
+        return {'isset': bool(val.get('cryptvalue', None))}
+    if 'broken' in val:
+        return {'broken': val['broken'],
+                'expression': val.get('expression', None)}
+    return val.get('value', None)
+
+
+def retrieve_columns(nodes, configmanager, inputdata):
+    # One response for the whole noderange, each attribute a list of values
+    # aligned to the node list, rather than a message per node and attribute
+    attributes = ()
+    if isinstance(inputdata, msg.InputAttributeColumns):
+        attributes = inputdata.attributes
+    nodes, columns = configmanager.get_node_attribute_columns(
+        util.natural_sort(nodes), attributes)
+    values = {}
+    inheritedfrom = {}
+    for attribute in columns:
+        column = columns[attribute]
+        values[attribute] = [_column_value(attribute, val) for val in column]
+        origins = [val.get('inheritedfrom', None)
+                   if isinstance(val, dict) else None for val in column]
+        if origins.count(None) < len(origins):
+            inheritedfrom[attribute] = origins
+    yield msg.AttributeColumns(nodes, values, inheritedfrom)
+
+
 def retrieve_nodes(nodes, element, configmanager, inputdata):
     attributes = configmanager.get_node_attributes(nodes)
     if element[-1] == 'all':
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import atexit
+import confluent.config.conf as conf
 import confluent.exceptions as exc
 import confluent.firmwaremanager as firmwaremanager
 import confluent.interface.console as conapi
@@ -26,6 +27,7 @@ import eventlet.event
 import eventlet.green.threading as threading
 import eventlet.greenpool as greenpool
 import eventlet.queue as queue
+import eventlet.semaphore as semaphore
 import eventlet.support.greendns
 from fnmatch import fnmatch
 import os
@@ -114,6 +116,80 @@ sensor_categories = {
     'fans': frozenset(['Fan', 'Cooling Device']),
 }
 
+# Sweeps of a sensor category are shared by all requests for the same node
+# and category that arrive while the sweep is running or within
+# _sensorsweepttl seconds after it completed, after which it is discarded
+_sensorsweepttl = 1.0
+_sensorsweeps = {}
+
+
+class SensorSweep(object):
+    """A single pass reading every sensor of a category on a node
+
+    :param ipmicmd: The ipmi command object to read sensors through
+    :param match: Function to select the sensors to read
+    """
+
+    def __init__(self, ipmicmd, match):
+        self.done = eventlet.event.Event()
+        self.completed = None
+        self.readings = []
+        # sensors that exist, but are not available at this time
+        self.unavailable = []
+        eventlet.spawn_n(self._sweep, ipmicmd, match)
+
+    def _sweep(self, ipmicmd, match):
+        try:
+            sensors = ipmicmd.get_sensor_descriptions()
+            for sensor in filter(match, sensors):
+                try:
+                    reading = ipmicmd.get_sensor_reading(sensor['name'])
+                except pygexc.IpmiException as ie:
+                    if ie.ipmicode == 203:
+                        self.unavailable.append(sensor['name'])
+                        continue
+                    raise
+                if hasattr(reading, 'health'):
+                    reading.health = _str_health(reading.health)
+                self.readings.append(reading)
+        except Exception as e:
+            self.completed = util.monotonic_time()
+            self.done.send_exception(e)
+            return
+        self.completed = util.monotonic_time()
+        self.done.send()
+
+    def expired(self):
+        return (self.completed is not None and
+                (self.done.has_exception() or
+                 util.monotonic_time() - self.completed > _sensorsweepttl))
+
+    def wait(self):
+        self.done.wait()
+
+
+def get_sensor_sweep(node, tenant, category, ipmicmd, match):
+    """Get a current sweep of a node's sensors, starting one if needed"""
+    sweepkey = (node, tenant, category)
+    sweep = _sensorsweeps.get(sweepkey, None)
+    if sweep is None or sweep.expired():
+        sweep = SensorSweep(ipmicmd, match)
+        _sensorsweeps[sweepkey] = sweep
+        try:
+            sweep.wait()
+        finally:
+            eventlet.spawn_after(_sensorsweepttl, _drop_sensor_sweep,
+                                 sweepkey, sweep)
+        return sweep
+    sweep.wait()
+    return sweep
+
+
+def _drop_sensor_sweep(sweepkey, sweep):
+    # a newer sweep may have taken its place, leave that one be
+    if _sensorsweeps.get(sweepkey, None) is sweep:
+        del _sensorsweeps[sweepkey]
+
 
 class EmptySensor(object):
     def __init__(self, name):
@@ -358,6 +434,130 @@ class IpmiConsole(conapi.Console):
         self.solconnection.send_break()
 
 
+# Requests against many nodes are admitted through a set of semaphores, one
+# for the whole server and one per BMC subnet and per switch that the node is
+# cabled to, so that a large sweep does not flood a segment with logins and
+# UDP traffic all at once.  Session establishment is additionally paced to
+# a maximum rate of new logins per second.
+_sweepsems = {}
+_nextlogin = 0
+active_sweeps = set([])
+
+
+def _get_sweep_limit(option, default):
+    limit = conf.get_int_option('ipmi', option)
+    if limit is None:
+        return default
+    return limit
+
+
+def _get_sweep_semaphore(key):
+    if key not in _sweepsems:
+        if key is None:
+            limit = _get_sweep_limit('max_sessions', 512)
+        elif key[0] == 'subnet':
+            limit = _get_sweep_limit('max_sessions_per_subnet', 128)
+        else:
+            limit = _get_sweep_limit('max_sessions_per_switch', 64)
+        if limit <= 0:
+            _sweepsems[key] = None
+        else:
+            _sweepsems[key] = semaphore.Semaphore(limit)
+    return _sweepsems[key]
+
+
+def _get_subnet(address):
+    # Only literal addresses are grouped, names are not resolved just to
+    # schedule a request
+    if address.startswith('[') and address.endswith(']'):
+        address = address[1:-1]
+    address = address.split('%')[0]
+    for family, prefix in ((socket.AF_INET, 3), (socket.AF_INET6, 8)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except socket.error:
+            continue
+        return ('subnet', packed[:prefix])
+    return None
+
+
+def _get_sweep_keys(node, configdata, switchdata):
+    keys = set([])
+    bmc = configdata.get(node, {}).get('hardwaremanagement.manager', {}).get(
+        'value', node)
+    subnet = _get_subnet(bmc)
+    if subnet:
+        keys.add(subnet)
+    nodeswitches = switchdata.get(node, {})
+    for attr in nodeswitches:
+        if 'value' in nodeswitches[attr] and nodeswitches[attr]['value']:
+            keys.add(('switch', nodeswitches[attr]['value']))
+    # Always acquire in the same order, and the global semaphore last, so
+    # that a request waiting on a busy switch does not hold a global slot
+    return sorted(keys) + [None]
+
+
+def pace_login():
+    """Wait for a slot to begin establishing a new session
+    """
+    global _nextlogin
+    rate = _get_sweep_limit('login_rate', 200)
+    if rate <= 0:
+        return
+    now = util.monotonic_time()
+    slot = max(now, _nextlogin)
+    _nextlogin = slot + 1.0 / rate
+    if slot > now:
+        eventlet.sleep(slot - now)
+
+
+class SweepProgress(object):
+    """Track the progress of a request against a set of nodes
+
+    :param operator: The operation being performed
+    :param element: The resource path being requested
+    :param total: The number of nodes in the request
+    """
+
+    def __init__(self, operator, element, total):
+        self.operation = operator
+        self.resource = '/'.join(element)
+        self.total = total
+        self.running = 0
+        self.completed = 0
+        self.started = util.monotonic_time()
+
+    @property
+    def pending(self):
+        return self.total - self.running - self.completed
+
+    def __repr__(self):
+        return ('<{0} {1}: {2} of {3} complete, {4} running, '
+                '{5:.1f}s elapsed>'.format(
+                    self.operation, self.resource, self.completed,
+                    self.total, self.running,
+                    util.monotonic_time() - self.started))
+
+
+def scheduled_request(sweepkeys, progress, *args):
+    held = []
+    try:
+        for key in sweepkeys:
+            sem = _get_sweep_semaphore(key)
+            if sem is not None:
+                sem.acquire()
+                held.append(sem)
+        progress.running += 1
+        try:
+            return perform_request(*args)
+        finally:
+            progress.running -= 1
+            progress.completed += 1
+    finally:
+        for sem in reversed(held):
+            sem.release()
+
+
 def perform_requests(operator, nodes, element, cfg, inputdata, realop):
     cryptit = cfg.decrypt
     cfg.decrypt = True
@@ -366,43 +566,53 @@ def perform_requests(operator, nodes, element, cfg, inputdata, realop):
     resultdata = queue.LightQueue()
     livingthreads = set([])
     numnodes = len(nodes)
-    for node in nodes:
-        livingthreads.add(_ipmiworkers.spawn(
-            perform_request, operator, node, element, configdata, inputdata,
-            cfg, resultdata, realop))
-    while livingthreads:
+    progress = SweepProgress(operator, element, numnodes)
+    if numnodes > 1:
+        switchdata = cfg.get_node_attributes(nodes, ('net*.switch',))
+    else:
+        switchdata = {}
+    active_sweeps.add(progress)
+    try:
+        for node in nodes:
+            sweepkeys = _get_sweep_keys(node, configdata, switchdata)
+            livingthreads.add(_ipmiworkers.spawn(
+                scheduled_request, sweepkeys, progress, operator, node,
+                element, configdata, inputdata, cfg, resultdata, realop))
+        while livingthreads:
+            try:
+                bundle = []
+                datum = resultdata.get(timeout=10)
+                while datum:
+                    if datum != 'Done':
+                        if isinstance(datum, Exception):
+                            raise datum
+                        if (hasattr(datum, 'kvpairs') and datum.kvpairs and
+                                len(datum.kvpairs) == 1):
+                            bundle.append((datum.kvpairs.keys()[0], datum))
+                            numnodes -= 1
+                        else:
+                            yield datum
+                    timeout = 0.1 if numnodes else 0.001
+                    datum = resultdata.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            finally:
+                for datum in sorted(
+                        bundle, key=lambda x: util.naturalize_string(x[0])):
+                    yield datum[1]
+            for t in list(livingthreads):
+                if t.dead:
+                    livingthreads.discard(t)
         try:
-            bundle = []
-            datum = resultdata.get(timeout=10)
-            while datum:
+            # drain queue if a thread put something on the queue and died
+            while True:
+                datum = resultdata.get_nowait()
                 if datum != 'Done':
-                    if isinstance(datum, Exception):
-                        raise datum
-                    if (hasattr(datum, 'kvpairs') and datum.kvpairs and
-                            len(datum.kvpairs) == 1):
-                        bundle.append((datum.kvpairs.keys()[0], datum))
-                        numnodes -= 1
-                    else:
-                        yield datum
-                timeout = 0.1 if numnodes else 0.001
-                datum = resultdata.get(timeout=timeout)
+                    yield datum
         except queue.Empty:
             pass
-        finally:
-            for datum in sorted(
-                    bundle, key=lambda x: util.naturalize_string(x[0])):
-                yield datum[1]
-        for t in list(livingthreads):
-            if t.dead:
-                livingthreads.discard(t)
-    try:
-        # drain queue if a thread put something on the queue and died
-        while True:
-            datum = resultdata.get_nowait()
-            if datum != 'Done':
-                yield datum
-    except queue.Empty:
-        pass
+    finally:
+        active_sweeps.discard(progress)
 
 
 def perform_request(operator, node, element,
@@ -468,6 +678,7 @@ class IpmiHandler(object):
             except KeyError:  # was no previous session
                 pass
             try:
+                pace_login()
                 persistent_ipmicmds[(node, tenant)] = IpmiCommandWrapper(
                     node, cfg, bmc=connparams['bmc'],
                     userid=connparams['username'],
@@ -802,22 +1013,14 @@ class IpmiHandler(object):
 
     def read_sensors(self, sensorname):
         if sensorname == 'all':
-            sensors = self.ipmicmd.get_sensor_descriptions()
-            readings = []
-            for sensor in filter(self.match_sensor, sensors):
-                try:
-                    reading = self.ipmicmd.get_sensor_reading(
-                        sensor['name'])
-                except pygexc.IpmiException as ie:
-                    if ie.ipmicode == 203:
-                        self.output.put(msg.SensorReadings([EmptySensor(
-                            sensor['name'])], name=self.node))
-                        continue
-                    raise
-                if hasattr(reading, 'health'):
-                    reading.health = _str_health(reading.health)
-                readings.append(reading)
-            self.output.put(msg.SensorReadings(readings, name=self.node))
+            sweep = get_sensor_sweep(self.node, self.tenant,
+                                     self.sensorcategory, self.ipmicmd,
+                                     self.match_sensor)
+            for sensorname in sweep.unavailable:
+                self.output.put(msg.SensorReadings([EmptySensor(
+                    sensorname)], name=self.node))
+            self.output.put(msg.SensorReadings(list(sweep.readings),
+                                               name=self.node))
         else:
             self.make_sensor_map()
             if sensorname not in self.sensormap:
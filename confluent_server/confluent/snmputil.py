@@ -21,21 +21,116 @@
 # patch pysnmp to have it be eventlet friendly has caused it's selection
 # This module simplifies the complex hlapi pysnmp interface
 
+import collections
+import confluent.config.conf as conf
 import confluent.exceptions as exc
 import eventlet
 from eventlet.support.greendns import getaddrinfo
+import pysnmp.proto.rfc1905 as rfc1905
 import pysnmp.smi.error as snmperr
 import socket
+import time
 snmp = eventlet.import_patched('pysnmp.hlapi')
 
-
-def _get_transport(name):
+# Engines are the expensive part of a session (and with SNMPv3 carry the
+# discovered engine id and time of the agent), so they are kept per target
+# and credential and reused across sessions rather than made per session.
+# An engine is only ever used by one walk at a time, so a target being
+# walked concurrently will have several in its pool.
+# (server, secret, username, context) -> [_Engine]
+_idleengines = collections.OrderedDict()
+_idlecount = 0
+# server -> (resolved address, family, expiry)
+_addresses = {}
+_addressttl = 300
+
+
+def _get_int_option(option, default):
+    value = conf.get_int_option('snmp', option)
+    if value is None:
+        return default
+    return value
+
+
+def _resolve(name):
+    now = time.time()
+    cached = _addresses.get(name, None)
+    if cached and cached[2] > now:
+        return cached[:2]
     # Annoyingly, pysnmp does not automatically determine ipv6 v ipv4
     res = getaddrinfo(name, 161, 0, socket.SOCK_DGRAM)
-    if res[0][0] == socket.AF_INET6:
-        return snmp.Udp6TransportTarget(res[0][4])
+    _addresses[name] = (res[0][4], res[0][0], now + _addressttl)
+    return res[0][4], res[0][0]
+
+
+def _get_transport(name):
+    addr, family = _resolve(name)
+    if family == socket.AF_INET6:
+        return snmp.Udp6TransportTarget(addr)
     else:
-        return snmp.UdpTransportTarget(res[0][4])
+        return snmp.UdpTransportTarget(addr)
+
+
+class _Engine(object):
+    """An SNMP engine with the transport and auth data to reach one target"""
+
+    def __init__(self, key):
+        server, secret, username, context = key
+        self.key = key
+        if username is None:
+            # SNMP v2c
+            self.authdata = snmp.CommunityData(secret, mpModel=1)
+        else:
+            self.authdata = snmp.UsmUserData(
+                username, authKey=secret, privKey=secret,
+                authProtocol=snmp.usmHMACSHAAuthProtocol)
+        self.eng = snmp.SnmpEngine()
+        self.transport = _get_transport(server)
+        self.ctx = snmp.ContextData(context)
+
+
+def _get_engine(key):
+    global _idlecount
+    idle = _idleengines.get(key, None)
+    if idle:
+        _idlecount -= 1
+        engine = idle.pop()
+        if not idle:
+            del _idleengines[key]
+        return engine
+    return _Engine(key)
+
+
+def _release_engine(engine):
+    global _idlecount
+    limit = _get_int_option('max_idle_engines', 256)
+    if limit <= 0:
+        return
+    key = engine.key
+    idle = _idleengines.pop(key, [])
+    idle.append(engine)
+    # reinserted to mark it as the most recently used
+    _idleengines[key] = idle
+    _idlecount += 1
+    while _idlecount > limit:
+        oldest = next(iter(_idleengines))
+        _idleengines[oldest].pop(0)
+        _idlecount -= 1
+        if not _idleengines[oldest]:
+            del _idleengines[oldest]
+
+
+def _forget_target(server):
+    """Discard cached state of a target that failed to respond
+
+    The name may resolve differently now, or the agent may have been reset
+    and have a new engine id, so the next session should start afresh.
+    """
+    global _idlecount
+    _addresses.pop(server, None)
+    for key in list(_idleengines):
+        if key[0] == server:
+            _idlecount -= len(_idleengines.pop(key))
 
 
 class Session(object):
@@ -55,42 +150,57 @@ class Session(object):
         """
         self.server = server
         self.context = context
-        if username is None:
-            # SNMP v2c
-            self.authdata = snmp.CommunityData(secret, mpModel=1)
-        else:
-            self.authdata = snmp.UsmUserData(
-                username, authKey=secret, privKey=secret,
-                authProtocol=snmp.usmHMACSHAAuthProtocol)
-        self.eng = snmp.SnmpEngine()
+        self.key = (server, secret, username, context)
 
-    def walk(self, oid):
+    def walk(self, oid, maxrepetitions=None):
         """Walk over children of a given OID
 
         This is roughly equivalent to snmpwalk.  It will automatically try to
         be a snmpbulkwalk if possible.
 
         :param oid: The SNMP object identifier
+        :param maxrepetitions: How many entries to request per response
+        """
+        for _, ans in self.walk_tables((oid,), maxrepetitions):
+            yield ans
+
+    def walk_tables(self, oids, maxrepetitions=None):
+        """Walk over children of several OIDs in one pass
+
+        Each request asks for the next entries of every table still being
+        walked, rather than walking each table in turn, which saves round
+        trips when walking several columns of the same table.
+        Yields tuples of the requested oid and a result under it.
+
+        :param oids: The SNMP object identifiers
+        :param maxrepetitions: How many entries of each OID to request per
+                               response, the [snmp] max_repetitions option
+                               or 10 if not given
         """
         # SNMP is a complicated mess of things.  Will endeavor to shield caller
         # from as much as possible, assuming reasonable defaults when possible.
         # there may come a time where we add more parameters to override the
         # automatic behavior (e.g. DES is weak, so it's likely to be
         # overriden, but some devices only support DES)
-        tp = _get_transport(self.server)
-        ctx = snmp.ContextData(self.context)
-        if '::' in oid:
-            mib, field = oid.split('::')
-            obj = snmp.ObjectType(snmp.ObjectIdentity(mib, field))
-        else:
-            obj = snmp.ObjectType(snmp.ObjectIdentity(oid))
-
-        walking = snmp.bulkCmd(self.eng, self.authdata, tp, ctx, 0, 10, obj,
+        if maxrepetitions is None:
+            maxrepetitions = _get_int_option('max_repetitions', 10)
+        objs = []
+        for oid in oids:
+            if '::' in oid:
+                mib, field = oid.split('::')
+                objs.append(snmp.ObjectType(snmp.ObjectIdentity(mib, field)))
+            else:
+                objs.append(snmp.ObjectType(snmp.ObjectIdentity(oid)))
+        engine = _get_engine(self.key)
+        walking = snmp.bulkCmd(engine.eng, engine.authdata, engine.transport,
+                               engine.ctx, 0, maxrepetitions, *objs,
                                lexicographicMode=False)
+        healthy = False
         try:
             for rsp in walking:
                 errstr, errnum, erridx, answers = rsp
                 if errstr:
+                    _forget_target(self.server)
                     errstr = str(errstr)
                     finerr = errstr + ' while trying to connect to ' \
                                       '{0}'.format(self.server)
@@ -103,15 +213,24 @@ class Session(object):
                     raise exc.ConfluentException(errnum.prettyPrint() +
                                                  ' while trying to connect to '
                                                  '{0}'.format(self.server))
-                for ans in answers:
-                    if not obj[0].isPrefixOf(ans[0]):
-                        # PySNMP returns leftovers in a bulk command
-                        # filter out such leftovers
-                        break
-                    yield ans
+                for idx, ans in enumerate(answers):
+                    if (isinstance(ans[1], rfc1905.EndOfMibView) or
+                            not objs[idx][0].isPrefixOf(ans[0])):
+                        # PySNMP returns leftovers in a bulk command, and
+                        # marks the end of a table walked to completion
+                        # while others continue, filter out such leftovers
+                        continue
+                    yield oids[idx], ans
+            healthy = True
         except snmperr.WrongValueError:
             raise exc.TargetEndpointBadCredentials('Invalid SNMPv3 password')
-
+        finally:
+            if healthy:
+                _release_engine(engine)
+            else:
+                # an abandoned or failed walk may leave a response or
+                # error state behind, do not hand the engine to another
+                walking.close()
 
 
 if __name__ == '__main__':
@@ -134,6 +134,9 @@ def sessionhdl(connection, authname, skipauth=False, cert=None):
             dreq = tlvdata.recvall(connection, response['dispatch']['length'])
             return pluginapi.handle_dispatch(connection, cert, dreq,
                                              response['dispatch']['name'])
+        if 'dispatchchannel' in response:
+            return pluginapi.handle_dispatch_channel(
+                connection, cert, response['dispatchchannel']['name'])
         if 'proxyconsole' in response:
             return start_proxy_term(connection, cert, response['proxyconsole'])
         authname = response['username']
@@ -0,0 +1,283 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2018 Lenovo
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module periodically samples sensor categories for subscribed nodes and
+# retains a bounded history of readings per sensor.  The history is kept in
+# fixed size ring buffers backed by arrays rather than lists of dicts, so
+# that a large noderange sampled every few seconds has a predictable and
+# modest memory footprint.
+# A subscription is made by a create against /noderange/<nr>/sensors/history
+# with a category and optionally an interval in seconds and number of samples
+# to retain.  A retrieve returns the retained history, and given 'follow'
+# will continue to yield new samples as they are collected for that many
+# seconds, which is intended for use with an async session.
+
+import array
+import confluent.config.conf as conf
+import confluent.config.configmanager as configmodule
+import confluent.core as pluginapi
+import confluent.exceptions as exc
+import confluent.log as log
+import confluent.messages as msg
+import confluent.noderange as noderange
+import eventlet
+import eventlet.queue as queue
+import time
+
+categories = ('all', 'temperature', 'energy', 'power', 'fans')
+# (tenant, category) -> {'nodes': set, 'interval': seconds, 'samples': count}
+_subscriptions = {}
+_samplers = {}
+# (tenant, node) -> {sensorname: _SensorRing}
+_history = {}
+# tenant -> set of _Follower
+_followers = {}
+
+
+def _default_interval():
+    return conf.get_int_option('telemetry', 'interval') or 10
+
+
+def _default_samples():
+    return conf.get_int_option('telemetry', 'samples') or 360
+
+
+class _SensorRing(object):
+    __slots__ = ('category', 'units', 'times', 'values', 'pos', 'count')
+
+    def __init__(self, category, units, size):
+        self.category = category
+        self.units = units
+        self.times = array.array('d', (0,)) * size
+        self.values = array.array('d', (0,)) * size
+        self.pos = 0
+        self.count = 0
+
+    def add(self, timestamp, value):
+        size = len(self.times)
+        self.times[self.pos] = timestamp
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % size
+        if self.count < size:
+            self.count += 1
+
+    def samples(self, since=None):
+        size = len(self.times)
+        start = (self.pos - self.count) % size
+        for idx in range(self.count):
+            idx = (start + idx) % size
+            if since is not None and self.times[idx] <= since:
+                continue
+            yield [self.times[idx], self.values[idx]]
+
+
+class _Follower(object):
+    def __init__(self, nodes, category):
+        self.nodes = set(nodes)
+        self.category = category
+        self.pending = queue.LightQueue()
+
+
+def _save_subscriptions():
+    saved = []
+    for tenant, category in _subscriptions:
+        sub = _subscriptions[(tenant, category)]
+        saved.append({'tenant': tenant, 'category': category,
+                      'nodes': sorted(sub['nodes']),
+                      'interval': sub['interval'],
+                      'samples': sub['samples']})
+    configmodule.set_global('sensorhistory', saved)
+
+
+def _restore_subscriptions(configmanager):
+    saved = configmodule.get_global('sensorhistory')
+    if not saved:
+        return
+    for sub in saved:
+        if sub['tenant'] != configmanager.tenant:
+            continue
+        _subscribe(configmanager, sub['nodes'], sub['category'],
+                   sub['interval'], sub['samples'], save=False)
+
+
+def start_sampling():
+    configmodule.hook_new_configmanagers(_restore_subscriptions)
+
+
+def _subscribe(configmanager, nodes, category, interval, samples, save=True):
+    key = (configmanager.tenant, category)
+    if key not in _subscriptions:
+        _subscriptions[key] = {'nodes': set(), 'noderange': None}
+    sub = _subscriptions[key]
+    sub['nodes'].update(nodes)
+    sub['noderange'] = None
+    sub['interval'] = interval
+    sub['samples'] = samples
+    if key not in _samplers:
+        _samplers[key] = eventlet.spawn(_sample_loop, key)
+    if save:
+        _save_subscriptions()
+
+
+def _unsubscribe(configmanager, nodes, category):
+    tenant = configmanager.tenant
+    for key in list(_subscriptions):
+        if key[0] != tenant or category not in (None, key[1]):
+            continue
+        sub = _subscriptions[key]
+        sub['nodes'].difference_update(nodes)
+        sub['noderange'] = None
+        if not sub['nodes']:
+            del _subscriptions[key]
+    for node in nodes:
+        if category is None:
+            _history.pop((tenant, node), None)
+            continue
+        rings = _history.get((tenant, node), {})
+        for sensor in list(rings):
+            if rings[sensor].category == category:
+                del rings[sensor]
+    _save_subscriptions()
+
+
+def _sample_loop(key):
+    tenant, category = key
+    try:
+        while key in _subscriptions:
+            sub = _subscriptions[key]
+            started = time.time()
+            try:
+                _sample(tenant, category, sub)
+            except Exception:
+                log.logtrace()
+            eventlet.sleep(max(sub['interval'] - (time.time() - started), 0))
+    finally:
+        del _samplers[key]
+
+
+def _sample(tenant, category, sub):
+    cfm = configmodule.ConfigManager(tenant)
+    if not sub['noderange']:
+        # abbreviate once per change in membership, rather than handing the
+        # full node list to the noderange parser every interval
+        nodes = set(sub['nodes']) & set(cfm.list_nodes())
+        if not nodes:
+            return
+        sub['noderange'] = noderange.ReverseNodeRange(nodes, cfm).noderange
+    path = '/noderange/{0}/sensors/hardware/{1}/all'.format(
+        sub['noderange'], category)
+    for rsp in pluginapi.handle_path(path, 'retrieve', cfm):
+        if not isinstance(rsp, msg.SensorReadings):
+            continue
+        now = time.time()
+        for node in rsp.kvpairs:
+            readings = rsp.kvpairs[node].get('sensors', ())
+            if node in sub['nodes']:
+                _record(tenant, node, category, sub['samples'], now,
+                        readings)
+
+
+def _record(tenant, node, category, size, timestamp, readings):
+    rings = _history.setdefault((tenant, node), {})
+    updated = []
+    for reading in readings:
+        value = reading.get('value', None)
+        if not isinstance(value, (int, long, float)):
+            continue
+        name = reading['name']
+        ring = rings.get(name, None)
+        if ring is None or len(ring.times) != size:
+            ring = _SensorRing(category, reading.get('units', None), size)
+            rings[name] = ring
+        ring.add(timestamp, value)
+        updated.append({'name': name, 'units': ring.units,
+                        'category': category,
+                        'samples': [[timestamp, value]]})
+    if not updated:
+        return
+    for follower in _followers.get(tenant, ()):
+        if node in follower.nodes and follower.category in (None, category):
+            follower.pending.put((node, updated))
+
+
+def _node_history(tenant, node, category, since):
+    rings = _history.get((tenant, node), {})
+    sensors = []
+    for name in sorted(rings):
+        ring = rings[name]
+        if category not in (None, ring.category):
+            continue
+        sensors.append({'name': name, 'units': ring.units,
+                        'category': ring.category,
+                        'samples': list(ring.samples(since))})
+    return msg.SensorHistory(sensors, node)
+
+
+def _follow(tenant, nodes, category, duration):
+    follower = _Follower(nodes, category)
+    if tenant not in _followers:
+        _followers[tenant] = set()
+    _followers[tenant].add(follower)
+    deadline = time.time() + duration
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            try:
+                node, sensors = follower.pending.get(timeout=remaining)
+            except queue.Empty:
+                return
+            yield msg.SensorHistory(sensors, node)
+    finally:
+        _followers[tenant].discard(follower)
+
+
+def create(nodes, element, configmanager, inputdata):
+    if inputdata is None or inputdata.category is None:
+        raise exc.InvalidArgumentException(
+            'A sensor category is required to subscribe')
+    interval = inputdata.interval or _default_interval()
+    samples = inputdata.samples or _default_samples()
+    _subscribe(configmanager, nodes, inputdata.category, interval, samples)
+    for node in nodes:
+        yield msg.KeyValueData({'category': inputdata.category,
+                                'interval': interval,
+                                'samples': samples}, node)
+
+
+def retrieve(nodes, element, configmanager, inputdata):
+    category = since = None
+    follow = 0
+    if inputdata is not None:
+        category = inputdata.category
+        since = inputdata.since
+        follow = inputdata.follow
+    tenant = configmanager.tenant
+    for node in nodes:
+        yield _node_history(tenant, node, category, since)
+    if follow:
+        for rsp in _follow(tenant, nodes, category, follow):
+            yield rsp
+
+
+def delete(nodes, element, configmanager, inputdata):
+    category = None
+    if inputdata is not None:
+        category = inputdata.category
+    _unsubscribe(configmanager, nodes, category)
+    for node in nodes:
+        yield msg.DeletedResource(node)